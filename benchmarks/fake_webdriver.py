@@ -0,0 +1,231 @@
+"""fake_webdriver
+
+In-process stand-in for a Selenium WebDriver serving synthetic pages, so pytest-needle can be benchmarked without a
+browser or network.
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+import base64
+import random
+import sys
+from PIL import Image, ImageDraw
+
+if sys.version_info >= (3, 0):
+    from io import BytesIO as IOClass
+else:
+    from StringIO import StringIO as IOClass  # pylint: disable=E0401
+
+
+def make_page(width, height, viewport_height=None, seed=0):
+    """Draw a synthetic web page with a header, sidebar, text content and ad boxes
+
+    The page is drawn from a seeded random generator, so the same arguments always produce the same pixels.
+
+    :param int width: Page width in pixels
+    :param int height: Page height in pixels
+    :param int viewport_height: Height of the viewport the header is fixed to (Optional)
+    :param int seed: Random seed
+    :return: Page image and layout, element rectangles (left, top, width, height, fixed) by element id
+    :rtype: tuple
+    """
+
+    rand = random.Random(seed)
+    viewport_height = viewport_height or height
+
+    page = Image.new('RGB', (width, height), (255, 255, 255))
+    canvas = ImageDraw.Draw(page)
+
+    sidebar = max(width // 5, 120)
+    column = max(width // 4, 300)
+
+    layout = {
+        'header': (0, 0, width, 64, True),
+        'sidebar': (0, 64, sidebar, height - 64, False),
+        'content': (sidebar + 16, 80, width - sidebar - column - 48, height - 96, False)
+    }
+
+    canvas.rectangle((0, 64, sidebar, height), fill=(242, 244, 247))
+
+    # Lines of "text" with words of random widths
+    left, top, content_width, content_height, _ = layout['content']
+
+    for line_top in range(top, top + content_height - 16, 22):
+
+        word_left = left
+
+        while word_left < left + content_width - 40:
+
+            word_width = rand.randint(12, 80)
+            shade = rand.randint(20, 90)
+
+            canvas.rectangle((word_left, line_top, word_left + word_width, line_top + 12), fill=(shade, shade, shade))
+            word_left += word_width + rand.randint(4, 10)
+
+    # Ads in the right column, typically excluded from comparisons
+    for index, ad_top in enumerate(range(96, min(height, viewport_height) - 250, 280)):
+
+        ad_left = width - column - 16
+        layout['ad{}'.format(index)] = (ad_left, ad_top, column, 250, False)
+
+        color = tuple(rand.randint(0, 255) for _ in range(3))
+        canvas.rectangle((ad_left, ad_top, ad_left + column, ad_top + 250), fill=color)
+
+    del canvas
+    return page, layout
+
+
+def encode_png(image):
+    """Base64 encode an image as PNG, like WebDriver screenshots
+
+    :param Image.Image image: Image
+    :return:
+    :rtype: str
+    """
+
+    stream = IOClass()
+    image.save(stream, 'PNG')
+
+    return base64.b64encode(stream.getvalue()).decode('ascii')
+
+
+class FakeWebDriver(object):  # pylint: disable=R0205
+    """Serves screenshots of a synthetic page through the WebDriver methods pytest-needle uses
+
+    Screenshots are encoded once per scroll position, so benchmarks measure pytest-needle rather than PNG encoding on
+    the "browser" side. The header is fixed and painted into every viewport, like a sticky header.
+    """
+
+    session_id = 'fake'
+
+    def __init__(self, page, layout, viewport_height=None, device_pixel_ratio=1):
+
+        self.device_pixel_ratio = device_pixel_ratio
+        self.viewport_height = viewport_height or page.size[1] // device_pixel_ratio
+        self.commands = 0
+        self.scroll = 0
+
+        self.page = None
+        self.layout = None
+        self._screenshots = {}
+
+        self.set_page(page, layout)
+
+    def set_page(self, page, layout):
+        """Show another page, ex. a modified one for failing comparisons
+
+        :param Image.Image page: Page image in device pixels
+        :param dict layout: Element rectangles by element id, in CSS pixels
+        :return:
+        """
+
+        self.page = page
+        self.layout = layout
+        self.scroll = 0
+        self._screenshots = {}
+
+    @property
+    def document_size(self):
+        """Returns page size in CSS pixels
+
+        :return:
+        :rtype: tuple
+        """
+
+        return self.page.size[0] // self.device_pixel_ratio, self.page.size[1] // self.device_pixel_ratio
+
+    def execute(self, command, params=None):  # pylint: disable=W0613
+        """Count a WebDriver command
+
+        :param str command: Command name
+        :param dict params: Command parameters
+        :return:
+        """
+
+        self.commands += 1
+        return {'value': None}
+
+    def set_window_position(self, x, y):  # pylint: disable=C0103,W0613
+        """Move the window, does nothing but count the command
+        """
+
+        self.execute('setWindowPosition')
+
+    def set_window_size(self, width, height):  # pylint: disable=W0613
+        """Resize the window, does nothing but count the command
+        """
+
+        self.execute('setWindowSize')
+
+    def maximize_window(self):
+        """Maximize the window, does nothing but count the command
+        """
+
+        self.execute('maximizeWindow')
+
+    def get_screenshot_as_base64(self):
+        """Returns base64 encoded PNG of the viewport at the current scroll position
+
+        :return:
+        :rtype: str
+        """
+
+        self.execute('screenshot')
+
+        if self.scroll not in self._screenshots:
+
+            ratio = self.device_pixel_ratio
+            top = self.scroll * ratio
+
+            viewport = self.page.crop((0, top, self.page.size[0], top + self.viewport_height * ratio))
+            header = self.page.crop((0, 0, self.page.size[0], 64 * ratio))
+            viewport.paste(header, (0, 0))
+
+            self._screenshots[self.scroll] = encode_png(viewport)
+
+        return self._screenshots[self.scroll]
+
+    def execute_script(self, script, *args):  # pylint: disable=W0613
+        """Answer pytest-needle's geometry script from the page layout
+
+        :param str script: Script, ignored
+        :return:
+        :rtype: dict
+        """
+
+        self.execute('executeScript')
+
+        targets = args[0] if args else []
+        scroll_to = args[1] if len(args) > 1 else None
+
+        origin = self.scroll
+        width, height = self.document_size
+
+        if scroll_to is not None:
+            self.scroll = max(0, min(int(scroll_to[1]), height - self.viewport_height))
+
+        rects = []
+
+        for target in targets:
+
+            rect = self.layout.get(target[1]) if isinstance(target, list) else None
+
+            if rect is None:
+                rects.append(None)
+                continue
+
+            left, top, rect_width, rect_height, fixed = rect
+            rects.append({'left': left, 'top': top + (self.scroll if fixed else 0),
+                          'width': rect_width, 'height': rect_height})
+
+        return {
+            'elements': [None] * len(rects),
+            'rects': rects,
+            'window': {'width': width, 'height': self.viewport_height},
+            'viewport': {'width': width, 'height': self.viewport_height},
+            'document': {'width': width, 'height': height},
+            'scroll': {'x': 0, 'y': self.scroll},
+            'origin': {'x': 0, 'y': origin},
+            'devicePixelRatio': self.device_pixel_ratio
+        }
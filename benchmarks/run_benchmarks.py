@@ -0,0 +1,440 @@
+"""run_benchmarks
+
+Benchmark pytest-needle's screenshot and comparison paths against an in-process fake WebDriver.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --compare results.json
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+import PIL
+from PIL import ImageDraw
+from fake_webdriver import FakeWebDriver, make_page
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytest_needle import __version__  # noqa: E402 pylint: disable=C0413
+from pytest_needle.driver import NeedleDriver  # noqa: E402 pylint: disable=C0413
+from pytest_needle.exceptions import ImageMismatchException  # noqa: E402 pylint: disable=C0413
+from pytest_needle.manifest import ManifestStore  # noqa: E402 pylint: disable=C0413
+from pytest_needle.writer import ImageFormat, create_dir  # noqa: E402 pylint: disable=C0413
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which  # pylint: disable=E0611,E0401
+
+
+SIZES = ('800x600', '1920x1080', '3840x2160')
+FULL_PAGE_HEIGHTS = (4000, 12000)
+FULL_PAGE_VIEWPORT = '1280x800'
+EXCLUDE = [('id', 'ad0'), ('id', 'ad1'), ('id', 'header')]
+
+# Image formats and encoder settings compared by the encoder benchmarks
+ENCODERS = (
+    ('png-1', ImageFormat('png', png_compress_level=1)),
+    ('png-6', ImageFormat('png', png_compress_level=6)),
+    ('png-9', ImageFormat('png', png_compress_level=9)),
+    ('webp-0', ImageFormat('webp', webp_method=0)),
+    ('webp-4', ImageFormat('webp', webp_method=4)),
+    ('webp-6', ImageFormat('webp', webp_method=6)),
+    ('raw', ImageFormat('raw'))
+)
+
+# Binaries file based engines need
+ENGINE_BINARIES = {'imagemagick': 'compare', 'perceptualdiff': 'perceptualdiff'}
+
+
+def parse_size(size):
+    """Parse a WIDTHxHEIGHT size
+
+    :param str size: Size, ex. 1920x1080
+    :return:
+    :rtype: tuple
+    """
+
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+def get_engines(names):
+    """Returns engines that can run on this machine
+
+    :param list names: Engine names
+    :return:
+    :rtype: list
+    """
+
+    engines = []
+
+    for name in names:
+
+        if name == 'numpy':
+            try:
+                import numpy  # noqa: F401 pylint: disable=C0415,W0611
+            except ImportError:
+                print('skipping numpy engine, numpy is not installed', file=sys.stderr)
+                continue
+
+        if name in ENGINE_BINARIES and not which(ENGINE_BINARIES[name]):
+            print('skipping {} engine, {} is not installed'.format(name, ENGINE_BINARIES[name]), file=sys.stderr)
+            continue
+
+        engines.append(name)
+
+    return engines
+
+
+def get_environment():
+    """Returns the versions and machine details results depend on
+
+    :return:
+    :rtype: dict
+    """
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        commit = None
+
+    try:
+        import numpy  # pylint: disable=C0415
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+
+    return {
+        'commit': commit,
+        'pytest_needle': __version__,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': numpy_version,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count() if hasattr(os, 'cpu_count') else None
+    }
+
+
+def measure(name, run, repeat, setup=None):
+    """Time a benchmark, after one warm up run
+
+    :param str name: Benchmark name
+    :param run: Called with the result of setup, timed
+    :param int repeat: Number of timed runs
+    :param setup: Called before every run, not timed (Optional)
+    :return:
+    :rtype: dict
+    """
+
+    times = []
+
+    for index in range(repeat + 1):
+
+        state = setup() if setup else None
+
+        start = default_timer()
+        run(state)
+        elapsed = default_timer() - start
+
+        # First run warms up caches and imports
+        if index:
+            times.append(elapsed)
+
+    times.sort()
+
+    result = {'name': name, 'repeat': repeat, 'min': times[0], 'median': times[len(times) // 2], 'max': times[-1]}
+    print('{name:<52} min {min:8.4f}s  median {median:8.4f}s'.format(**result))
+
+    return result
+
+
+class Benchmarks(object):  # pylint: disable=R0205
+    """Benchmarks of one screen size, sharing a synthetic page and baseline directory
+    """
+
+    def __init__(self, directory, size, page_height=None):
+
+        self.width, self.height = parse_size(size)
+        self.page_height = page_height or self.height
+        self.label = '{}x{}'.format(self.width, self.page_height)
+
+        self.directory = directory
+        self.baseline_dir = os.path.join(directory, 'baseline')
+        self.output_dir = os.path.join(directory, 'output')
+
+        self.page, self.layout = make_page(self.width, self.page_height, self.height)
+
+        # Same page with a changed paragraph, for failing comparisons
+        self.changed_page = self.page.copy()
+        left, top, width, _, _ = self.layout['content']
+        ImageDraw.Draw(self.changed_page).rectangle((left, top, left + width, top + 200), fill=(200, 30, 30))
+
+    def get_needle(self, page=None, **options):
+        """Returns NeedleDriver for a fake WebDriver showing page
+
+        :param page: Page image, defaults to the unchanged page
+        :return:
+        :rtype: NeedleDriver
+        """
+
+        driver = FakeWebDriver(page or self.page, self.layout, self.height)
+        options.setdefault('baseline_dir', self.baseline_dir)
+        options.setdefault('output_dir', self.output_dir)
+        options.setdefault('viewport_size', '{}x{}'.format(self.width, self.height))
+
+        return NeedleDriver(driver, **options)
+
+    def save_baseline(self, name, full_page=False):
+        """Save baseline of the unchanged page
+
+        :param str name: Baseline name
+        :param bool full_page: Save a full page screenshot
+        :return:
+        """
+
+        self.get_needle(save_baseline=True).assert_screenshot(name, exclude=EXCLUDE, full_page=full_page)
+
+    def run_screenshots(self, repeat):
+        """Benchmark capturing, decoding, masking and cropping
+
+        :param int repeat: Number of timed runs
+        :return:
+        :rtype: list
+        """
+
+        needle = self.get_needle()
+
+        return [
+            measure('get_screenshot[{}]'.format(self.label), lambda _: needle.get_screenshot(), repeat),
+            measure('mask[{}]'.format(self.label),
+                    lambda _: needle.get_screenshot_as_image(exclude=EXCLUDE), repeat),
+            measure('element_crop[{}]'.format(self.label),
+                    lambda _: needle.get_screenshot_as_image(('id', 'content')), repeat)
+        ]
+
+    def run_assertions(self, engines, repeat):
+        """Benchmark passing and failing assertions with each engine
+
+        :param list engines: Engine names
+        :param int repeat: Number of timed runs
+        :return:
+        :rtype: list
+        """
+
+        self.save_baseline('page')
+
+        manifests = ManifestStore()
+        self.get_needle(manifests=manifests).assert_screenshot('page', exclude=EXCLUDE)
+
+        needle = self.get_needle(manifests=manifests)
+        results = [measure('assert_pass_manifest[{}]'.format(self.label),
+                           lambda _: needle.assert_screenshot('page', exclude=EXCLUDE), repeat)]
+
+        for engine in engines:
+
+            passing = self.get_needle(needle_engine=engine)
+            failing = self.get_needle(self.changed_page, needle_engine=engine)
+
+            def fail(_, needle=failing):
+                """Failing assertion
+                """
+
+                try:
+                    needle.assert_screenshot('page', exclude=EXCLUDE)
+                except ImageMismatchException:
+                    return
+
+                raise AssertionError('changed page matched the baseline')
+
+            results.append(measure('assert_pass[{},{}]'.format(engine, self.label),
+                                   lambda _, needle=passing: needle.assert_screenshot('page', exclude=EXCLUDE), repeat))
+            results.append(measure('assert_fail[{},{}]'.format(engine, self.label), fail, repeat))
+
+        return results
+
+    def run_full_page(self, engines, repeat):
+        """Benchmark full page screenshots and assertions
+
+        :param list engines: Engine names
+        :param int repeat: Number of timed runs
+        :return:
+        :rtype: list
+        """
+
+        self.save_baseline('full_page', full_page=True)
+
+        needle = self.get_needle()
+        results = [measure('full_page_screenshot[{}]'.format(self.label),
+                           lambda _: needle.get_screenshot_as_image(exclude=EXCLUDE, full_page=True), repeat)]
+
+        for engine in engines:
+
+            passing = self.get_needle(needle_engine=engine)
+
+            results.append(measure(
+                'assert_full_page_pass[{},{}]'.format(engine, self.label),
+                lambda _, needle=passing: needle.assert_screenshot('full_page', exclude=EXCLUDE, full_page=True),
+                repeat))
+
+        return results
+
+    def run_encoders(self, repeat):
+        """Benchmark writing the page in each image format, recording the file size
+
+        :param int repeat: Number of timed runs
+        :return:
+        :rtype: list
+        """
+
+        results = []
+        create_dir(self.output_dir)
+
+        for name, image_format in ENCODERS:
+
+            file_path = os.path.join(self.output_dir, 'encode' + image_format.extension)
+
+            def encode(_, image_format=image_format, file_path=file_path):
+                """Write the page
+                """
+
+                image_format.save(self.page, file_path)
+
+            result = measure('encode[{},{}]'.format(name, self.label), encode, repeat)
+            result['bytes'] = os.path.getsize(file_path)
+
+            results.append(result)
+
+        return results
+
+
+def print_encoders(results):
+    """Print a table of encode time against file size
+
+    :param list results: Results of this run
+    :return:
+    """
+
+    results = [result for result in results if 'bytes' in result]
+
+    if not results:
+        return
+
+    print('\n{:<52} {:>10} {:>12}'.format('encoder', 'min', 'size'))
+
+    for result in results:
+        print('{:<52} {:9.4f}s {:9.1f} KB'.format(result['name'], result['min'], result['bytes'] / 1024.0))
+
+
+def compare_results(results, previous, max_regression):
+    """Print change against previous results
+
+    :param list results: Results of this run
+    :param dict previous: Results file of an earlier run
+    :param float max_regression: Percentage a benchmark may get slower
+    :return: Names of benchmarks that got slower than allowed
+    :rtype: list
+    """
+
+    before = dict((result['name'], result) for result in previous['results'])
+    regressions = []
+
+    print('\nchange against {} (min times):'.format(previous['environment'].get('commit') or 'previous results'))
+
+    for result in results:
+
+        if result['name'] not in before:
+            continue
+
+        change = (result['min'] / before[result['name']]['min'] - 1) * 100
+        flag = ''
+
+        if change > max_regression:
+            regressions.append(result['name'])
+            flag = '  REGRESSION'
+
+        print('{:<52} {:8.4f}s -> {:8.4f}s {:+7.1f}%{}'.format(
+            result['name'], before[result['name']]['min'], result['min'], change, flag))
+
+    return regressions
+
+
+def main(argv=None):
+    """Run benchmarks
+
+    :param list argv: Command line arguments
+    :return: Exit code
+    :rtype: int
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sizes', default=','.join(SIZES), help='viewport sizes, comma separated')
+    parser.add_argument('--full-page-heights', default=','.join(str(height) for height in FULL_PAGE_HEIGHTS),
+                        help='page heights for full page benchmarks at {}, comma separated, '
+                             'empty to skip them'.format(FULL_PAGE_VIEWPORT))
+    parser.add_argument('--engines', default='pil,numpy', help='engines to compare with, comma separated')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='compare with results of an earlier run')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help='percentage a benchmark may get slower than in --compare before failing')
+
+    args = parser.parse_args(argv)
+
+    engines = get_engines([engine for engine in args.engines.split(',') if engine])
+    directory = tempfile.mkdtemp(prefix='needle-benchmarks-')
+    results = []
+
+    try:
+
+        for size in [size for size in args.sizes.split(',') if size]:
+
+            benchmarks = Benchmarks(os.path.join(directory, size), size)
+            results.extend(benchmarks.run_screenshots(args.repeat))
+            results.extend(benchmarks.run_assertions(engines, args.repeat))
+
+        for height in [int(height) for height in args.full_page_heights.split(',') if height]:
+
+            benchmarks = Benchmarks(os.path.join(directory, 'full_page_{}'.format(height)), FULL_PAGE_VIEWPORT, height)
+            results.extend(benchmarks.run_full_page(engines, args.repeat))
+            results.extend(benchmarks.run_encoders(args.repeat))
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print_encoders(results)
+
+    report = {'environment': get_environment(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+
+        with open(args.compare) as previous:
+            regressions = compare_results(results, json.load(previous), args.max_regression)
+
+        if regressions:
+            print('\n{} benchmarks regressed by more than {}%'.format(len(regressions), args.max_regression))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
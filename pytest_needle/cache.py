@@ -0,0 +1,333 @@
+"""pytest_needle.cache
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import struct
+import threading
+from PIL import Image
+from pytest_needle.writer import replace_file
+
+
+#: Number of image rows hashed or written at a time
+STRIP_ROWS = 256
+
+
+def get_image_size(image):
+    """Returns the number of bytes used by an image's pixel data
+
+    :param Image.Image image: Image
+    :return:
+    :rtype: int
+    """
+
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
+def get_rgb_image(image):
+    """Returns image in RGB mode, images that already are RGB are decoded in place rather than converted into a copy
+
+    :param Image.Image image: Image, ex. as returned by Image.open
+    :return:
+    :rtype: Image.Image
+    """
+
+    if image.mode == 'RGB':
+        image.load()
+        return image
+
+    return image.convert('RGB')
+
+
+def iter_image_bytes(image, rows=STRIP_ROWS):
+    """Yields an image's pixel data a strip of rows at a time, together the same bytes as image.tobytes()
+
+    :param Image.Image image: Image
+    :param int rows: Number of rows per strip
+    :return:
+    """
+
+    width, height = image.size
+
+    for top in range(0, height, rows):
+        yield image.crop((0, top, width, min(top + rows, height))).tobytes()
+
+
+def get_image_hash(image):
+    """Returns a hash of an image's decoded pixel data
+
+    Pixel data is hashed a strip at a time, so no copy of the whole image is made.
+
+    :param Image.Image image: Image
+    :return:
+    :rtype: str
+    """
+
+    digest = hashlib.sha1('{}:{}x{}:'.format(image.mode, *image.size).encode('ascii'))
+
+    for data in iter_image_bytes(image):
+        digest.update(data)
+
+    return digest.hexdigest()
+
+
+def get_file_signature(file_path):
+    """Returns a signature that changes when a file is modified
+
+    :param str file_path: File path
+    :return:
+    :rtype: tuple
+    """
+
+    stat = os.stat(file_path)
+    return stat.st_mtime, stat.st_size
+
+
+class SharedBaselineStore(object):  # pylint: disable=R0205
+    """Decode cache of baselines shared by several processes through a directory, ex. pytest-xdist workers
+
+    The first process to decode a baseline writes its raw RGB pixels, other processes read them instead of decoding the
+    baseline again, each into its own copy. Files are keyed by baseline path, modification time and size, and written
+    atomically. Nothing is evicted, baselines are no longer stored once the directory holds max_bytes of pixels.
+    """
+
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, directory, max_bytes=0):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+
+    def _get_path(self, file_path, signature):
+        """Returns path of the raw pixel file of a baseline
+
+        :param str file_path: Baseline image path
+        :param tuple signature: Baseline file signature
+        :return:
+        :rtype: str
+        """
+
+        key = '{}:{!r}:{}'.format(file_path, *signature).encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.rgb')
+
+    def get(self, file_path, signature):
+        """Returns decoded baseline image, None if no process has stored it yet
+
+        :param str file_path: Baseline image path
+        :param tuple signature: Baseline file signature
+        :return:
+        :rtype: Image.Image
+        """
+
+        try:
+            with open(self._get_path(file_path, signature), 'rb') as raw:
+                size = self.HEADER.unpack(raw.read(self.HEADER.size))
+                image = Image.frombytes('RGB', size, raw.read())
+
+        except (EnvironmentError, ValueError, struct.error):
+            return None
+
+        self.hits += 1
+        return image
+
+    def _get_stored_bytes(self):
+        """Returns the number of bytes stored in the directory
+
+        :return:
+        :rtype: int
+        """
+
+        stored = 0
+
+        for file_name in os.listdir(self.directory):
+
+            try:
+                stored += os.path.getsize(os.path.join(self.directory, file_name))
+
+            except EnvironmentError:
+                pass
+
+        return stored
+
+    def put(self, file_path, signature, image):
+        """Store decoded baseline image for other processes
+
+        :param str file_path: Baseline image path
+        :param tuple signature: Baseline file signature
+        :param Image.Image image: Decoded RGB image
+        :return:
+        """
+
+        path = self._get_path(file_path, signature)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        try:
+
+            if self._get_stored_bytes() + self.HEADER.size + get_image_size(image) > self.max_bytes:
+                return
+
+            with open(temp_path, 'wb') as raw:
+                raw.write(self.HEADER.pack(*image.size))
+
+                for data in iter_image_bytes(image):
+                    raw.write(data)
+
+            replace_file(temp_path, path)
+
+        except EnvironmentError:
+            pass
+
+
+class BaselineCache(object):  # pylint: disable=R0205
+    """Least recently used cache of decoded baseline images, bounded by memory
+
+    Entries are keyed by file path and invalidated when the file's modification time or size change. Cached images are
+    shared, callers must not modify them.
+    """
+
+    def __init__(self, max_bytes=0, shared=None):
+
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def _evict(self, max_bytes):
+        """Evict least recently used entries until the cache fits into max_bytes
+
+        :param int max_bytes: Maximum number of bytes
+        :return:
+        """
+
+        while self._entries and self.current_bytes > max_bytes:
+
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def get(self, file_path):
+        """Returns decoded baseline image, from cache if possible
+
+        :param str file_path: Baseline image path
+        :return:
+        :rtype: Image.Image
+        """
+
+        file_path = os.path.realpath(file_path)
+        signature = get_file_signature(file_path)
+
+        return self._get(file_path, signature, lambda: self._load(file_path, signature))
+
+    def get_content(self, digest, load):
+        """Returns decoded image of a content addressed baseline, from cache if possible
+
+        :param str digest: Pixel hash of the baseline
+        :param load: Called without arguments to decode the baseline on a cache miss
+        :return:
+        :rtype: Image.Image
+        """
+
+        return self._get(digest, digest, load)
+
+    def _load(self, file_path, signature):
+        """Decode baseline image file, or load it from the shared store
+
+        :param str file_path: Baseline image path
+        :param tuple signature: Baseline file signature
+        :return:
+        :rtype: Image.Image
+        """
+
+        image = self.shared.get(file_path, signature) if self.shared is not None else None
+
+        if image is None:
+
+            image = get_rgb_image(Image.open(file_path))
+
+            if self.shared is not None:
+                self.shared.put(file_path, signature, image)
+
+        return image
+
+    def _get(self, key, signature, load):
+        """Returns cached image, loading and caching it if missing or its signature changed
+
+        :param str key: Cache key
+        :param signature: Signature the cached entry must match
+        :param load: Called without arguments to load the image
+        :return:
+        :rtype: Image.Image
+        """
+
+        with self._lock:
+
+            entry = self._entries.pop(key, None)
+
+            if entry and entry[0] == signature:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+
+            if entry:
+                self.current_bytes -= entry[2]
+
+            self.misses += 1
+
+        image = load()
+        size = get_image_size(image)
+
+        if size <= self.max_bytes:
+
+            with self._lock:
+
+                if key in self._entries:
+                    self.current_bytes -= self._entries.pop(key)[2]
+
+                self._evict(self.max_bytes - size)
+                self._entries[key] = (signature, image, size)
+                self.current_bytes += size
+
+        return image
+
+    def clear(self):
+        """Remove all entries
+
+        :return:
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    @property
+    def stats(self):
+        """Returns cache counters
+
+        :return:
+        :rtype: dict
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'shared_hits': self.shared.hits if self.shared is not None else 0,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes
+        }
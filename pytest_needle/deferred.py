@@ -0,0 +1,185 @@
+"""pytest_needle.deferred
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+from PIL import Image
+from pytest_needle.cache import get_rgb_image
+from pytest_needle.engines import ENGINES, MISSING_ENGINE_MESSAGE, registry
+from pytest_needle.exceptions import ImageMismatchException, MissingBaselineException, MissingEngineException
+from pytest_needle.store import BaselineStore
+from pytest_needle.writer import get_variant_path, save_image
+
+
+def compare_images(engine_name, tolerance, fresh_image, fresh_image_file, baseline_image,  # pylint: disable=R0913
+                   threshold, keep_on_success=False, write_fresh=True, store_path=None, store_name=None,
+                   image_format=None):
+    """Compare a fresh image against its baseline, runs in a worker process
+
+    The fresh image, and a diff image if the engine produces one, are written when the comparison fails. Baselines read
+    from a baseline store are extracted next to the fresh image as ``.baseline.png`` when a file is needed.
+
+    :param str engine_name: Engine name or dotted path to the engine class
+    :param int tolerance: Per channel tolerance, for engines that support it
+    :param Image.Image fresh_image: Fresh image
+    :param str fresh_image_file: Fresh image path
+    :param str baseline_image: Baseline image path
+    :param threshold: Distance threshold
+    :param bool keep_on_success: Write fresh image even if the comparison passes
+    :param bool write_fresh: False, if the fresh image is already on disk at fresh_image_file
+    :param str store_path: Path of the baseline store to read the baseline from (Optional)
+    :param str store_name: Name of the baseline in the baseline store
+    :param pytest_needle.writer.ImageFormat image_format: Format fresh and diff images are written in, by default
+                                                          that of the fresh image's file extension
+    :return: Result with status passed, failed, missing or engine (the engine is not installed) and a message
+    :rtype: dict
+    """
+
+    store = BaselineStore(store_path) if store_path else None
+
+    try:
+        return _compare_images(registry.get(engine_name), tolerance, fresh_image, fresh_image_file, baseline_image,
+                               threshold, keep_on_success, write_fresh, store, store_name, image_format)
+
+    except ValueError:
+
+        # Engines that run external programs raise ValueError when the program is missing
+        if registry.get_path(engine_name) != ENGINES['imagemagick']:
+            raise
+
+        return {'status': 'engine', 'message': MISSING_ENGINE_MESSAGE.format('imagemagick'),
+                'baseline_image': baseline_image, 'output_image': fresh_image_file}
+
+    finally:
+
+        if store is not None:
+            store.close()
+
+
+def _compare_images(engine, tolerance, fresh_image, fresh_image_file, baseline_image,  # pylint: disable=R0912,R0913
+                    threshold, keep_on_success, write_fresh, store, store_name, image_format):
+    """Compare a fresh image against its baseline, see :func:`compare_images`
+
+    :return:
+    :rtype: dict
+    """
+
+    if hasattr(engine, 'tolerance'):
+        engine.tolerance = tolerance
+
+    result = {'status': 'passed', 'message': '', 'baseline_image': baseline_image, 'output_image': fresh_image_file}
+    baseline_file = os.path.splitext(fresh_image_file)[0] + '.baseline.png' if store is not None else baseline_image
+
+    try:
+        baseline = store.open(store_name) if store is not None else get_rgb_image(Image.open(baseline_image))
+
+    except EnvironmentError:
+
+        if write_fresh:
+            save_image(fresh_image, fresh_image_file, image_format)
+
+        result.update(status='missing', message="Missing baseline '{}'. Please run again with "
+                                                "--needle-save-baseline".format(baseline_image))
+        return result
+
+    try:
+
+        if hasattr(engine, 'assertSameImages'):
+            engine.assertSameImages(fresh_image, baseline, threshold)
+
+        else:
+
+            if write_fresh:
+                save_image(fresh_image, fresh_image_file, image_format)
+
+            if store is not None:
+                store.extract(store_name, baseline_file)
+
+            engine.assertSameFiles(fresh_image_file, baseline_file, threshold)
+
+    except AssertionError as err:
+
+        if hasattr(engine, 'assertSameImages'):
+
+            if write_fresh:
+                save_image(fresh_image, fresh_image_file, image_format)
+
+            if store is not None:
+                store.extract(store_name, baseline_file)
+
+            if hasattr(engine, 'get_diff_image') and fresh_image.size == baseline.size:
+                save_image(engine.get_diff_image(fresh_image, baseline), get_variant_path(fresh_image_file, 'diff'),
+                           image_format)
+
+        result.update(status='failed', message=err.args[0] if err.args else '', baseline_image=baseline_file)
+        return result
+
+    if store is not None and not hasattr(engine, 'assertSameImages'):
+        os.remove(baseline_file)
+
+    if not write_fresh:
+        return result
+
+    if keep_on_success and hasattr(engine, 'assertSameImages'):
+        save_image(fresh_image, fresh_image_file, image_format)
+
+    elif not keep_on_success and not hasattr(engine, 'assertSameImages'):
+        os.remove(fresh_image_file)
+
+    return result
+
+
+def get_exception(result):
+    """Returns the exception for a failed comparison result, None if it passed
+
+    :param dict result: Result of :func:`compare_images`
+    :return:
+    """
+
+    if result['status'] == 'missing':
+        return MissingBaselineException(result['message'])
+
+    if result['status'] == 'engine':
+        return MissingEngineException(result['message'])
+
+    if result['status'] == 'failed':
+        return ImageMismatchException(result['message'], result['baseline_image'], result['output_image'])
+
+    return None
+
+
+class DeferredComparisons(object):  # pylint: disable=R0205
+    """Compares images in a pool of worker processes, started on first use
+    """
+
+    def __init__(self, processes=None):
+
+        self.processes = processes or None
+        self.submitted = 0
+        self._executor = None
+
+    def submit(self, *args, **kwargs):
+        """Schedule a comparison, takes the arguments of :func:`compare_images`
+
+        :return:
+        :rtype: concurrent.futures.Future
+        """
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.processes)
+
+        self.submitted += 1
+        return self._executor.submit(compare_images, *args, **kwargs)
+
+    def shutdown(self):
+        """Wait for scheduled comparisons and stop the worker processes
+
+        :return:
+        """
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -4,18 +4,32 @@
 
 """
 
-import base64
-from errno import EEXIST
+import binascii
+from contextlib import contextmanager
+from errno import EEXIST, ENOENT
+import itertools
 import math
 import os
 import re
 import sys
+from timeit import default_timer
 import pytest
-from needle.cases import import_from_string
 from needle.engines.pil_engine import ImageDiff
-from PIL import Image, ImageDraw, ImageColor
+from PIL import Image, ImageChops, ImageColor, ImageDraw
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.remote.webdriver import WebElement
-from pytest_needle.exceptions import ImageMismatchException, MissingBaselineException, MissingEngineException
+from pytest_needle.cache import get_image_hash, get_image_size, get_rgb_image
+from pytest_needle.deferred import DeferredComparisons, get_exception
+from pytest_needle.engines import ENGINES, MISSING_ENGINE_MESSAGE, registry
+from pytest_needle.exceptions import ImageMismatchException, MissingBaselineException, MissingEngineException, \
+    MultipleFailuresException, NeedleException
+from pytest_needle.geometry import resolve_geometry
+from pytest_needle.masks import compare_regions, get_image_box, get_mask
+from pytest_needle.pyramid import PYRAMID_FACTORS, PyramidCache, compare_pyramid
+from pytest_needle.store import get_name
+from pytest_needle.tiles import compare_tiles, get_tile_hashes
+from pytest_needle.writer import DEFAULT_IMAGE_FORMAT, DEFAULT_PNG_COMPRESS_LEVEL, DEFAULT_WEBP_METHOD, IMAGE_FORMATS, \
+    ImageFormat, get_variant_path, save_image
 
 
 if sys.version_info >= (3, 0):
@@ -34,18 +48,27 @@ else:
 
 DEFAULT_BASELINE_DIR = os.path.realpath(os.path.join(os.getcwd(), 'screenshots', 'baseline'))
 DEFAULT_OUTPUT_DIR = os.path.realpath(os.path.join(os.getcwd(), 'screenshots'))
-DEFAULT_ENGINE = 'needle.engines.pil_engine.Engine'
+DEFAULT_ENGINE = 'pytest_needle.engines.pil_engine.Engine'
 DEFAULT_VIEWPORT_SIZE = '1024x768'
+DEFAULT_CAPTURE_STRATEGY = 'crop'
+DEFAULT_STABLE_TIMEOUT = 5.0
+
+VIEWPORT_SIZE_PATTERN = re.compile(r'(?P<width>\d+)\s?[xX]\s?(?P<height>\d+)')
 
 
 class NeedleDriver(object):  # pylint: disable=R0205
     """NeedleDriver instance
     """
 
-    ENGINES = {
-        'pil': DEFAULT_ENGINE,
-        'imagemagick': 'needle.engines.imagemagick_engine.Engine',
-        'perceptualdiff': 'needle.engines.perceptualdiff_engine.Engine'
+    ENGINES = ENGINES
+
+    # Region capture commands tried, in order, for each capture strategy. Crop always falls back to capturing
+    # the viewport and cropping it to the element
+    CAPTURE_STRATEGIES = {
+        'crop': (),
+        'clip': ('clip',),
+        'element': ('element',),
+        'auto': ('clip', 'element')
     }
 
     def __init__(self, driver, **kwargs):
@@ -53,8 +76,18 @@ class NeedleDriver(object):  # pylint: disable=R0205
         self.options = kwargs
         self.driver = driver
 
+        # Statistics of every assertion made, in order
+        self.assertion_stats = []
+        self.last_capture_strategy = None
+
+        # Statistics of the assertion in progress
+        self._current_stats = None
+
+        # Futures of deferred comparisons not collected yet
+        self._deferred = []
+
         # Set viewport position, size
-        self.driver.set_window_position(0, 0)
+        self._set_window('position', (0, 0), lambda: self.driver.set_window_position(0, 0))
         self.set_viewport()
 
     @staticmethod
@@ -79,99 +112,97 @@ class NeedleDriver(object):  # pylint: disable=R0205
 
             raise err
 
-    def _find_element(self, element_or_selector=None):
-        """Returns an element
-
-        :param element_or_selector: WebElement or tuple containing selector ex. ('id', 'mainPage')
-        :return:
-        """
+    @staticmethod
+    def _get_ratio(image_size, window_size):
 
-        if isinstance(element_or_selector, tuple):  # pylint: disable=R1705
+        return max((
+            math.ceil(image_size[0] / float(window_size[0])),
+            math.ceil(image_size[1] / float(window_size[1]))
+        ))
 
-            elements = self.driver.find_elements(*element_or_selector)
-            return elements[0] if elements else None
+    @property
+    def baseline_dir(self):
+        """Return baseline image path
 
-        elif isinstance(element_or_selector, WebElement):
-            return element_or_selector
+        :return:
+        :rtype: str
+        """
 
-        raise ValueError("element_or_selector must be a WebElement or tuple selector")
+        return self.options.get('baseline_dir', DEFAULT_BASELINE_DIR)
 
-    @staticmethod
-    def _get_element_dimensions(element):
-        """Returns an element's position and size
+    @baseline_dir.setter
+    def baseline_dir(self, value):
+        """Set baseline image directory
 
-        :param WebElement element: Element to get dimensions for
+        :param str value: File path
         :return:
         """
 
-        if isinstance(element, WebElement):
+        assert isinstance(value, basestring)
+        self.options['baseline_dir'] = value
 
-            # Get dimensions of element
-            location = element.location
-            size = element.size
+    @property
+    def baseline_cache(self):
+        """Return decoded baseline cache shared by the session
 
-            return {
-                'top': int(location['y']),
-                'left': int(location['x']),
-                'width': int(size['width']),
-                'height': int(size['height'])
-            }
+        :return:
+        :rtype: pytest_needle.cache.BaselineCache
+        """
 
-        raise ValueError("element must be a WebElement")
+        return self.options.get('baseline_cache')
 
-    def _get_element_rect(self, element):
-        """Returns the two points that define the rectangle
+    @property
+    def baseline_format(self):
+        """Return format baselines are written in (png, webp or raw)
 
-        :param WebElement element: Element to get points for
         :return:
+        :rtype: str
         """
 
-        dimensions = self._get_element_dimensions(element)
+        return self.options.get('baseline_format', DEFAULT_IMAGE_FORMAT)
 
-        if dimensions:
+    @baseline_format.setter
+    def baseline_format(self, value):
+        """Set format baselines are written in
 
-            return (
-                dimensions['left'],
-                dimensions['top'],
-                (dimensions['left'] + dimensions['width']),
-                (dimensions['top'] + dimensions['height'])
-            )
-
-        return ()
+        :param str value: Image format (png, webp or raw)
+        :return:
+        """
 
-    @staticmethod
-    def _get_ratio(image_size, window_size):
+        assert value in IMAGE_FORMATS
+        self.options['baseline_format'] = value
 
-        return max((
-            math.ceil(image_size[0] / float(window_size[0])),
-            math.ceil(image_size[1] / float(window_size[1]))
-        ))
+    @property
+    def baseline_store(self):
+        """Return baseline store of the baseline directory, None if baselines are stored as PNG files
 
-    def _get_window_size(self):
+        :return:
+        :rtype: pytest_needle.store.BaselineStore
+        """
 
-        window_size = self.driver.get_window_size()
-        return window_size['width'], window_size['height']
+        stores = self.options.get('baseline_stores')
+        return stores.get(self.baseline_dir) if stores is not None else None
 
     @property
-    def baseline_dir(self):
-        """Return baseline image path
+    def capture_strategy(self):
+        """Return how element screenshots are captured (crop, clip, element or auto)
 
         :return:
         :rtype: str
         """
 
-        return self.options.get('baseline_dir', DEFAULT_BASELINE_DIR)
+        return self.options.get('capture_strategy', DEFAULT_CAPTURE_STRATEGY)
 
-    @baseline_dir.setter
-    def baseline_dir(self, value):
-        """Set baseline image directory
+    @capture_strategy.setter
+    def capture_strategy(self, value):
+        """Set how element screenshots are captured
 
-        :param str value: File path
+        :param str value: Capture strategy (crop, clip, element or auto)
         :return:
         """
 
-        assert isinstance(value, basestring)
-        self.options['baseline_dir'] = value
+        assert value.lower() in self.CAPTURE_STRATEGIES
+        self.options['capture_strategy'] = value.lower()
 
     @property
     def cleanup_on_success(self):
@@ -193,14 +224,52 @@ class NeedleDriver(object):  # pylint: disable=R0205
 
         self.options['cleanup_on_success'] = bool(value)
 
+    @property
+    def compare_pool(self):
+        """Return process pool deferred comparisons are made in, shared by the session
+
+        :return:
+        :rtype: pytest_needle.deferred.DeferredComparisons
+        """
+
+        if self.options.get('compare_pool') is None:
+            self.options['compare_pool'] = DeferredComparisons()
+
+        return self.options['compare_pool']
+
+    @property
+    def deferred_compare(self):
+        """Returns True, if screenshots are compared in worker processes by default
+
+        :return:
+        :rtype: bool
+        """
+
+        return self.options.get('deferred_compare', False)
+
+    @deferred_compare.setter
+    def deferred_compare(self, value):
+        """Set deferred compare flag
+
+        :param bool value: Deferred compare flag
+        :return:
+        """
+
+        self.options['deferred_compare'] = bool(value)
+
     @property
     def engine(self):
-        """Return image processing engine
+        """Return image processing engine, each engine is instantiated once per engine registry
 
         :return:
         """
 
-        return import_from_string(self.engine_class)()
+        engine = self.engine_registry.get(self.options.get('needle_engine', 'pil'))
+
+        if hasattr(engine, 'tolerance'):
+            engine.tolerance = self.tolerance
+
+        return engine
 
     @property
     def engine_class(self):
@@ -210,226 +279,1646 @@ class NeedleDriver(object):  # pylint: disable=R0205
         :rtype: str
         """
 
-        return self.ENGINES.get(self.options.get('needle_engine', 'pil').lower(), DEFAULT_ENGINE)
+        return self.engine_registry.get_path(self.options.get('needle_engine', 'pil'))
 
     @engine_class.setter
     def engine_class(self, value):
         """Set image processing engine name
 
-        :param str value: Image processing engine name (pil, imagemagick, perceptualdiff)
+        :param str value: Image processing engine name (pil, imagemagick, perceptualdiff, numpy or a registered engine)
+        :return:
+        """
+
+        self.engine_registry.get_class(value)
+        self.options['needle_engine'] = value.lower() if value in self.engine_registry else value
+
+    @property
+    def engine_registry(self):
+        """Return engine registry shared by the session
+
         :return:
+        :rtype: pytest_needle.engines.EngineRegistry
         """
 
-        assert value.lower() in self.ENGINES
-        self.options['needle_engine'] = value.lower()
+        return self.options.get('engine_registry') or registry
 
-    def get_screenshot(self, element=None):
+    def get_screenshot(self, element=None, geometry=None):
         """Returns screenshot image
 
-        :param WebElement element: Crop image to element (Optional)
+        :param element: Crop image to WebElement or tuple containing selector ex. ('id', 'mainPage') (Optional)
+        :param Geometry geometry: Geometry already resolved for element, as first target (Optional)
         :return:
         """
 
-        stream = IOClass(base64.b64decode(self.driver.get_screenshot_as_base64().encode('ascii')))
-        image = Image.open(stream).convert('RGB')
+        self.last_capture_strategy = 'viewport'
 
-        if isinstance(element, WebElement):
+        if isinstance(element, (WebElement, tuple)):
 
-            window_size = self._get_window_size()
+            geometry = geometry or self._resolve_geometry([element])
+            rect = geometry.rects[0]
 
-            image_size = image.size
+            image = self._capture_element(geometry.elements[0], rect) if rect else None
 
-            # Get dimensions of element
-            dimensions = self._get_element_dimensions(element)
+            if image is not None:
+                return image
 
-            if not image_size == (dimensions['width'], dimensions['height']):
+            image = self._decode_screenshot(self._capture_viewport())
 
-                ratio = self._get_ratio(image_size, window_size)
+            if rect and not image.size == (rect[2] - rect[0], rect[3] - rect[1]):
 
-                return image.crop([point * ratio for point in self._get_element_rect(element)])
+                ratio = self._get_ratio(image.size, geometry.window_size)
 
-        return image
+                self.last_capture_strategy = 'crop'
+                return image.crop([point * ratio for point in rect])
+
+            return image
 
-    def get_screenshot_as_image(self, element=None, exclude=None):
+        return self._decode_screenshot(self._capture_viewport())
+
+    def _capture_element(self, element, rect):
+        """Capture only the element's region, using the first capture strategy the driver supports
+
+        :param WebElement element: Element to capture
+        :param tuple rect: Element's page rectangle
+        :return: Image, None if no region capture strategy is enabled or supported
         """
 
-        :param WebElement element: Crop image to element (Optional)
-        :param list exclude: Elements to exclude
+        for strategy in self.CAPTURE_STRATEGIES.get(self.capture_strategy, ()):
+
+            try:
+
+                if strategy == 'clip' and hasattr(self.driver, 'execute_cdp_cmd'):
+
+                    with self._timed('capture'):
+                        data = self.driver.execute_cdp_cmd('Page.captureScreenshot', {
+                            'format': 'png',
+                            'clip': {'x': rect[0], 'y': rect[1], 'width': rect[2] - rect[0],
+                                     'height': rect[3] - rect[1], 'scale': 1}
+                        })['data']
+
+                elif strategy == 'element' and isinstance(element, WebElement):
+
+                    with self._timed('capture'):
+                        data = element.screenshot_as_base64
+
+                else:
+                    continue
+
+            except WebDriverException:
+                continue
+
+            self.last_capture_strategy = strategy
+            return self._decode_screenshot(data)
+
+        return None
+
+    def _capture_viewport(self):
+        """Returns base64 encoded screenshot of the viewport
+
         :return:
+        :rtype: str
         """
 
-        image = self.get_screenshot(element)
+        with self._timed('capture'):
+            return self.driver.get_screenshot_as_base64()
 
-        # Mask elements in exclude if element is not included
-        if isinstance(exclude, (list, tuple)) and exclude and not element:
+    def _decode_screenshot(self, data):
+        """Decode base64 encoded screenshot
 
-            # Gather all elements to exclude
-            elements = [self._find_element(element) for element in exclude]
-            elements = [element for element in elements if element]
+        :param str data: Base64 encoded PNG
+        :return:
+        :rtype: Image.Image
+        """
 
-            canvas = ImageDraw.Draw(image)
+        with self._timed('decode'):
 
-            window_size = self._get_window_size()
+            # a2b_base64 reads the payload string as it is, without an encoded copy of it
+            png = binascii.a2b_base64(data)
 
-            image_size = image.size
+            source = Image.open(IOClass(png))
+            image = get_rgb_image(source)
 
-            ratio = self._get_ratio(image_size, window_size)
+            if self._current_stats is not None:
+                self._current_stats['screenshot_bytes'] = self._current_stats.get('screenshot_bytes', 0) + len(png)
 
-            for ele in elements:
-                canvas.rectangle([point * ratio for point in self._get_element_rect(ele)],
-                                 fill=ImageColor.getrgb('black'))
+            # Payload, PNG and decoded pixels are all held at once, along with a converted copy if it was not RGB
+            self._record_peak_memory(len(data) + len(png) + get_image_size(source) +
+                                     (get_image_size(image) if image is not source else 0))
 
-            del canvas
+            return image
 
-        return image
+    def _record_peak_memory(self, size):
+        """Record an estimate of the memory held at once while capturing, the largest of an assertion is kept
 
-    def assert_screenshot(self, file_path, element_or_selector=None, threshold=0, exclude=None):
-        """Fail if new fresh image is too dissimilar from the baseline image
+        :param int size: Bytes held
+        :return:
+        """
 
-        .. note:: From needle
-            https://github.com/python-needle/needle/blob/master/needle/cases.py#L161
+        if self._current_stats is not None:
+            self._current_stats['peak_memory'] = max(self._current_stats.get('peak_memory', 0), size)
 
-        :param str file_path: File name for baseline image
-        :param element_or_selector: WebElement or tuple containing selector ex. ('id', 'mainPage')
-        :param threshold: Distance threshold
-        :param list exclude: Elements or element selectors for areas to exclude
+    def _resolve_geometry(self, targets=None, scroll_to=None):
+        """Resolve page geometry, see :func:`pytest_needle.geometry.resolve_geometry`
+
+        :param list targets: Elements or element selectors
+        :param tuple scroll_to: Page position to scroll to first
         :return:
+        :rtype: pytest_needle.geometry.Geometry
         """
 
-        element = self._find_element(element_or_selector) if element_or_selector else None
+        with self._timed('geometry'):
+            return resolve_geometry(self.driver, targets, scroll_to)
 
-        # Get baseline screenshot
-        self._create_dir(self.baseline_dir)
-        baseline_image = os.path.join(self.baseline_dir, '%s.png' % file_path) \
-            if isinstance(file_path, basestring) else Image.open(file_path).convert('RGB')
+    def get_screenshot_as_image(self, element=None, exclude=None, full_page=False):
+        """Returns screenshot image, cropped to element or with excluded areas masked
 
-        # Take screenshot and exit if in baseline saving mode
-        if self.save_baseline:
-            self.get_screenshot_as_image(element, exclude=exclude).save(baseline_image)
-            return
+        Element and excluded areas are resolved together in a single WebDriver command.
 
-        # Get fresh screenshot
-        self._create_dir(self.output_dir)
-        fresh_image = self.get_screenshot_as_image(element, exclude=exclude)
-        fresh_image_file = os.path.join(self.output_dir, '%s.png' % file_path)
-        fresh_image.save(fresh_image_file)
+        :param element: Crop image to WebElement or tuple containing selector ex. ('id', 'mainPage') (Optional)
+        :param list exclude: Elements or element selectors to exclude
+        :param bool full_page: Scroll through and stitch the whole page, ignored if element is given
+        :return:
+        """
 
-        # Error if there is not a baseline image to compare
-        if not self.save_baseline and not isinstance(file_path, basestring) and not os.path.exists(baseline_image):
-            raise IOError('The baseline screenshot %s does not exist. You might want to '
-                          're-run this test in baseline-saving mode.' % baseline_image)
+        return self._get_screenshot_with_boxes(element, exclude, full_page)[0]
 
-        # Compare images
-        if isinstance(baseline_image, basestring):
-            try:
-                self.engine.assertSameFiles(fresh_image_file, baseline_image, threshold)
+    def _get_screenshot_with_boxes(self, element=None, exclude=None, full_page=False, areas=None):
+        """Returns screenshot image along with the image boxes of areas, ex. to leave them out of comparisons
 
-            except AssertionError as err:
-                msg = getattr(err, 'message', err.args[0] if err.args else "")
-                args = err.args[1:] if len(err.args) > 1 else []
-                raise ImageMismatchException(msg, baseline_image, fresh_image_file, args)
+        Element, excluded areas and areas are resolved together in a single WebDriver command. Areas of full page
+        screenshots are resolved once more before scrolling.
 
-            except EnvironmentError:
-                msg = "Missing baseline '{}'. Please run again with --needle-save-baseline".format(baseline_image)
-                raise MissingBaselineException(msg)
+        :param element: Crop image to WebElement or tuple containing selector ex. ('id', 'mainPage') (Optional)
+        :param list exclude: Elements or element selectors to exclude
+        :param bool full_page: Scroll through and stitch the whole page, ignored if element is given
+        :param list areas: Elements or element selectors to locate in the image
+        :return: Image and boxes of areas, None for areas that were not found or are outside the image
+        :rtype: tuple
+        """
 
-            except ValueError as err:
+        # Mask elements in exclude if element is not included
+        exclude = list(exclude) if isinstance(exclude, (list, tuple)) and exclude and not element else []
+        areas = list(areas or [])
 
-                if self.options['needle_engine'] == 'imagemagick':
-                    msg = "It appears {0} is not installed. Please verify {0} is installed or choose a different engine"
-                    raise MissingEngineException(msg.format(self.options['needle_engine']))
+        if full_page and not element:
 
-                raise err
+            geometry = self._resolve_geometry(areas) if areas else None
+            image = self.get_full_page_screenshot(exclude)
 
-            finally:
-                if self.cleanup_on_success:
-                    os.remove(fresh_image_file)
+            if not areas:
+                return image, []
 
-        else:
+            ratio = self._get_ratio(image.size, (geometry.viewport_size[0], geometry.document_size[1]))
+            return image, [get_image_box(rect, ratio, (0, 0), image.size) for rect in geometry.rects]
 
-            diff = ImageDiff(fresh_image, baseline_image)
-            distance = abs(diff.get_distance())
+        targets = ([element] if element else []) + exclude + areas
+        geometry = self._resolve_geometry(targets) if targets else None
 
-            if distance > threshold:
-                pytest.fail('Fail: New screenshot did not match the baseline (by a distance of %.2f)' % distance)
+        image = self.get_screenshot(element, geometry)
 
-    @property
-    def output_dir(self):
-        """Return output image path
+        if exclude:
+
+            with self._timed('mask'):
+                self._mask_image(image, geometry.rects[:len(exclude)],
+                                 self._get_ratio(image.size, geometry.window_size))
+
+        if not areas:
+            return image, []
+
+        rect = geometry.rects[0] if element else None
+
+        # Areas of element screenshots are relative to the element
+        if rect:
+            ratio = self._get_ratio(image.size, (max(rect[2] - rect[0], 1), max(rect[3] - rect[1], 1)))
+            offset = rect[:2]
+        else:
+            ratio = self._get_ratio(image.size, geometry.window_size)
+            offset = (0, 0)
+
+        return image, [get_image_box(area, ratio, offset, image.size) for area in geometry.rects[-len(areas):]]
+
+    @staticmethod
+    def _mask_image(image, rects, ratio, offset=(0, 0)):
+        """Paint rectangles black
 
+        :param Image.Image image: Image to mask
+        :param list rects: Page rectangles to mask, None entries are skipped
+        :param ratio: Image pixels per page pixel
+        :param tuple offset: Page position of the image's top left corner
         :return:
-        :rtype: str
         """
 
-        return self.options.get('output_dir', DEFAULT_OUTPUT_DIR)
+        canvas = ImageDraw.Draw(image)
 
-    @output_dir.setter
-    def output_dir(self, value):
-        """Set output image directory
+        for rect in rects:
+            if rect:
+                canvas.rectangle([(point - offset[index % 2]) * ratio for index, point in enumerate(rect)],
+                                 fill=ImageColor.getrgb('black'))
 
-        :param str value: File path
+        del canvas
+
+    def get_full_page_screenshot(self, exclude=None):
+        """Returns screenshot of the whole page, scrolling through it one viewport at a time
+
+        Tiles are pasted into the final image as they are captured, so only one tile is decoded at a time.
+
+        :param list exclude: Elements or element selectors to mask, they are resolved again for every tile so fixed and
+                             sticky elements are masked wherever they appear
         :return:
+        :rtype: Image.Image
         """
 
-        assert isinstance(value, basestring)
-        self.options['output_dir'] = value
+        return self._stitch_tiles(self._iter_full_page_tiles(exclude))
 
-    @property
-    def save_baseline(self):
-        """Returns True, if save baseline flag is set
+    def _stitch_tiles(self, tiles):
+        """Paste full page tiles into a single image
 
+        :param tiles: Iterable of (top, tile, page size)
         :return:
-        :rtype: bool
+        :rtype: Image.Image
         """
 
-        return self.options.get('save_baseline', False)
+        image = None
+        peak = 0
 
-    @save_baseline.setter
-    def save_baseline(self, value):
-        """Set save baseline flag
+        for top, tile, page_size in tiles:
 
-        :param bool value: Save baseline flag
+            if image is None:
+                image = Image.new('RGB', page_size)
+
+            image.paste(tile, (0, top))
+
+            if self._current_stats is not None:
+                peak = max(peak, self._current_stats.get('peak_memory', 0))
+
+        # Tiles are decoded while the page image is held
+        if image is not None:
+            self._record_peak_memory(get_image_size(image) + peak)
+
+        return image
+
+    def _iter_full_page_tiles(self, exclude=None):
+        """Scroll through the page from the top, capturing one viewport at a time
+
+        Each tile is cropped to the rows no previous tile covered and has excluded areas masked. Excluded elements
+        pinned to the top of the viewport, ex. sticky headers, cover the same rows of every tile, so tiles after the
+        first scroll less to capture the content under them.
+
+        :param list exclude: Elements or element selectors to mask
+        :return: Generator of (top, tile, page size), top and page size in image pixels
+        """
+
+        exclude = list(exclude or [])
+
+        self.last_capture_strategy = 'full_page'
+
+        geometry = self._resolve_geometry(exclude, scroll_to=(0, 0))
+        origin = geometry.scroll_origin
+        page_size = None
+        filled = 0
+
+        try:
+
+            while True:
+
+                tile = self._decode_screenshot(self._capture_viewport())
+                ratio = self._get_ratio(tile.size, geometry.viewport_size)
+
+                if page_size is None:
+                    page_size = (tile.size[0], geometry.document_size[1] * ratio)
+
+                if exclude:
+
+                    with self._timed('mask'):
+                        self._mask_image(tile, geometry.rects, ratio, geometry.scroll)
+
+                top = geometry.scroll[1] * ratio
+                bottom = min(top + tile.size[1], page_size[1])
+
+                if bottom > filled:
+                    yield filled, tile.crop((0, filled - top, tile.size[0], bottom - top)), page_size
+                    filled = bottom
+
+                if filled >= page_size[1]:
+                    break
+
+                # Height of excluded elements across the top of the viewport, masks include their bottom edge, ignored
+                # if nothing else would fit
+                band = max([rect[3] - geometry.scroll[1] + 1 for rect in geometry.rects
+                            if rect and rect[1] <= geometry.scroll[1] < rect[3]] + [0])
+                band = band if band < geometry.viewport_size[1] else 0
+
+                geometry = self._resolve_geometry(exclude, scroll_to=(geometry.scroll[0],
+                                                                      max(filled // ratio - band, 0)))
+
+                # Page can not be scrolled any further
+                if geometry.scroll[1] * ratio <= top:
+                    break
+
+        finally:
+            self._resolve_geometry(scroll_to=origin)
+
+    def assert_screenshot(self, file_path, element_or_selector=None, threshold=0, exclude=None,  # pylint: disable=R0913
+                          full_page=False, defer=None, ignore=None, regions=None, stable_frames=None):
+        """Fail if new fresh image is too dissimilar from the baseline image
+
+        .. note:: From needle
+            https://github.com/python-needle/needle/blob/master/needle/cases.py#L161
+
+        :param str file_path: File name for baseline image
+        :param element_or_selector: WebElement or tuple containing selector ex. ('id', 'mainPage')
+        :param threshold: Distance threshold
+        :param list exclude: Elements or element selectors for areas to exclude, ignored within element screenshots
+        :param bool full_page: Scroll through and stitch the whole page, ignored if element_or_selector is given
+        :param bool defer: Compare in a worker process, failures are raised by :meth:`collect_deferred`
+            (defaults to the deferred compare flag)
+        :param list ignore: Elements or element selectors for areas left out of the comparison, without masking them
+        :param dict regions: (element or selector, threshold) tuples by region name, regions are compared against
+            their own threshold and left out of the rest of the comparison
+        :param int stable_frames: Capture until this many consecutive screenshots are identical, or the stable timeout
+            elapses, and compare the last one (defaults to the stable frames setting, less than 2 to disable)
         :return:
         """
 
-        self.options['save_baseline'] = bool(value)
+        stats = {'name': str(file_path), 'webdriver_commands': 0, 'screenshot_bytes': 0, 'timings': {}}
+        self.assertion_stats.append(stats)
 
-    def set_viewport(self):
-        """Set viewport width, height based off viewport size
+        self.last_capture_strategy = None
+        self._current_stats = stats
+        start = default_timer()
 
+        try:
+            with self._count_commands(stats):
+                self._assert_screenshot(file_path, element_or_selector, threshold, exclude, full_page,
+                                        self.deferred_compare if defer is None else defer, ignore=ignore,
+                                        regions=regions,
+                                        stable_frames=self.stable_frames if stable_frames is None else stable_frames)
+
+        finally:
+            stats['capture_strategy'] = self.last_capture_strategy
+            stats['duration'] = default_timer() - start
+            self._current_stats = None
+
+    def assert_screenshots(self, screenshots, threshold=0, exclude=None, parallel=None):
+        """Fail if any element's fresh image is too dissimilar from its baseline image, from a single screenshot
+
+        The viewport is captured and decoded once, all elements and excluded areas are resolved in a single WebDriver
+        command, and every element is cropped from the same image. All elements are compared, mismatches are raised
+        together once every comparison has finished. Elements must be within the viewport.
+
+        :param dict screenshots: Elements or element selectors by file name for their baseline image, or a list of
+                                 (file name, element or selector) pairs
+        :param threshold: Distance threshold
+        :param list exclude: Elements or element selectors for areas to exclude, masked before cropping
+        :param bool parallel: Compare in worker processes (defaults to the deferred compare flag)
         :return:
+        :raises MultipleFailuresException: If several elements did not match their baseline
         """
 
-        if self.viewport_size.lower() == 'fullscreen':
-            self.driver.maximize_window()
-            return
+        screenshots = list(screenshots.items()) if hasattr(screenshots, 'items') else list(screenshots)
 
-        viewport_size = re.match(r'(?P<width>\d+)\s?[xX]\s?(?P<height>\d+)', self.viewport_size)
+        stats = {'name': '+'.join(str(name) for name, _ in screenshots), 'webdriver_commands': 0,
+                 'screenshot_bytes': 0, 'timings': {}}
+        self.assertion_stats.append(stats)
 
-        viewport_dimensions = (viewport_size.group('width'), viewport_size.group('height')) if viewport_size \
-            else DEFAULT_VIEWPORT_SIZE.split('x')
+        self.last_capture_strategy = 'crop'
+        self._current_stats = stats
+        start = default_timer()
 
-        self.driver.set_window_size(*[int(dimension) for dimension in viewport_dimensions])
+        # Comparisons deferred before the batch are still collected when the test finishes
+        pending, self._deferred = self._deferred, []
 
-    @property
-    def viewport_size(self):
-        """Return setting for browser window size
+        try:
+            with self._count_commands(stats):
+                failures = self._assert_screenshots(screenshots, threshold, exclude,
+                                                    self.deferred_compare if parallel is None else parallel)
 
-        :return:
-        :rtype: str
+        finally:
+            self._deferred = pending + self._deferred
+            stats['capture_strategy'] = self.last_capture_strategy
+            stats['duration'] = default_timer() - start
+            self._current_stats = None
+
+        if len(failures) == 1:
+            raise failures[0]
+
+        if failures:
+            raise MultipleFailuresException(failures)
+
+    def _assert_screenshots(self, screenshots, threshold, exclude, parallel):
+        """Compare elements cropped from a single screenshot against their baselines
+
+        :param list screenshots: (file name, element or selector) pairs
+        :param threshold: Distance threshold
+        :param list exclude: Elements or element selectors for areas to exclude
+        :param bool parallel: Compare in worker processes
+        :return: Failures
+        :rtype: list
         """
 
-        return self.options.get('viewport_size', DEFAULT_VIEWPORT_SIZE)
+        exclude = list(exclude) if isinstance(exclude, (list, tuple)) else []
+        geometry = self._resolve_geometry([element for _, element in screenshots] + exclude)
 
-    @viewport_size.setter
-    def viewport_size(self, value):
-        """Set setting for browser window size
+        image = self._decode_screenshot(self._capture_viewport())
+        ratio = self._get_ratio(image.size, geometry.window_size)
 
-        :param value: Browser window size, as string or (x,y)
+        if exclude:
+
+            with self._timed('mask'):
+                self._mask_image(image, geometry.rects[len(screenshots):], ratio)
+
+        failures = []
+
+        for (file_path, _), rect in zip(screenshots, geometry.rects):
+
+            box = [point * ratio for point in rect] if rect else None
+
+            if box is None or min(box[:2]) < 0 or box[2] > image.size[0] or box[3] > image.size[1]:
+                failures.append(NeedleException("Element for '{}' was not found in the viewport".format(file_path)))
+                continue
+
+            try:
+                self._assert_screenshot(file_path, threshold=threshold, defer=parallel, fresh_image=image.crop(box))
+
+            except (ImageMismatchException, MissingBaselineException) as err:
+                failures.append(err)
+
+        failures.extend(self.collect_deferred())
+
+        return failures
+
+    def _capture_stable(self, capture, frames, baseline_hash=None):
+        """Capture until several consecutive captures have identical pixel hashes, or the stable timeout elapses
+
+        Captures are only hashed, never compared by the engine. A capture identical to the baseline is taken as
+        settled right away.
+
+        :param capture: Called without arguments, returns a tuple starting with the image
+        :param int frames: Number of consecutive identical captures
+        :param str baseline_hash: Pixel hash of the baseline (Optional)
+        :return: Last capture, followed by its pixel hash
+        :rtype: tuple
+        """
+
+        start = default_timer()
+        captured = 0
+        streak = 0
+        digest = None
+
+        while True:
+
+            result = capture()
+            captured += 1
+
+            with self._timed('hash'):
+                current = get_image_hash(result[0])
+
+            streak = streak + 1 if current == digest else 1
+            digest = current
+
+            if streak >= frames or digest == baseline_hash or default_timer() - start >= self.stable_timeout:
+                break
+
+        if self._current_stats is not None:
+            self._current_stats.update(stable_frames=captured, stable_time=default_timer() - start,
+                                       settled=streak >= frames or digest == baseline_hash)
+
+        return tuple(result) + (digest,)
+
+    @contextmanager
+    def _count_commands(self, stats):
+        """Count WebDriver commands issued within the context
+
+        :param dict stats: Assertion statistics, webdriver_commands is incremented for every command
         :return:
         """
 
-        assert isinstance(value, (basestring, list, tuple))
-        assert len(value) == 2 and all([isinstance(i, int) for i in value]) \
-            if isinstance(value, (list, tuple)) else True
-        self.options['viewport_size'] = value if isinstance(value, basestring) else '{}x{}'.format(*value)
+        execute = getattr(self.driver, 'execute', None)
+
+        if execute is None:
+            yield
+            return
+
+        def counting_execute(*args, **kwargs):
+            """Execute WebDriver command and count it
+            """
+
+            stats['webdriver_commands'] += 1
+            return execute(*args, **kwargs)
+
+        self.driver.execute = counting_execute
+
+        try:
+            yield
+
+        finally:
+            del self.driver.execute
+
+            if getattr(self.driver, 'execute', None) != execute:
+                self.driver.execute = execute
+
+    @contextmanager
+    def _timed(self, stage):
+        """Add time spent within the context to a stage of the assertion in progress
+
+        :param str stage: Stage name, ex. capture, decode or compare
+        :return:
+        """
+
+        start = default_timer()
+
+        try:
+            yield
+
+        finally:
+
+            if self._current_stats is not None:
+                timings = self._current_stats['timings']
+                timings[stage] = timings.get(stage, 0) + default_timer() - start
+
+    def collect_deferred(self):
+        """Wait for the deferred comparisons made so far and return their failures
+
+        Every comparison is waited for, a comparison that raised in its worker process, ex. because the pool broke,
+        fails with a NeedleException without stopping the others from being collected.
+
+        :return: MissingBaselineException, MissingEngineException, ImageMismatchException and NeedleException
+                 instances, in the order the assertions were made
+        :rtype: list
+        """
+
+        pending, self._deferred = self._deferred, []
+        failures = []
+
+        for baseline_image, future in pending:
+
+            try:
+                exception = get_exception(future.result())
+
+            except Exception as err:  # pylint: disable=W0703
+                msg = "Deferred comparison against '{}' failed: {!r}".format(baseline_image, err)
+                exception = NeedleException(msg)
+
+            if exception is not None:
+                failures.append(exception)
+
+        return failures
+
+    def _assert_screenshot(self, file_path, element_or_selector=None, threshold=0,  # pylint: disable=R0913,R0914
+                           exclude=None, full_page=False, defer=False, fresh_image=None, ignore=None, regions=None,
+                           stable_frames=0):
+        """Fail if new fresh image is too dissimilar from the baseline image
+
+        :param str file_path: File name for baseline image
+        :param element_or_selector: WebElement or tuple containing selector ex. ('id', 'mainPage')
+        :param threshold: Distance threshold
+        :param list exclude: Elements or element selectors for areas to exclude
+        :param bool full_page: Scroll through and stitch the whole page, ignored if element_or_selector is given
+        :param bool defer: Compare in a worker process
+        :param Image.Image fresh_image: Screenshot already captured, instead of taking one (Optional)
+        :param list ignore: Elements or element selectors for areas left out of the comparison
+        :param dict regions: (element or selector, threshold) tuples by region name
+        :param int stable_frames: Number of consecutive identical screenshots to wait for
+        :return:
+        """
+
+        element = element_or_selector or None
+
+        # Get baseline screenshot
+        self._create_dir(self.baseline_dir)
+        baseline_extension = '.png' if self.baseline_store is not None else IMAGE_FORMATS[self.baseline_format][0]
+        baseline_image = os.path.join(self.baseline_dir, file_path + baseline_extension) \
+            if isinstance(file_path, basestring) else get_rgb_image(Image.open(file_path))
+
+        # Take screenshot and exit if in baseline saving mode
+        if self.save_baseline:
+
+            digest = None
+
+            if fresh_image is not None:
+                image = fresh_image
+            elif stable_frames > 1:
+                image, _, digest = self._capture_stable(
+                    lambda: self._get_screenshot_with_boxes(element, exclude, full_page), stable_frames)
+            else:
+                image = self.get_screenshot_as_image(element, exclude=exclude, full_page=full_page)
+
+            if digest is None:
+
+                with self._timed('hash'):
+                    digest = get_image_hash(image)
+
+            # Baselines are only written when they changed, unchanged files keep their encoding and mtime
+            if self.baseline_store is not None:
+
+                name = get_name(self.baseline_dir, baseline_image)
+                baseline_hash = self.baseline_store.get_hash(name)
+                result, existing_hash = self._get_baseline_update(image, digest, baseline_hash,
+                                                                  lambda: self._open_baseline(baseline_image),
+                                                                  baseline_hash is not None)
+
+                if result != 'skipped':
+
+                    with self._timed('write'):
+                        self.baseline_store.save(name, image, digest=digest)
+
+            else:
+
+                baseline_hash = self._get_baseline_hash(baseline_image)
+                result, existing_hash = self._get_baseline_update(image, digest, baseline_hash,
+                                                                  lambda: self._open_baseline(baseline_image),
+                                                                  os.path.exists(baseline_image))
+
+                # Rebuild a missing or stale manifest entry of a baseline that is kept, ex. after a fresh checkout
+                if result == 'skipped' and baseline_hash is None:
+                    self._record_baseline_hash(baseline_image, existing_hash)
+
+                elif result != 'skipped':
+                    self._save_image(image, baseline_image,
+                                     callback=lambda path: self._record_baseline_hash(path, digest))
+
+            # Downscaled levels of rewritten baselines are pruned at the end of the session
+            self.pyramid_cache.add_baseline(existing_hash if result == 'skipped' else digest,
+                                            existing_hash if result == 'written' else None)
+
+            if self._current_stats is not None:
+                self._current_stats['baseline_update'] = result
+
+            return
+
+        fresh_image_file = os.path.join(self.output_dir, file_path + IMAGE_FORMATS[self.output_format][0]) \
+            if isinstance(file_path, basestring) else os.path.join(self.output_dir, '%s.png' % file_path)
+
+        ignore = list(ignore or [])
+        regions = list((regions or {}).items())
+
+        # Exclusions can not be masked within element screenshots, they are left out of the comparison instead
+        if element and isinstance(exclude, (list, tuple)) and getattr(self.engine, 'masks', False):
+            ignore.extend(exclude)
+
+        areas = ignore + [region for _, (region, _) in regions]
+
+        if areas and not getattr(self.engine, 'masks', False):
+            raise NeedleException("Ignored areas and regions need an engine that compares images with masks, "
+                                  "ex. pil or numpy")
+
+        # Compare full page screenshots one band at a time, so the fresh image is never stitched together
+        if full_page and not element and self.full_page_bands and not defer and fresh_image is None and \
+                not areas and stable_frames < 2 and isinstance(baseline_image, basestring):
+
+            engine = self.engine
+
+            if hasattr(engine, 'get_distance'):
+                tiles = self._iter_full_page_tiles(exclude if isinstance(exclude, (list, tuple)) else None)
+                self._assert_same_bands(engine, tiles, fresh_image_file, baseline_image, threshold)
+                return
+
+        # Get fresh screenshot
+        boxes = []
+        fresh_hash = None
+
+        if fresh_image is None and stable_frames > 1:
+            fresh_image, boxes, fresh_hash = self._capture_stable(
+                lambda: self._get_screenshot_with_boxes(element, exclude, full_page, areas), stable_frames,
+                self._get_baseline_hash(baseline_image) if isinstance(baseline_image, basestring) else None)
+
+        elif fresh_image is None:
+            fresh_image, boxes = self._get_screenshot_with_boxes(element, exclude, full_page, areas)
+
+        region_boxes = {}
+
+        for (name, (_, region_threshold)), box in zip(regions, boxes[len(ignore):]):
+
+            if box is None:
+                raise NeedleException("Region '{}' was not found in the screenshot".format(name))
+
+            region_boxes[name] = box, region_threshold
+
+        # Compare images
+        if isinstance(baseline_image, basestring):
+
+            # Pass without opening the baseline if the fresh pixels are identical to it
+            baseline_hash = self._get_baseline_hash(baseline_image)
+
+            if baseline_hash and fresh_hash is None:
+
+                with self._timed('hash'):
+                    fresh_hash = get_image_hash(fresh_image)
+
+            if baseline_hash and baseline_hash == fresh_hash:
+                self._keep_fresh_image(fresh_image, fresh_image_file)
+                return
+
+            if areas:
+                self._assert_same_regions(self.engine, fresh_image, fresh_image_file, baseline_image, threshold,
+                                          boxes[:len(ignore)], region_boxes)
+                return
+
+            if defer and not self.tile_size:
+
+                with self._timed('defer'):
+                    self._deferred.append((baseline_image, self.compare_pool.submit(
+                        self.engine_class, self.tolerance, fresh_image, fresh_image_file, baseline_image, threshold,
+                        keep_on_success=self.keep_on_success and not self.cleanup_on_success,
+                        store_path=self.baseline_store.path if self.baseline_store is not None else None,
+                        store_name=get_name(self.baseline_dir, baseline_image),
+                        image_format=self.get_image_format(self.output_format))))
+
+                return
+
+            engine = self.engine
+
+            # Fail on downscaled images first, when the screenshot is far from its baseline
+            if self.pyramid and baseline_hash and hasattr(engine, 'get_distance'):
+                self._assert_same_pyramid(engine, fresh_image, fresh_image_file, baseline_image, baseline_hash,
+                                          threshold)
+
+            if hasattr(engine, 'assertSameImages'):
+                self._assert_same_images(engine, fresh_image, fresh_image_file, baseline_image, threshold)
+            else:
+                self._assert_same_files(engine, fresh_image, fresh_image_file, baseline_image, threshold)
+
+        elif areas:
+            self._assert_same_regions(self.engine, fresh_image, fresh_image_file, baseline_image, threshold,
+                                      boxes[:len(ignore)], region_boxes)
+
+        else:
+
+            with self._timed('compare'):
+                distance = abs(ImageDiff(fresh_image, baseline_image).get_distance())
+
+            if distance > threshold:
+                self._save_image(fresh_image, fresh_image_file)
+                pytest.fail('Fail: New screenshot did not match the baseline (by a distance of %.2f)' % distance)
+
+            self._keep_fresh_image(fresh_image, fresh_image_file)
+
+    def _assert_same_images(self, engine, fresh_image, fresh_image_file, baseline_image,  # pylint: disable=R0913
+                            threshold):
+        """Compare fresh image against the decoded baseline in memory, fresh image is only written on failure
+
+        :param engine: Image processing engine that implements assertSameImages
+        :param Image.Image fresh_image: Fresh image
+        :param str fresh_image_file: Fresh image path
+        :param str baseline_image: Baseline image path
+        :param threshold: Distance threshold
+        :return:
+        """
+
+        try:
+            baseline = self._open_baseline(baseline_image)
+
+        except EnvironmentError:
+            self._save_image(fresh_image, fresh_image_file)
+            msg = "Missing baseline '{}'. Please run again with --needle-save-baseline".format(baseline_image)
+            raise MissingBaselineException(msg)
+
+        # Rebuild missing or stale manifest entry while the baseline is decoded anyway
+        if self.manifests is not None and self._get_baseline_hash(baseline_image) is None:
+
+            with self._timed('hash'):
+                self._record_baseline_hash(baseline_image, get_image_hash(baseline))
+
+        changed_regions = []
+
+        try:
+
+            with self._timed('compare'):
+
+                if self.tile_size and hasattr(engine, 'get_distance') and fresh_image.size == baseline.size:
+                    changed_regions = self._assert_same_tiles(engine, fresh_image, baseline, baseline_image,
+                                                              threshold)
+                else:
+                    engine.assertSameImages(fresh_image, baseline, threshold)
+
+        except AssertionError as err:
+
+            self._save_image(fresh_image, fresh_image_file)
+
+            if hasattr(engine, 'get_diff_image') and fresh_image.size == baseline.size:
+                self._save_image(engine.get_diff_image(fresh_image, baseline),
+                                 get_variant_path(fresh_image_file, 'diff'))
+
+            msg = getattr(err, 'message', err.args[0] if err.args else "")
+            args = err.args[1:] if len(err.args) > 1 else []
+            raise ImageMismatchException(msg, self._get_baseline_file(baseline_image, fresh_image_file),
+                                         fresh_image_file, *args,
+                                         changed_regions=getattr(err, 'changed_regions', changed_regions))
+
+        self._keep_fresh_image(fresh_image, fresh_image_file)
+
+    def _assert_same_regions(self, engine, fresh_image, fresh_image_file, baseline_image,  # pylint: disable=R0913
+                             threshold, ignore, regions):
+        """Compare fresh image against the baseline with ignored areas left out, named regions against their own
+        thresholds
+
+        Ignored areas and regions are applied as a mask while computing distances, neither image is painted.
+
+        :param engine: Image processing engine whose get_distance accepts a mask
+        :param Image.Image fresh_image: Fresh image
+        :param str fresh_image_file: Fresh image path
+        :param baseline_image: Baseline image path or decoded baseline image
+        :param threshold: Distance threshold outside named regions
+        :param list ignore: Image boxes to leave out
+        :param dict regions: (image box, threshold) tuples by region name
+        :return:
+        """
+
+        baseline = baseline_image
+
+        if isinstance(baseline_image, basestring):
+
+            try:
+                baseline = self._open_baseline(baseline_image)
+
+            except EnvironmentError:
+                self._save_image(fresh_image, fresh_image_file)
+                msg = "Missing baseline '{}'. Please run again with --needle-save-baseline".format(baseline_image)
+                raise MissingBaselineException(msg)
+
+        if fresh_image.size != baseline.size:
+            msg = "The new screenshot did not match the baseline (sizes differ %s != %s)"
+            msg = msg % (fresh_image.size, baseline.size)
+            failures = None
+
+        else:
+
+            with self._timed('compare'):
+                distance, distances = compare_regions(engine, fresh_image, baseline, ignore,
+                                                      dict((name, box) for name, (box, _) in regions.items()))
+
+            failures = sorted(name for name, value in distances.items() if value > regions[name][1])
+
+            if distance <= threshold and not failures:
+                self._keep_fresh_image(fresh_image, fresh_image_file)
+                return
+
+            msg = "The new screenshot did not match the baseline (%s)" % ', '.join(
+                (["by a distance of %.2f" % distance] if distance > threshold else []) +
+                ["region '%s' by a distance of %.2f" % (name, distances[name]) for name in failures])
+
+        self._save_image(fresh_image, fresh_image_file)
+
+        if not isinstance(baseline_image, basestring):
+            pytest.fail('Fail: ' + msg)
+
+        if failures is not None and hasattr(engine, 'get_diff_image'):
+            self._save_image(engine.get_diff_image(fresh_image, baseline, mask=get_mask(fresh_image.size, ignore)),
+                             get_variant_path(fresh_image_file, 'diff'))
+
+        raise ImageMismatchException(msg, self._get_baseline_file(baseline_image, fresh_image_file), fresh_image_file,
+                                     changed_regions=[regions[name][0] for name in failures or []])
+
+    def _assert_same_pyramid(self, engine, fresh_image, fresh_image_file, baseline_image,  # pylint: disable=R0913
+                             baseline_hash, threshold):
+        """Fail if downscaled images already differ by more than threshold, without a full resolution comparison
+
+        Downscaled baselines are cached by their pixel hash, so the full baseline is only decoded to build them, or
+        for the diff image of a failure.
+
+        :param engine: Image processing engine that implements get_distance
+        :param Image.Image fresh_image: Fresh image
+        :param str fresh_image_file: Fresh image path
+        :param str baseline_image: Baseline image path
+        :param str baseline_hash: Pixel hash of the baseline
+        :param threshold: Distance threshold
+        :return:
+        """
+
+        baseline = []
+
+        def load():
+            """Decode the baseline once, for all levels that are not cached
+            """
+
+            if not baseline:
+                baseline.append(self._open_baseline(baseline_image))
+
+            return baseline[0]
+
+        try:
+            levels = dict((factor, self.pyramid_cache.get(self.baseline_dir, baseline_hash, factor, load))
+                          for factor in PYRAMID_FACTORS)
+
+        except EnvironmentError:
+            return
+
+        with self._timed('pyramid'):
+            distance = compare_pyramid(fresh_image, levels.get, threshold, getattr(engine, 'tolerance', 0))
+
+        self.pyramid_cache.add_result(distance is not None)
+
+        if distance is None:
+            return
+
+        self._save_image(fresh_image, fresh_image_file)
+
+        # Failures are rare, decoding the baseline for a diff image costs nothing on passing assertions
+        if hasattr(engine, 'get_diff_image'):
+
+            try:
+                diff_baseline = load()
+
+            except EnvironmentError:
+                diff_baseline = None
+
+            if diff_baseline is not None and fresh_image.size == diff_baseline.size:
+                self._save_image(engine.get_diff_image(fresh_image, diff_baseline),
+                                 get_variant_path(fresh_image_file, 'diff'))
+
+        raise ImageMismatchException("The new screenshot did not match the baseline (by a distance of at least %.2f)"
+                                     % distance, self._get_baseline_file(baseline_image, fresh_image_file),
+                                     fresh_image_file)
+
+    def _assert_same_tiles(self, engine, fresh_image, baseline, baseline_image, threshold):  # pylint: disable=R0913
+        """Compare fresh image against the baseline tile by tile, only tiles whose hashes differ are compared
+
+        Baseline tile hashes are kept in the baseline's manifest, so they are only computed once per baseline.
+
+        :param engine: Image processing engine that implements get_distance
+        :param Image.Image fresh_image: Fresh image
+        :param Image.Image baseline: Decoded baseline image
+        :param str baseline_image: Baseline image path
+        :param threshold: Distance threshold
+        :return: Boxes of changed tiles
+        :rtype: list
+        """
+
+        manifest = self.manifests.get(os.path.dirname(os.path.realpath(baseline_image))) \
+            if self.manifests is not None else None
+        name = os.path.basename(baseline_image)
+
+        baseline_hashes = manifest.get_tiles(name, self.tile_size) if manifest else None
+
+        if not baseline_hashes:
+            baseline_hashes = get_tile_hashes(baseline, self.tile_size)
+
+            if manifest:
+                manifest.update_tiles(name, self.tile_size, baseline_hashes)
+
+        distance, changed = compare_tiles(engine, fresh_image, baseline, self.tile_size, baseline_hashes)
+
+        if distance > threshold:
+            err = AssertionError("The new screenshot did not match the baseline (by a distance of %.2f, %d of %d "
+                                 "tiles changed)" % (distance, len(changed), len(baseline_hashes)))
+            err.changed_regions = changed
+            raise err
+
+        return changed
+
+    def _assert_same_bands(self, engine, tiles, fresh_image_file, baseline_image, threshold):  # pylint: disable=R0913
+        """Compare full page tiles against the matching bands of the baseline
+
+        Distances add up across bands, only bands that differ from the baseline are compared and kept in memory. On
+        failure the fresh image is rebuilt from the baseline and the differing bands.
+
+        :param engine: Image processing engine that implements get_distance and assertSameImages
+        :param tiles: Iterable of (top, tile, page size)
+        :param str fresh_image_file: Fresh image path
+        :param str baseline_image: Baseline image path
+        :param threshold: Distance threshold
+        :return:
+        """
+
+        try:
+            baseline = self._open_baseline(baseline_image)
+
+        except EnvironmentError:
+            self._save_image(self._stitch_tiles(tiles), fresh_image_file)
+            msg = "Missing baseline '{}'. Please run again with --needle-save-baseline".format(baseline_image)
+            raise MissingBaselineException(msg)
+
+        distance = 0
+        changed = []
+
+        for top, tile, page_size in tiles:
+
+            # Sizes differ, fall back to comparing whole images
+            if page_size != baseline.size:
+                fresh_image = self._stitch_tiles(itertools.chain([(top, tile, page_size)], tiles))
+                self._assert_same_images(engine, fresh_image, fresh_image_file, baseline_image, threshold)
+                return
+
+            with self._timed('compare'):
+
+                band = baseline.crop((0, top, tile.size[0], top + tile.size[1]))
+
+                if ImageChops.difference(tile, band).getbbox():
+                    distance += engine.get_distance(tile, band)
+                    changed.append((top, tile))
+
+        if distance <= threshold and not (self.keep_on_success and not self.cleanup_on_success):
+            return
+
+        fresh_image = baseline.copy()
+
+        for top, tile in changed:
+            fresh_image.paste(tile, (0, top))
+
+        if distance <= threshold:
+            self._keep_fresh_image(fresh_image, fresh_image_file)
+            return
+
+        self._save_image(fresh_image, fresh_image_file)
+
+        if hasattr(engine, 'get_diff_image'):
+            self._save_image(engine.get_diff_image(fresh_image, baseline), get_variant_path(fresh_image_file, 'diff'))
+
+        raise ImageMismatchException("The new screenshot did not match the baseline (by a distance of %.2f)" % distance,
+                                     self._get_baseline_file(baseline_image, fresh_image_file), fresh_image_file)
+
+    def _assert_same_files(self, engine, fresh_image, fresh_image_file, baseline_image,  # pylint: disable=R0913
+                           threshold):
+        """Compare fresh image against the baseline on disk, for engines that only work with files
+
+        :param engine: Image processing engine
+        :param Image.Image fresh_image: Fresh image
+        :param str fresh_image_file: Fresh image path
+        :param str baseline_image: Baseline image path
+        :param threshold: Distance threshold
+        :return:
+        """
+
+        self._save_image(fresh_image, fresh_image_file, sync=True)
+        baseline_file = baseline_image
+
+        try:
+
+            # Engines that compare files need the stored baseline on disk
+            if self.baseline_store is not None:
+
+                with self._timed('baseline'):
+                    baseline_file = self._get_baseline_file(baseline_image, fresh_image_file)
+
+            with self._timed('compare'):
+                engine.assertSameFiles(fresh_image_file, baseline_file, threshold)
+
+        except AssertionError as err:
+            msg = getattr(err, 'message', err.args[0] if err.args else "")
+            args = err.args[1:] if len(err.args) > 1 else []
+            raise ImageMismatchException(msg, baseline_file, fresh_image_file, *args)
+
+        except EnvironmentError:
+            msg = "Missing baseline '{}'. Please run again with --needle-save-baseline".format(baseline_image)
+            raise MissingBaselineException(msg)
+
+        except ValueError as err:
+
+            if self.options['needle_engine'] == 'imagemagick':
+                raise MissingEngineException(MISSING_ENGINE_MESSAGE.format(self.options['needle_engine']))
+
+            raise err
+
+        if baseline_file != baseline_image:
+            os.remove(baseline_file)
+
+        if self.cleanup_on_success or not self.keep_on_success:
+            os.remove(fresh_image_file)
+
+    def _keep_fresh_image(self, fresh_image, fresh_image_file):
+        """Write fresh image of a passing comparison, only if asked to keep it
+
+        :param Image.Image fresh_image: Fresh image
+        :param str fresh_image_file: Fresh image path
+        :return:
+        """
+
+        if self.keep_on_success and not self.cleanup_on_success:
+            self._save_image(fresh_image, fresh_image_file)
+
+    def _get_baseline_update(self, image, digest, baseline_hash, load, exists=True):  # pylint: disable=R0913
+        """Returns how saving a new baseline changes the existing one: new, written, or skipped if it is unchanged
+
+        A baseline is unchanged if its pixel hash is the same, or if the new screenshot is within the save baseline
+        threshold of it.
+
+        :param Image.Image image: New baseline image
+        :param str digest: Pixel hash of the new baseline image
+        :param str baseline_hash: Pixel hash of the existing baseline, None if unknown or there is none
+        :param load: Called without arguments to decode the existing baseline
+        :param bool exists: False, if there is no existing baseline
+        :return: new, written or skipped, and the pixel hash of the existing baseline, None if there is none
+        :rtype: tuple
+        """
+
+        if not exists:
+            return 'new', None
+
+        baseline = None
+
+        if baseline_hash is None:
+
+            try:
+                baseline = load()
+
+            except EnvironmentError:
+                return 'new', None
+
+            with self._timed('hash'):
+                baseline_hash = get_image_hash(baseline)
+
+        if baseline_hash == digest:
+            return 'skipped', baseline_hash
+
+        if not self.save_baseline_threshold:
+            return 'written', baseline_hash
+
+        baseline = baseline if baseline is not None else load()
+
+        if baseline.size != image.size:
+            return 'written', baseline_hash
+
+        engine = self.engine
+
+        with self._timed('compare'):
+            distance = engine.get_distance(image, baseline) if hasattr(engine, 'get_distance') else \
+                abs(ImageDiff(image, baseline).get_distance())
+
+        return 'skipped' if distance <= self.save_baseline_threshold else 'written', baseline_hash
+
+    def _get_baseline_hash(self, file_path):
+        """Returns pixel hash of a baseline from its directory's manifest, None if missing or stale
+
+        :param str file_path: Baseline image path
+        :return:
+        :rtype: str
+        """
+
+        if self.baseline_store is not None:
+            return self.baseline_store.get_hash(get_name(self.baseline_dir, file_path))
+
+        if self.manifests is None:
+            return None
+
+        manifest = self.manifests.get(os.path.dirname(os.path.realpath(file_path)))
+        return manifest.get(os.path.basename(file_path))
+
+    def _record_baseline_hash(self, file_path, digest):
+        """Record pixel hash of a baseline in its directory's manifest
+
+        :param str file_path: Baseline image path
+        :param str digest: Pixel hash
+        :return:
+        """
+
+        if self.manifests is None or self.baseline_store is not None:
+            return
+
+        manifest = self.manifests.get(os.path.dirname(os.path.realpath(file_path)))
+        manifest.update(os.path.basename(file_path), digest)
+
+    def _open_baseline(self, file_path):
+        """Returns decoded baseline image, from the session's baseline cache if there is one
+
+        :param str file_path: Baseline image path
+        :return:
+        :rtype: Image.Image
+        """
+
+        with self._timed('baseline'):
+
+            store = self.baseline_store
+
+            if store is not None:
+
+                name = get_name(self.baseline_dir, file_path)
+
+                if self.baseline_cache is None:
+                    return store.open(name)
+
+                digest = store.get_hash(name)
+
+                if digest is None:
+                    raise IOError(ENOENT, "No such baseline", file_path)
+
+                return self.baseline_cache.get_content(digest, lambda: store.open(name))
+
+            if self.baseline_cache is not None:
+                return self.baseline_cache.get(file_path)
+
+            return get_rgb_image(Image.open(file_path))
+
+    def _get_baseline_file(self, baseline_image, fresh_image_file):
+        """Returns path of a baseline on disk, stored baselines are extracted next to the fresh image
+
+        :param str baseline_image: Baseline image path
+        :param str fresh_image_file: Fresh image path
+        :return:
+        :rtype: str
+        """
+
+        if self.baseline_store is None:
+            return baseline_image
+
+        baseline_file = os.path.splitext(fresh_image_file)[0] + '.baseline.png'
+        self.baseline_store.extract(get_name(self.baseline_dir, baseline_image), baseline_file)
+
+        return baseline_file
+
+    def get_image_format(self, name):
+        """Returns image format with the encoder settings of this driver
+
+        :param str name: Image format (png, webp or raw)
+        :return:
+        :rtype: pytest_needle.writer.ImageFormat
+        """
+
+        return ImageFormat(name, png_compress_level=self.png_compress_level, webp_method=self.webp_method)
+
+    def _save_image(self, image, file_path, callback=None, sync=False):
+        """Save image to disk, creating its directory if needed
+
+        Images are written in the background when the session has an image writer with threads.
+
+        :param Image.Image image: Image to save, must not be modified afterwards
+        :param str file_path: File path
+        :param callback: Called with the file path once written (Optional)
+        :param bool sync: Write before returning
+        :return:
+        """
+
+        image_format = ImageFormat.from_path(file_path, png_compress_level=self.png_compress_level,
+                                             webp_method=self.webp_method)
+
+        with self._timed('write'):
+
+            if self.image_writer is not None:
+                self.image_writer.save(image, file_path, callback, sync, image_format)
+                return
+
+            save_image(image, file_path, image_format)
+
+        if callback:
+            callback(file_path)
+
+    @property
+    def full_page_bands(self):
+        """Returns True, if full page screenshots are compared one band at a time
+
+        :return:
+        :rtype: bool
+        """
+
+        return self.options.get('full_page_bands', False)
+
+    @full_page_bands.setter
+    def full_page_bands(self, value):
+        """Set full page bands flag
+
+        :param bool value: Full page bands flag
+        :return:
+        """
+
+        self.options['full_page_bands'] = bool(value)
+
+    @property
+    def image_writer(self):
+        """Return image writer shared by the session
+
+        :return:
+        :rtype: pytest_needle.writer.ImageWriter
+        """
+
+        return self.options.get('image_writer')
+
+    @property
+    def keep_on_success(self):
+        """Returns True, if fresh images of passing comparisons should be written to disk
+
+        :return:
+        :rtype: bool
+        """
+
+        return self.options.get('keep_on_success', False)
+
+    @keep_on_success.setter
+    def keep_on_success(self, value):
+        """Set keep on success flag
+
+        :param bool value: Keep on success flag
+        :return:
+        """
+
+        self.options['keep_on_success'] = bool(value)
+
+    @property
+    def manifests(self):
+        """Return baseline manifests shared by the session
+
+        :return:
+        :rtype: pytest_needle.manifest.ManifestStore
+        """
+
+        return self.options.get('manifests')
+
+    @property
+    def output_dir(self):
+        """Return output image path
+
+        :return:
+        :rtype: str
+        """
+
+        return self.options.get('output_dir', DEFAULT_OUTPUT_DIR)
+
+    @output_dir.setter
+    def output_dir(self, value):
+        """Set output image directory
+
+        :param str value: File path
+        :return:
+        """
+
+        assert isinstance(value, basestring)
+        self.options['output_dir'] = value
+
+    @property
+    def output_format(self):
+        """Return format fresh and diff images are written in (png, webp or raw)
+
+        :return:
+        :rtype: str
+        """
+
+        return self.options.get('output_format', DEFAULT_IMAGE_FORMAT)
+
+    @output_format.setter
+    def output_format(self, value):
+        """Set format fresh and diff images are written in
+
+        :param str value: Image format (png, webp or raw)
+        :return:
+        """
+
+        assert value in IMAGE_FORMATS
+        self.options['output_format'] = value
+
+    @property
+    def png_compress_level(self):
+        """Return zlib compression level PNG images are written with
+
+        :return:
+        :rtype: int
+        """
+
+        return self.options.get('png_compress_level', DEFAULT_PNG_COMPRESS_LEVEL)
+
+    @png_compress_level.setter
+    def png_compress_level(self, value):
+        """Set zlib compression level PNG images are written with
+
+        :param int value: Compression level, 0 (fastest) to 9 (smallest)
+        :return:
+        """
+
+        assert 0 <= int(value) <= 9
+        self.options['png_compress_level'] = int(value)
+
+    @property
+    def pyramid(self):
+        """Returns True, if screenshots are compared on downscaled images before full resolution
+
+        :return:
+        :rtype: bool
+        """
+
+        return self.options.get('pyramid', False)
+
+    @pyramid.setter
+    def pyramid(self, value):
+        """Set pyramid comparison flag
+
+        :param bool value: Pyramid comparison flag
+        :return:
+        """
+
+        self.options['pyramid'] = bool(value)
+
+    @property
+    def pyramid_cache(self):
+        """Return downscaled baseline cache shared by the session
+
+        :return:
+        :rtype: pytest_needle.pyramid.PyramidCache
+        """
+
+        if self.options.get('pyramid_cache') is None:
+            self.options['pyramid_cache'] = PyramidCache()
+
+        return self.options['pyramid_cache']
+
+    @property
+    def save_baseline(self):
+        """Returns True, if save baseline flag is set
+
+        :return:
+        :rtype: bool
+        """
+
+        return self.options.get('save_baseline', False)
+
+    @save_baseline.setter
+    def save_baseline(self, value):
+        """Set save baseline flag
+
+        :param bool value: Save baseline flag
+        :return:
+        """
+
+        self.options['save_baseline'] = bool(value)
+
+    @property
+    def save_baseline_threshold(self):
+        """Returns distance within which saving baselines keeps the existing baseline, 0 to only keep identical ones
+
+        :return:
+        """
+
+        return self.options.get('save_baseline_threshold', 0)
+
+    @save_baseline_threshold.setter
+    def save_baseline_threshold(self, value):
+        """Set save baseline threshold
+
+        :param value: Distance threshold
+        :return:
+        """
+
+        self.options['save_baseline_threshold'] = value
+
+    def set_viewport(self, force=False):
+        """Set viewport width, height based off viewport size
+
+        :param bool force: Resize the window even if the window tracker has it at this size already
+        :return:
+        """
+
+        if self.viewport_size.lower() == 'fullscreen':
+
+            self._set_window('size', 'fullscreen', self.driver.maximize_window, force)
+
+            # Maximizing also moves the window
+            if self.window_tracker is not None:
+                self.window_tracker.forget(self.driver, 'position')
+
+            return
+
+        viewport_size = VIEWPORT_SIZE_PATTERN.match(self.viewport_size)
+
+        viewport_dimensions = tuple(int(dimension) for dimension in (
+            (viewport_size.group('width'), viewport_size.group('height')) if viewport_size
+            else DEFAULT_VIEWPORT_SIZE.split('x')))
+
+        self._set_window('size', viewport_dimensions, lambda: self.driver.set_window_size(*viewport_dimensions), force)
+
+    def _set_window(self, name, value, command, force=False):
+        """Set window position or size through the session's window tracker, if there is one
+
+        :param str name: Setting name, position or size
+        :param value: Setting value
+        :param command: Called without arguments to set the value
+        :param bool force: Set value even if the window tracker has it already
+        :return:
+        """
+
+        if self.window_tracker is None:
+            command()
+            return
+
+        self.window_tracker.set(self.driver, name, value, command, force)
+
+    @property
+    def stable_frames(self):
+        """Returns number of consecutive identical screenshots to wait for before comparing, 0 if disabled
+
+        :return:
+        :rtype: int
+        """
+
+        return self.options.get('stable_frames', 0)
+
+    @stable_frames.setter
+    def stable_frames(self, value):
+        """Set number of consecutive identical screenshots to wait for
+
+        :param int value: Number of screenshots, less than 2 to disable
+        :return:
+        """
+
+        self.options['stable_frames'] = max(int(value), 0)
+
+    @property
+    def stable_timeout(self):
+        """Returns seconds to wait for consecutive identical screenshots, the last one is compared after that
+
+        :return:
+        :rtype: float
+        """
+
+        return self.options.get('stable_timeout', DEFAULT_STABLE_TIMEOUT)
+
+    @stable_timeout.setter
+    def stable_timeout(self, value):
+        """Set seconds to wait for consecutive identical screenshots
+
+        :param float value: Timeout in seconds
+        :return:
+        """
+
+        self.options['stable_timeout'] = float(value)
+
+    @property
+    def tile_size(self):
+        """Return tile size for tiled comparisons, 0 if images are compared as a whole
+
+        :return:
+        :rtype: int
+        """
+
+        return self.options.get('tile_size', 0)
+
+    @tile_size.setter
+    def tile_size(self, value):
+        """Set tile size for tiled comparisons
+
+        :param int value: Tile width and height in pixels, 0 to compare images as a whole
+        :return:
+        """
+
+        assert int(value) >= 0
+        self.options['tile_size'] = int(value)
+
+    @property
+    def tolerance(self):
+        """Return per channel tolerance, channel differences at or below it are ignored by engines that support it
+
+        :return:
+        :rtype: int
+        """
+
+        return self.options.get('tolerance', 0)
+
+    @tolerance.setter
+    def tolerance(self, value):
+        """Set per channel tolerance
+
+        :param int value: Tolerance (0-255)
+        :return:
+        """
+
+        assert 0 <= int(value) <= 255
+        self.options['tolerance'] = int(value)
+
+    @property
+    def viewport_size(self):
+        """Return setting for browser window size
+
+        :return:
+        :rtype: str
+        """
+
+        return self.options.get('viewport_size', DEFAULT_VIEWPORT_SIZE)
+
+    @viewport_size.setter
+    def viewport_size(self, value):
+        """Set setting for browser window size
+
+        :param value: Browser window size, as string or (x,y)
+        :return:
+        """
+
+        assert isinstance(value, (basestring, list, tuple))
+        assert len(value) == 2 and all([isinstance(i, int) for i in value]) \
+            if isinstance(value, (list, tuple)) else True
+        self.options['viewport_size'] = value if isinstance(value, basestring) else '{}x{}'.format(*value)
+
+    @property
+    def window_tracker(self):
+        """Return window tracker shared by the session
+
+        :return:
+        :rtype: pytest_needle.window.WindowTracker
+        """
+
+        return self.options.get('window_tracker')
+
+    @property
+    def webp_method(self):
+        """Return method lossless WebP images are written with
+
+        :return:
+        :rtype: int
+        """
+
+        return self.options.get('webp_method', DEFAULT_WEBP_METHOD)
+
+    @webp_method.setter
+    def webp_method(self, value):
+        """Set method lossless WebP images are written with
+
+        :param int value: Method, 0 (fastest) to 6 (smallest)
+        :return:
+        """
+
+        assert 0 <= int(value) <= 6
+        self.options['webp_method'] = int(value)
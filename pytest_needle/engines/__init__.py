@@ -0,0 +1,156 @@
+"""pytest_needle.engines
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+import threading
+from needle.cases import import_from_string
+
+
+#: Entry point group third-party engines register under, ex. ``myengine = mypackage.engine:Engine``
+ENTRY_POINT_GROUP = 'pytest_needle.engines'
+
+#: Engines bundled with pytest-needle and needle, by name
+ENGINES = {
+    'pil': 'pytest_needle.engines.pil_engine.Engine',
+    'imagemagick': 'needle.engines.imagemagick_engine.Engine',
+    'perceptualdiff': 'needle.engines.perceptualdiff_engine.Engine',
+    'numpy': 'pytest_needle.engines.numpy_engine.Engine'
+}
+
+#: Message for engines whose external program is not installed, formatted with the engine name
+MISSING_ENGINE_MESSAGE = "It appears {0} is not installed. Please verify {0} is installed or choose a different engine"
+
+
+def _iter_entry_points(group):
+    """Yields entry points of a group, without loading them
+
+    :param str group: Entry point group
+    :return:
+    """
+
+    try:
+        from importlib.metadata import entry_points  # pylint: disable=C0415
+
+    except ImportError:
+
+        import pkg_resources  # pylint: disable=C0415
+
+        for entry_point in pkg_resources.iter_entry_points(group):
+            yield entry_point
+
+        return
+
+    points = entry_points()
+
+    for entry_point in points.select(group=group) if hasattr(points, 'select') else points.get(group, []):
+        yield entry_point
+
+
+class EngineRegistry(object):  # pylint: disable=R0205
+    """Image processing engines by name
+
+    Engines are looked up among the bundled engines, then the ``pytest_needle.engines`` entry point group, or can be
+    given as a dotted path to the engine class. Engine modules are only imported when an engine is first used, and
+    each engine is instantiated once.
+    """
+
+    def __init__(self):
+
+        self._entry_points = None
+        self._classes = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    @property
+    def entry_points(self):
+        """Returns engine entry points by name, read on first access
+
+        :return:
+        :rtype: dict
+        """
+
+        if self._entry_points is None:
+            self._entry_points = dict((entry_point.name.lower(), entry_point)
+                                      for entry_point in _iter_entry_points(ENTRY_POINT_GROUP))
+
+        return self._entry_points
+
+    @property
+    def names(self):
+        """Returns names of all known engines
+
+        :return:
+        :rtype: list
+        """
+
+        return sorted(set(ENGINES) | set(self.entry_points))
+
+    def __contains__(self, name):
+
+        return name.lower() in ENGINES or name.lower() in self.entry_points
+
+    def get_class(self, name):
+        """Returns engine class, importing its module on first use
+
+        :param str name: Engine name or dotted path to the engine class
+        :return:
+        """
+
+        key = name.lower() if name in self else name
+
+        with self._lock:
+
+            if key not in self._classes:
+
+                if key in ENGINES:
+                    self._classes[key] = import_from_string(ENGINES[key])
+
+                elif key in self.entry_points:
+                    self._classes[key] = self.entry_points[key].load()
+
+                elif '.' in key:
+                    self._classes[key] = import_from_string(key)
+
+                else:
+                    raise ValueError("Unknown engine '{}', choose one of: {}".format(name, ', '.join(self.names)))
+
+            return self._classes[key]
+
+    def get(self, name):
+        """Returns engine instance, instantiated on first use
+
+        :param str name: Engine name or dotted path to the engine class
+        :return:
+        """
+
+        engine_class = self.get_class(name)
+
+        with self._lock:
+
+            if engine_class not in self._instances:
+                self._instances[engine_class] = engine_class()
+
+            return self._instances[engine_class]
+
+    def get_path(self, name):
+        """Returns dotted path to an engine class
+
+        :param str name: Engine name or dotted path to the engine class
+        :return:
+        :rtype: str
+        """
+
+        if name.lower() in ENGINES:
+            return ENGINES[name.lower()]
+
+        if name not in self and '.' in name:
+            return name
+
+        engine_class = self.get_class(name)
+        return '{}.{}'.format(engine_class.__module__, engine_class.__name__)
+
+
+#: Registry used by NeedleDriver instances created outside of a pytest session
+registry = EngineRegistry()  # pylint: disable=C0103
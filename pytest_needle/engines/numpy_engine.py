@@ -0,0 +1,233 @@
+"""pytest_needle.engines.numpy_engine
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from collections import namedtuple
+import numpy
+from needle.engines.base import EngineBase
+from PIL import Image
+from pytest_needle.writer import get_variant_path, save_image
+
+
+#: Number of image rows compared at a time, keeps temporary arrays small for full page captures
+CHUNK_ROWS = 256
+
+ImageComparison = namedtuple('ImageComparison', ('distance', 'changed_pixels', 'total_pixels'))
+
+
+def get_image_array(image):
+    """Returns image as an uint8 array of shape (height, width, bands)
+
+    :param image: PIL image or file path
+    :return:
+    :rtype: numpy.ndarray
+    """
+
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    return numpy.asarray(image, dtype=numpy.uint8)
+
+
+def get_mask_array(mask):
+    """Returns comparison mask as a boolean array of shape (height, width), True for pixels that are compared
+
+    :param Image.Image mask: Mask, pixels where it is zero are left out
+    :return: Array, None if no mask is given
+    :rtype: numpy.ndarray
+    """
+
+    if mask is None:
+        return None
+
+    return numpy.asarray(mask.convert('L'), dtype=numpy.uint8) > 0
+
+
+def _iter_chunks(array_a, array_b, tolerance=0):
+    """Yields absolute per channel differences of both arrays, chunked by rows
+
+    :param numpy.ndarray array_a: Image array
+    :param numpy.ndarray array_b: Image array
+    :param int tolerance: Channel differences at or below tolerance are ignored
+    :return:
+    """
+
+    for top in range(0, array_a.shape[0], CHUNK_ROWS):
+
+        chunk_a = array_a[top:top + CHUNK_ROWS]
+        chunk_b = array_b[top:top + CHUNK_ROWS]
+
+        # max - min stays within uint8, no need to widen to a signed type
+        diff = numpy.maximum(chunk_a, chunk_b) - numpy.minimum(chunk_a, chunk_b)
+
+        if tolerance:
+            diff[diff <= tolerance] = 0
+
+        yield top, diff
+
+
+def compare_arrays(array_a, array_b, tolerance=0, mask=None):
+    """Compare two image arrays
+
+    The distance is the same as :meth:`needle.engines.pil_engine.ImageDiff.get_distance`, the sum of every channel
+    difference normalised by the number of bands and 255.
+
+    :param numpy.ndarray array_a: Image array
+    :param numpy.ndarray array_b: Image array
+    :param int tolerance: Channel differences at or below tolerance are ignored
+    :param numpy.ndarray mask: Boolean array, pixels where it is False are left out (Optional)
+    :return:
+    :rtype: ImageComparison
+    """
+
+    if array_a.shape != array_b.shape:
+        raise ValueError('Images have different sizes {} != {}'.format(array_a.shape[1::-1], array_b.shape[1::-1]))
+
+    bands = array_a.shape[2] if array_a.ndim > 2 else 1
+    total = 0
+    changed = 0
+
+    for top, diff in _iter_chunks(array_a, array_b, tolerance):
+
+        # Selecting the compared pixels flattens the chunk to (pixels, bands)
+        if mask is not None:
+            diff = diff[mask[top:top + CHUNK_ROWS]]
+
+        total += int(diff.sum(dtype=numpy.uint64))
+        changed += int(numpy.count_nonzero(diff.any(axis=-1) if diff.ndim > 1 and bands > 1 else diff))
+
+    pixels = array_a.shape[0] * array_a.shape[1] if mask is None else int(numpy.count_nonzero(mask))
+
+    return ImageComparison(total / float(bands * 255), changed, pixels)
+
+
+def get_diff_array(array_a, array_b, tolerance=0, mask=None):
+    """Returns a diff image array, changed pixels in red over a faded copy of the second image
+
+    :param numpy.ndarray array_a: Image array
+    :param numpy.ndarray array_b: Image array
+    :param int tolerance: Channel differences at or below tolerance are ignored
+    :param numpy.ndarray mask: Boolean array, changes where it is False are not highlighted (Optional)
+    :return:
+    :rtype: numpy.ndarray
+    """
+
+    output = numpy.empty(array_b.shape[:2] + (3,), dtype=numpy.uint8)
+
+    for top, diff in _iter_chunks(array_a, array_b, tolerance):
+
+        chunk = output[top:top + CHUNK_ROWS]
+        faded = array_b[top:top + CHUNK_ROWS].mean(axis=2, dtype=numpy.float32) / 4 + 191
+        chunk[...] = faded.astype(numpy.uint8)[..., None]
+        changed = diff.any(axis=2)
+
+        if mask is not None:
+            changed &= mask[top:top + CHUNK_ROWS]
+
+        chunk[changed] = (255, 0, 0)
+
+    return output
+
+
+class Engine(EngineBase):
+    """Vectorized in-process comparison engine
+    """
+
+    #: Channel differences at or below tolerance are ignored
+    tolerance = 0
+
+    #: get_distance accepts a mask of pixels to leave out
+    masks = True
+
+    def compare(self, image_a, image_b, mask=None):
+        """Compare two images
+
+        :param image_a: PIL image or file path
+        :param image_b: PIL image or file path
+        :param Image.Image mask: Pixels where the mask is zero are left out (Optional)
+        :return:
+        :rtype: ImageComparison
+        """
+
+        return compare_arrays(get_image_array(image_a), get_image_array(image_b), self.tolerance,
+                              get_mask_array(mask))
+
+    def get_distance(self, image_a, image_b, mask=None):
+        """Returns the distance between two images of the same size
+
+        :param image_a: PIL image or file path
+        :param image_b: PIL image or file path
+        :param Image.Image mask: Pixels where the mask is zero are left out (Optional)
+        :return:
+        :rtype: float
+        """
+
+        return self.compare(image_a, image_b, mask).distance
+
+    def get_diff_image(self, image_a, image_b, mask=None):
+        """Returns an image highlighting the differences between both images
+
+        :param image_a: PIL image or file path
+        :param image_b: PIL image or file path
+        :param Image.Image mask: Changes where the mask is zero are not highlighted (Optional)
+        :return:
+        :rtype: Image.Image
+        """
+
+        array = get_diff_array(get_image_array(image_a), get_image_array(image_b), self.tolerance,
+                               get_mask_array(mask))
+        return Image.fromarray(array, 'RGB')
+
+    def assertSameImages(self, output_image, baseline_image, threshold):  # pylint: disable=C0103
+        """Fail if the output image is too dissimilar from the baseline image
+
+        :param Image.Image output_image: Fresh image
+        :param Image.Image baseline_image: Baseline image
+        :param threshold: Distance threshold
+        :return:
+        """
+
+        try:
+            comparison = self.compare(output_image, baseline_image)
+
+        except ValueError as err:
+            raise AssertionError("The new screenshot did not match the baseline (%s)" % err)
+
+        if comparison.distance > threshold:
+            raise AssertionError("The new screenshot did not match the baseline "
+                                 "(by a distance of %.2f, %d of %d pixels changed)"
+                                 % (comparison.distance, comparison.changed_pixels, comparison.total_pixels))
+
+    def assertSameFiles(self, output_file, baseline_file, threshold):  # pylint: disable=C0103
+        """Fail if the output file is too dissimilar from the baseline file
+
+        :param str output_file: Fresh image path
+        :param str baseline_file: Baseline image path
+        :param threshold: Distance threshold
+        :return:
+        """
+
+        output_array = get_image_array(output_file)
+        baseline_array = get_image_array(baseline_file)
+
+        try:
+            comparison = compare_arrays(output_array, baseline_array, self.tolerance)
+
+        except ValueError as err:
+            raise AssertionError("The new screenshot '%s' did not match the baseline '%s' (%s)"
+                                 % (output_file, baseline_file, err))
+
+        if comparison.distance > threshold:
+
+            diff_file = get_variant_path(output_file, 'diff')
+            save_image(Image.fromarray(get_diff_array(output_array, baseline_array, self.tolerance), 'RGB'), diff_file)
+
+            raise AssertionError("The new screenshot '%s' did not match the baseline '%s' "
+                                 "(by a distance of %.2f, %d of %d pixels changed)"
+                                 % (output_file, baseline_file, comparison.distance,
+                                    comparison.changed_pixels, comparison.total_pixels))
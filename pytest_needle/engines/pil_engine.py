@@ -0,0 +1,53 @@
+"""pytest_needle.engines.pil_engine
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from needle.engines.pil_engine import Engine as PilEngine, ImageDiff
+from PIL import ImageChops
+
+
+class Engine(PilEngine):
+    """PIL engine that can also compare images already in memory
+    """
+
+    #: get_distance accepts a mask of pixels to leave out
+    masks = True
+
+    def get_distance(self, image_a, image_b, mask=None):  # pylint: disable=R0201
+        """Returns the distance between two images of the same size
+
+        :param Image.Image image_a: Image
+        :param Image.Image image_b: Image
+        :param Image.Image mask: Pixels where the mask is zero are left out (Optional)
+        :return:
+        :rtype: float
+        """
+
+        if mask is None:
+            return abs(ImageDiff(image_a, image_b).get_distance())
+
+        # Same distance as ImageDiff, from a histogram of the differences of the pixels the mask lets through
+        bands = len(image_a.getbands())
+        histogram = ImageChops.difference(image_a, image_b).histogram(mask)
+
+        return sum(index % 256 * count for index, count in enumerate(histogram)) / float(bands * 255)
+
+    def assertSameImages(self, output_image, baseline_image, threshold):  # pylint: disable=C0103
+        """Fail if the output image is too dissimilar from the baseline image
+
+        :param Image.Image output_image: Fresh image
+        :param Image.Image baseline_image: Baseline image
+        :param threshold: Distance threshold
+        :return:
+        """
+
+        if output_image.size != baseline_image.size:
+            raise AssertionError("The new screenshot did not match the baseline (sizes differ %s != %s)"
+                                 % (output_image.size, baseline_image.size))
+
+        distance = self.get_distance(output_image, baseline_image)
+
+        if distance > threshold:
+            raise AssertionError("The new screenshot did not match the baseline (by a distance of %.2f)" % distance)
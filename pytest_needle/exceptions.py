@@ -14,10 +14,11 @@ class ImageMismatchException(NeedleException):
     """Image mismatch exception
     """
 
-    def __init__(self, message, baseline_image, output_image, *args):
+    def __init__(self, message, baseline_image, output_image, *args, **kwargs):
 
         self.baseline_image = baseline_image
         self.output_image = output_image
+        self.changed_regions = kwargs.pop('changed_regions', [])
 
         super(ImageMismatchException, self).__init__(message, *args)
 
@@ -38,3 +39,18 @@ class MissingEngineException(NeedleException):
     def __init__(self, message, *args):
 
         super(MissingEngineException, self).__init__(message, *args)
+
+
+class MultipleFailuresException(NeedleException):
+    """Several screenshot assertions of a test failed
+    """
+
+    def __init__(self, exceptions, *args):
+
+        self.exceptions = list(exceptions)
+
+        message = '{} screenshot assertions failed:\n{}'.format(len(self.exceptions), '\n'.join(
+            '  {}{}'.format(exception, ' ({})'.format(exception.output_image) if hasattr(exception, 'output_image')
+                            else '') for exception in self.exceptions))
+
+        super(MultipleFailuresException, self).__init__(message, *args)
@@ -0,0 +1,148 @@
+"""pytest_needle.geometry
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from collections import namedtuple
+from selenium.webdriver.remote.webdriver import WebElement
+
+
+#: Resolves elements and selectors, returns their page rectangles along with window size, scroll offset and
+#: device pixel ratio. Scrolls the window first if a scroll position is given
+GEOMETRY_SCRIPT = """
+var targets = arguments[0] || [];
+var scrollTo = arguments[1];
+var origin = {'x': window.pageXOffset || 0, 'y': window.pageYOffset || 0};
+
+if (scrollTo) {
+    window.scrollTo(scrollTo[0], scrollTo[1]);
+}
+
+function find(by, value) {
+    var i, nodes;
+    switch (by) {
+        case 'id':
+            return document.getElementById(value);
+        case 'xpath':
+            return document.evaluate(value, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null)
+                .singleNodeValue;
+        case 'name':
+            return document.getElementsByName(value)[0] || null;
+        case 'tag name':
+            return document.getElementsByTagName(value)[0] || null;
+        case 'class name':
+            return document.getElementsByClassName(value)[0] || null;
+        case 'css selector':
+            return document.querySelector(value);
+        case 'link text':
+        case 'partial link text':
+            nodes = document.getElementsByTagName('a');
+            for (i = 0; i < nodes.length; i++) {
+                var text = (nodes[i].innerText || nodes[i].textContent || '').trim();
+                if (by === 'link text' ? text === value : text.indexOf(value) !== -1) {
+                    return nodes[i];
+                }
+            }
+            return null;
+    }
+    throw new Error('Unsupported selector strategy: ' + by);
+}
+
+var scrollX = window.pageXOffset || document.documentElement.scrollLeft || 0;
+var scrollY = window.pageYOffset || document.documentElement.scrollTop || 0;
+var elements = [];
+var rects = [];
+
+for (var i = 0; i < targets.length; i++) {
+    var element = Array.isArray(targets[i]) ? find(targets[i][0], targets[i][1]) : targets[i];
+    var rect = element ? element.getBoundingClientRect() : null;
+    elements.push(element);
+    rects.push(rect ? {
+        'left': rect.left + scrollX,
+        'top': rect.top + scrollY,
+        'width': rect.width,
+        'height': rect.height
+    } : null);
+}
+
+return {
+    'elements': elements,
+    'rects': rects,
+    'window': {'width': window.outerWidth, 'height': window.outerHeight},
+    'viewport': {'width': document.documentElement.clientWidth, 'height': window.innerHeight},
+    'document': {
+        'width': Math.max(document.documentElement.scrollWidth, document.body ? document.body.scrollWidth : 0),
+        'height': Math.max(document.documentElement.scrollHeight, document.body ? document.body.scrollHeight : 0)
+    },
+    'scroll': {'x': scrollX, 'y': scrollY},
+    'origin': origin,
+    'devicePixelRatio': window.devicePixelRatio || 1
+};
+"""
+
+Geometry = namedtuple('Geometry', ('elements', 'rects', 'window_size', 'viewport_size', 'document_size', 'scroll',
+                                   'scroll_origin', 'device_pixel_ratio'))
+
+
+def _get_rect(rect):
+    """Returns the two points that define a rectangle, rounded the same way as element location and size
+
+    :param dict rect: Rectangle with left, top, width and height
+    :return:
+    :rtype: tuple
+    """
+
+    if not rect:
+        return None
+
+    left, top = int(rect['left']), int(rect['top'])
+    return left, top, left + int(rect['width']), top + int(rect['height'])
+
+
+def _get_size(size):
+    """Returns width and height as a tuple
+
+    :param dict size: Size with width and height
+    :return:
+    :rtype: tuple
+    """
+
+    return int(size['width']), int(size['height'])
+
+
+def resolve_geometry(driver, targets=None, scroll_to=None):
+    """Resolve elements and selectors along with window geometry in a single WebDriver command
+
+    :param driver: Selenium web driver
+    :param list targets: WebElements or tuples containing selectors ex. ('id', 'mainPage')
+    :param tuple scroll_to: Scroll window to x, y before resolving (Optional)
+    :return:
+    :rtype: Geometry
+    """
+
+    arguments = []
+
+    for target in targets or []:
+
+        if isinstance(target, WebElement):
+            arguments.append(target)
+
+        elif isinstance(target, tuple):
+            arguments.append(list(target))
+
+        else:
+            raise ValueError("element_or_selector must be a WebElement or tuple selector")
+
+    result = driver.execute_script(GEOMETRY_SCRIPT, arguments, list(scroll_to) if scroll_to else None)
+
+    return Geometry(
+        elements=result['elements'],
+        rects=[_get_rect(rect) for rect in result['rects']],
+        window_size=_get_size(result['window']),
+        viewport_size=_get_size(result['viewport']),
+        document_size=_get_size(result['document']),
+        scroll=(int(result['scroll']['x']), int(result['scroll']['y'])),
+        scroll_origin=(int(result['origin']['x']), int(result['origin']['y'])),
+        device_pixel_ratio=float(result['devicePixelRatio'])
+    )
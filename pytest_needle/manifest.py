@@ -0,0 +1,269 @@
+"""pytest_needle.manifest
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+import json
+import os
+import threading
+from pytest_needle.cache import get_file_signature
+from pytest_needle.writer import replace_file
+
+
+MANIFEST_FILE = '.needle-manifest.json'
+
+
+class BaselineManifest(object):  # pylint: disable=R0205
+    """Maps each baseline image in a directory to the hash of its decoded pixel data
+
+    Entries record the baseline file's modification time and size, an entry is ignored once the file changes.
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE)
+
+        self._entries = None
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        """Returns manifest entries, loaded from disk on first access
+
+        :return:
+        :rtype: dict
+        """
+
+        if self._entries is None:
+            self._entries = self._read()
+
+        return self._entries
+
+    def _read(self):
+        """Read manifest from disk
+
+        :return:
+        :rtype: dict
+        """
+
+        try:
+            with open(self.path) as manifest:
+                entries = json.load(manifest)
+
+        except (EnvironmentError, ValueError):
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+    def _get_entry(self, name):
+        """Returns manifest entry of a baseline, None if missing or stale
+
+        :param str name: Baseline file name, relative to the manifest's directory
+        :return:
+        :rtype: dict
+        """
+
+        entry = self.entries.get(name)
+
+        if not entry:
+            return None
+
+        try:
+            signature = get_file_signature(os.path.join(self.directory, name))
+
+        except EnvironmentError:
+            return None
+
+        if [entry.get('mtime'), entry.get('size')] != list(signature):
+            return None
+
+        return entry
+
+    def get(self, name):
+        """Returns pixel hash of a baseline, None if missing or stale
+
+        :param str name: Baseline file name, relative to the manifest's directory
+        :return:
+        :rtype: str
+        """
+
+        entry = self._get_entry(name)
+        return entry.get('hash') if entry else None
+
+    @property
+    def hashes(self):
+        """Returns pixel hashes of all baselines whose entries are not stale
+
+        :return:
+        :rtype: set
+        """
+
+        return set(digest for digest in (self.get(name) for name in list(self.entries)) if digest)
+
+    def get_tiles(self, name, tile_size):
+        """Returns tile hashes of a baseline, None if missing or stale
+
+        :param str name: Baseline file name, relative to the manifest's directory
+        :param int tile_size: Tile width and height
+        :return:
+        :rtype: list
+        """
+
+        entry = self._get_entry(name)
+        return entry.get('tiles', {}).get(str(tile_size)) if entry else None
+
+    def update(self, name, digest):
+        """Record pixel hash of a baseline
+
+        :param str name: Baseline file name, relative to the manifest's directory
+        :param str digest: Pixel hash
+        :return:
+        """
+
+        mtime, size = get_file_signature(os.path.join(self.directory, name))
+        entry = {'hash': digest, 'mtime': mtime, 'size': size}
+
+        with self._lock:
+            self.entries[name] = entry
+            self._updated[name] = entry
+
+    def update_tiles(self, name, tile_size, hashes):
+        """Record tile hashes of a baseline, the baseline's pixel hash must have been recorded
+
+        :param str name: Baseline file name, relative to the manifest's directory
+        :param int tile_size: Tile width and height
+        :param list hashes: Tile hashes
+        :return:
+        """
+
+        entry = self._get_entry(name)
+
+        if not entry:
+            return
+
+        with self._lock:
+            entry.setdefault('tiles', {})[str(tile_size)] = hashes
+            self._updated[name] = entry
+
+    @property
+    def updates(self):
+        """Returns entries updated since the manifest was last saved
+
+        :return:
+        :rtype: dict
+        """
+
+        with self._lock:
+            return dict(self._updated)
+
+    def add_updates(self, entries):
+        """Add entries updated by another process, written on the next save
+
+        :param dict entries: Manifest entries by baseline file name
+        :return:
+        """
+
+        with self._lock:
+            self.entries.update(entries)
+            self._updated.update(entries)
+
+    def save(self):
+        """Write updated entries to disk, merged with entries written since the manifest was read
+
+        :return:
+        """
+
+        with self._lock:
+
+            if not self._updated:
+                return
+
+            entries = self._read()
+            entries.update(self._updated)
+
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+
+            with open(temp_path, 'w') as manifest:
+                json.dump(entries, manifest, indent=2, sort_keys=True)
+
+            replace_file(temp_path, self.path)
+            self._updated = {}
+
+
+class ManifestStore(object):  # pylint: disable=R0205
+    """Baseline manifests of a session, one per baseline directory
+    """
+
+    def __init__(self):
+
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def get(self, directory):
+        """Returns manifest for a baseline directory
+
+        :param str directory: Baseline directory
+        :return:
+        :rtype: BaselineManifest
+        """
+
+        directory = os.path.realpath(directory)
+
+        with self._lock:
+
+            if directory not in self._manifests:
+                self._manifests[directory] = BaselineManifest(directory)
+
+            return self._manifests[directory]
+
+    def get_updates(self):
+        """Returns entries updated since the manifests were last saved, by baseline directory
+
+        :return:
+        :rtype: dict
+        """
+
+        return dict((directory, manifest.updates) for directory, manifest in list(self._manifests.items())
+                    if manifest.updates)
+
+    def add_updates(self, updates):
+        """Add entries updated by another process, ex. a pytest-xdist worker
+
+        :param dict updates: Manifest entries by baseline directory, as returned by :meth:`get_updates`
+        :return:
+        """
+
+        for directory, entries in updates.items():
+            self.get(directory).add_updates(entries)
+
+    def save(self):
+        """Write all manifests to disk
+
+        :return:
+        """
+
+        for manifest in list(self._manifests.values()):
+
+            if os.path.isdir(manifest.directory):
+                manifest.save()
+
+
+def get_manifest_hashes(directory):
+    """Returns pixel hashes recorded in the manifests of a directory and its subdirectories
+
+    :param str directory: Baseline directory
+    :return:
+    :rtype: set
+    """
+
+    hashes = set()
+
+    for path, _, files in os.walk(directory):
+
+        if MANIFEST_FILE in files:
+            hashes.update(BaselineManifest(path).hashes)
+
+    return hashes
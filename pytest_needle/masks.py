@@ -0,0 +1,87 @@
+"""pytest_needle.masks
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from PIL import Image, ImageDraw
+
+
+def get_image_box(rect, ratio, offset, size):
+    """Returns the image box of a page rectangle, clipped to the image
+
+    :param tuple rect: Page rectangle (left, top, right, bottom), None if the element was not found
+    :param ratio: Image pixels per page pixel
+    :param tuple offset: Page position of the image's top left corner
+    :param tuple size: Image width and height
+    :return: Box, None if the rectangle is missing or outside the image
+    :rtype: tuple
+    """
+
+    if not rect:
+        return None
+
+    box = [(point - offset[index % 2]) * ratio for index, point in enumerate(rect)]
+    box = (max(box[0], 0), max(box[1], 0), min(box[2], size[0]), min(box[3], size[1]))
+
+    return box if box[0] < box[2] and box[1] < box[3] else None
+
+
+def get_mask(size, boxes):
+    """Returns a comparison mask, pixels inside the boxes are zero and left out of comparisons
+
+    Only the mask is drawn, the images it is applied to are never copied or painted.
+
+    :param tuple size: Image width and height
+    :param list boxes: Boxes to leave out, None entries are skipped
+    :return: Mask, None if there is nothing to leave out
+    :rtype: Image.Image
+    """
+
+    boxes = [box for box in boxes if box]
+
+    if not boxes:
+        return None
+
+    mask = Image.new('L', size, 255)
+    canvas = ImageDraw.Draw(mask)
+
+    for box in boxes:
+        # Rectangles include their right and bottom edges, boxes do not
+        canvas.rectangle((box[0], box[1], box[2] - 1, box[3] - 1), fill=0)
+
+    del canvas
+    return mask
+
+
+def compare_regions(engine, image_a, image_b, ignore=None, regions=None):
+    """Compare two images of the same size, leaving out ignored boxes, named regions are compared on their own
+
+    Pixels of named regions only count towards the distance of their region, ignored boxes count towards none.
+
+    :param engine: Image processing engine whose get_distance accepts a mask
+    :param Image.Image image_a: Image
+    :param Image.Image image_b: Image
+    :param list ignore: Boxes to leave out
+    :param dict regions: Boxes of named regions
+    :return: Distance outside named regions and distances of named regions by name
+    :rtype: tuple
+    """
+
+    ignore = [box for box in ignore or [] if box]
+    regions = regions or {}
+
+    distance = engine.get_distance(image_a, image_b, mask=get_mask(image_a.size, ignore + list(regions.values())))
+    distances = {}
+
+    for name, box in regions.items():
+
+        # Ignored boxes relative to the region
+        inside = [(left - box[0], top - box[1], right - box[0], bottom - box[1])
+                  for left, top, right, bottom in ignore if left < box[2] and right > box[0] and top < box[3] and
+                  bottom > box[1]]
+
+        distances[name] = engine.get_distance(image_a.crop(box), image_b.crop(box),
+                                              mask=get_mask((box[2] - box[0], box[3] - box[1]), inside))
+
+    return distance, distances
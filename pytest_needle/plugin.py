@@ -6,11 +6,41 @@
 
 from __future__ import absolute_import
 import base64
+from io import BytesIO
 import os
+import shutil
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
 import pytest
+from PIL import Image
+from pytest_needle.cache import BaselineCache, SharedBaselineStore
+from pytest_needle.deferred import DeferredComparisons
 from pytest_needle.driver import DEFAULT_BASELINE_DIR, DEFAULT_OUTPUT_DIR, DEFAULT_ENGINE, \
-    DEFAULT_VIEWPORT_SIZE, NeedleDriver
-from pytest_needle.exceptions import ImageMismatchException
+    DEFAULT_VIEWPORT_SIZE, DEFAULT_CAPTURE_STRATEGY, DEFAULT_STABLE_TIMEOUT, NeedleDriver
+from pytest_needle.engines import EngineRegistry
+from pytest_needle.exceptions import ImageMismatchException, MultipleFailuresException
+from pytest_needle.manifest import ManifestStore, get_manifest_hashes
+from pytest_needle.pyramid import PYRAMID_DIR, PyramidCache, prune_pyramid
+from pytest_needle.recompare import recompare
+from pytest_needle.store import STORE_FILE, BaselineStore, BaselineStores
+from pytest_needle.window import WindowTracker
+from pytest_needle.writer import DEFAULT_IMAGE_FORMAT, DEFAULT_PNG_COMPRESS_LEVEL, DEFAULT_WEBP_METHOD, IMAGE_FORMATS, \
+    ImageFormat, ImageWriter, get_variant_path
+
+
+DEFAULT_BASELINE_CACHE_MB = 256
+DEFAULT_DURATIONS = 5
+
+DEFAULT_REPORT_THUMBNAIL_SIZE = 240
+
+# Image formats browsers display, others are converted to PNG for HTML reports
+BROWSER_FORMATS = ('png', 'webp')
+
+# How images are attached to HTML reports: embedded in full, or as thumbnails linking to the files on disk
+REPORT_MODES = ('embed', 'link')
+
+# Assertion stages in the order they usually run
+STAGES = ('geometry', 'capture', 'decode', 'mask', 'hash', 'baseline', 'pyramid', 'compare', 'defer', 'write')
 
 
 def pytest_addoption(parser):
@@ -24,25 +54,561 @@ def pytest_addoption(parser):
     group.addoption('--needle-cleanup-on-success', action='store_true',
                     help='destroy all non-baseline screenshots')
 
+    group.addoption('--needle-keep-on-success', action='store_true',
+                    help='write fresh screenshots to disk even if they match the baseline')
+
     group.addoption('--needle-save-baseline', action='store_true',
                     help='save baseline screenshots to disk')
 
+    group.addoption('--needle-save-baseline-threshold', action='store', dest='save_baseline_threshold',
+                    metavar='distance', type=float, default=0,
+                    help='when saving baselines, keep existing baselines the new screenshots are within this distance '
+                         'of (by default only identical baselines are kept)')
+
     group.addoption('--needle-engine', action='store', dest='needle_engine', metavar='engine',
-                    default=DEFAULT_ENGINE, help='engine for compare screenshots')
+                    default=DEFAULT_ENGINE, help='engine for compare screenshots: pil, imagemagick, perceptualdiff, '
+                                                 'numpy, an engine registered under the pytest_needle.engines '
+                                                 'entry point group or a dotted path to an engine class')
+
+    group.addoption('--needle-tolerance', action='store', dest='needle_tolerance', metavar='value', type=int,
+                    default=0, help='per channel difference to ignore (numpy engine only)')
+
+    group.addoption('--needle-tile-size', action='store', dest='needle_tile_size', metavar='pixels', type=int,
+                    default=0, help='compare images in tiles of this size, only tiles whose hashes differ are '
+                                    'compared (PIL and NumPy engines only, 0 to compare whole images)')
 
     group.addoption('--needle-baseline-dir', action='store', dest='baseline_dir',
                     metavar='dir', default=DEFAULT_BASELINE_DIR,
                     help='where to store baseline images')
 
+    group.addoption('--needle-baseline-store', action='store_true',
+                    help='store baselines in a single deduplicated SQLite file ({}) inside the baseline directory, '
+                         'instead of one PNG file each'.format(STORE_FILE))
+
     group.addoption('--needle-output-dir', action='store', dest='output_dir',
                     metavar='dir', default=DEFAULT_OUTPUT_DIR,
                     help='where to store baseline images')
 
+    group.addoption('--needle-baseline-format', action='store', dest='baseline_format', metavar='format',
+                    default=DEFAULT_IMAGE_FORMAT, choices=sorted(IMAGE_FORMATS),
+                    help='format baseline images are written in: png, lossless webp or raw (uncompressed PPM)')
+
+    group.addoption('--needle-output-format', action='store', dest='output_format', metavar='format',
+                    default=DEFAULT_IMAGE_FORMAT, choices=sorted(IMAGE_FORMATS),
+                    help='format fresh and diff images are written in: png, lossless webp or raw (uncompressed PPM)')
+
+    group.addoption('--needle-png-compress-level', action='store', dest='png_compress_level', metavar='level',
+                    type=int, default=DEFAULT_PNG_COMPRESS_LEVEL, choices=range(10),
+                    help='zlib compression level PNG images are written with, 0 (fastest) to 9 (smallest)')
+
+    group.addoption('--needle-webp-method', action='store', dest='webp_method', metavar='method', type=int,
+                    default=DEFAULT_WEBP_METHOD, choices=range(7),
+                    help='method lossless WebP images are written with, 0 (fastest) to 6 (smallest)')
+
+    group.addoption('--needle-capture-strategy', action='store', dest='capture_strategy', metavar='strategy',
+                    default=DEFAULT_CAPTURE_STRATEGY, choices=sorted(NeedleDriver.CAPTURE_STRATEGIES),
+                    help='how element screenshots are captured: crop the viewport (crop), capture only the element '
+                         'using a clip-capable command (clip) or WebElement screenshots (element), or the first '
+                         'supported of those (auto)')
+
+    group.addoption('--needle-full-page-bands', action='store_true',
+                    help='compare full page screenshots one viewport band at a time, '
+                         'without stitching the fresh screenshot together')
+
+    group.addoption('--needle-baseline-cache-mb', action='store', dest='baseline_cache_mb', metavar='megabytes',
+                    type=float, default=DEFAULT_BASELINE_CACHE_MB,
+                    help='memory budget for decoded baseline images shared by all tests, also the most pixel data '
+                         'pytest-xdist workers share through a temporary directory, 0 to disable')
+
+    group.addoption('--needle-writer-threads', action='store', dest='writer_threads', metavar='threads', type=int,
+                    default=0, help='encode and write screenshots on this many background threads, '
+                                    '0 to write them synchronously')
+
+    group.addoption('--needle-pyramid', action='store_true',
+                    help='compare downscaled screenshots first and fail without a full resolution comparison when they '
+                         'already differ by more than the threshold, downscaled baselines are cached in {} inside the '
+                         'baseline directory'.format(PYRAMID_DIR))
+
+    group.addoption('--needle-stable-frames', action='store', dest='stable_frames', metavar='frames', type=int,
+                    default=0, help='capture until this many consecutive screenshots are identical before comparing, '
+                                    'for pages with animations or late loading content (0 to disable)')
+
+    group.addoption('--needle-stable-timeout', action='store', dest='stable_timeout', metavar='seconds', type=float,
+                    default=DEFAULT_STABLE_TIMEOUT, help='longest time to wait for --needle-stable-frames, the last '
+                                                         'screenshot is compared after that')
+
+    group.addoption('--needle-deferred-compare', action='store_true',
+                    help='compare screenshots in worker processes while the test continues, failures are reported '
+                         'when the test finishes')
+
+    group.addoption('--needle-compare-processes', action='store', dest='compare_processes', metavar='processes',
+                    type=int, default=0, help='number of worker processes for deferred comparisons, '
+                                              '0 for one per CPU')
+
+    group.addoption('--needle-recompare', action='store_true',
+                    help='compare the fresh screenshots in the output directory against their baselines again, '
+                         'in parallel and without running any tests')
+
+    group.addoption('--needle-recompare-threshold', action='store', dest='recompare_threshold', metavar='distance',
+                    type=float, default=0, help='distance threshold for --needle-recompare')
+
+    group.addoption('--needle-durations', action='store', dest='needle_durations', metavar='N', type=int,
+                    default=DEFAULT_DURATIONS, help='show the N slowest screenshot assertions, 0 to hide them')
+
+    group.addoption('--needle-report-mode', action='store', dest='report_mode', metavar='mode',
+                    default=REPORT_MODES[0], choices=REPORT_MODES,
+                    help='how mismatching images are attached to pytest-html reports: embed them in full (embed) or '
+                         'embed thumbnails linking to the images on disk (link)')
+
+    group.addoption('--needle-report-thumbnail-size', action='store', dest='report_thumbnail_size', metavar='pixels',
+                    type=int, default=DEFAULT_REPORT_THUMBNAIL_SIZE,
+                    help='largest width or height of thumbnails in --needle-report-mode link')
+
+    group.addoption('--needle-report-max-mb', action='store', dest='report_max_mb', metavar='megabytes', type=float,
+                    default=0, help='most image data to embed in pytest-html reports, split evenly between '
+                                    'pytest-xdist workers, images past it are only linked (0 for no limit)')
+
     group.addoption('--needle-viewport-size', action='store', dest='viewport_size',
                     metavar='pixels', default=DEFAULT_VIEWPORT_SIZE,
                     help='size of window width (px) x height (px)')
 
 
+def pytest_cmdline_main(config):
+    """Run --needle-recompare instead of the test session
+
+    :param config: pytest config
+    :return: Exit code, if recomparing
+    """
+
+    if not config.getoption('needle_recompare'):
+        return None
+
+    engine_registry = EngineRegistry()
+
+    try:
+        engine_registry.get_class(config.getoption('needle_engine'))
+
+    except (ImportError, AttributeError, ValueError) as err:
+        raise pytest.UsageError("--needle-engine: {}".format(err))
+
+    return recompare(config.getoption('output_dir'), config.getoption('baseline_dir'),
+                     engine_registry.get_path(config.getoption('needle_engine')),
+                     config.getoption('needle_tolerance'), config.getoption('recompare_threshold'),
+                     config.getoption('compare_processes'), store=config.getoption('needle_baseline_store'),
+                     baseline_format=config.getoption('baseline_format'))
+
+
+def is_worker(config):
+    """True, if running in a pytest-xdist worker
+
+    :param config: pytest config
+    :return:
+    """
+
+    return hasattr(config, 'workerinput')
+
+
+def pytest_configure(config):
+    """Create session wide state
+
+    :param config: pytest config
+    :return:
+    """
+
+    config.addinivalue_line('markers', 'needle_viewport(size): viewport size for the test, ex. 800x600')
+
+    config._needle_engine_registry = EngineRegistry()
+
+    # Fail early on an unknown engine, instead of at the first comparison
+    try:
+        config._needle_engine_registry.get_class(config.getoption('needle_engine'))
+
+    except (ImportError, AttributeError, ValueError) as err:
+        raise pytest.UsageError("--needle-engine: {}".format(err))
+
+    # pytest-xdist workers share decoded baselines through a directory created by the controller
+    shared_dir = config.workerinput.get('needle_shared_dir') if is_worker(config) else None
+
+    cache_bytes = int(config.getoption('baseline_cache_mb') * 1024 * 1024)
+
+    config._needle_shared_dir = None
+    config._needle_baseline_cache = BaselineCache(cache_bytes,
+                                                  SharedBaselineStore(shared_dir, cache_bytes) if shared_dir else None)
+    config._needle_manifests = ManifestStore()
+    config._needle_writer = ImageWriter(config.getoption('writer_threads'))
+    config._needle_compare_pool = DeferredComparisons(config.getoption('compare_processes'))
+    config._needle_window_tracker = WindowTracker()
+    config._needle_pyramid_cache = PyramidCache()
+    config._needle_baseline_stores = BaselineStores() if config.getoption('needle_baseline_store') else None
+    config._needle_assertions = []
+    config._needle_report_bytes = 0
+
+    # pytest-xdist workers each embed their share of the report image budget
+    config._needle_report_max_bytes = int(config.getoption('report_max_mb') * 1024 * 1024 /
+                                          (config.workerinput.get('workercount', 1) if is_worker(config) else 1))
+    config._needle_worker_stats = []
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    """Pass the shared baseline directory to a pytest-xdist worker
+
+    :param node: pytest-xdist worker node
+    :return:
+    """
+
+    config = node.config
+
+    if config._needle_shared_dir is None:
+        config._needle_shared_dir = tempfile.mkdtemp(prefix='needle-')
+
+    node.workerinput['needle_shared_dir'] = config._needle_shared_dir
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):  # pylint: disable=W0613
+    """Collect statistics and baseline manifest entries of a finished pytest-xdist worker
+
+    :param node: pytest-xdist worker node
+    :param error: Worker error, if it crashed
+    :return:
+    """
+
+    output = getattr(node, 'workeroutput', {}).get('needle')
+
+    if not output:
+        return
+
+    node.config._needle_worker_stats.append(output['stats'])
+    node.config._needle_manifests.add_updates(output['manifests'])
+    node.config._needle_pyramid_cache.add_baseline_updates(output['baselines'])
+
+
+def get_session_stats(config):
+    """Returns needle statistics of this process
+
+    :param config: pytest config
+    :return:
+    :rtype: dict
+    """
+
+    cache = getattr(config, '_needle_baseline_cache', None)
+    compare_pool = getattr(config, '_needle_compare_pool', None)
+    window_tracker = getattr(config, '_needle_window_tracker', None)
+    pyramid_cache = getattr(config, '_needle_pyramid_cache', None)
+    writer = getattr(config, '_needle_writer', None)
+
+    return {
+        'assertions': getattr(config, '_needle_assertions', []),
+        'cache': cache.stats if cache is not None else None,
+        'deferred': compare_pool.submitted if compare_pool is not None else 0,
+        'window': window_tracker.stats if window_tracker is not None else None,
+        'pyramid': pyramid_cache.stats if pyramid_cache is not None else None,
+        'writer_errors': [[file_path, str(err)] for file_path, err in writer.errors] if writer is not None else []
+    }
+
+
+def merge_session_stats(stats):
+    """Returns needle statistics of several processes added together
+
+    :param list stats: Statistics as returned by :func:`get_session_stats`
+    :return:
+    :rtype: dict
+    """
+
+    merged = {'assertions': [], 'cache': None, 'deferred': 0, 'window': None, 'pyramid': None, 'writer_errors': []}
+
+    for process_stats in stats:
+
+        merged['assertions'].extend(process_stats['assertions'])
+        merged['deferred'] += process_stats['deferred']
+        merged['writer_errors'].extend(process_stats['writer_errors'])
+
+        # Counters are added together
+        for name in ('cache', 'window', 'pyramid'):
+
+            if process_stats.get(name) is None:
+                continue
+
+            if merged[name] is None:
+                merged[name] = dict(process_stats[name])
+
+            else:
+                for key, value in process_stats[name].items():
+                    merged[name][key] = merged[name].get(key, 0) + value
+
+    return merged
+
+
+def pytest_sessionfinish(session):
+    """Write session wide state to disk
+
+    :param session: pytest session
+    :return:
+    """
+
+    config = session.config
+    compare_pool = getattr(config, '_needle_compare_pool', None)
+
+    if compare_pool is not None:
+        compare_pool.shutdown()
+
+    writer = getattr(config, '_needle_writer', None)
+
+    # Manifest entries of baselines are recorded once their images are written
+    if writer is not None:
+        writer.close()
+
+    baseline_stores = getattr(config, '_needle_baseline_stores', None)
+
+    if baseline_stores is not None:
+        baseline_stores.close()
+
+    manifests = getattr(config, '_needle_manifests', None)
+
+    # Workers hand their statistics and manifest entries to the controller, which writes the manifests once
+    if is_worker(config):
+
+        if manifests is not None:
+            config.workeroutput['needle'] = {'stats': get_session_stats(config), 'manifests': manifests.get_updates(),
+                                             'baselines': config._needle_pyramid_cache.baseline_updates}
+
+        return
+
+    stats = merge_session_stats(getattr(config, '_needle_worker_stats', None) or [get_session_stats(config)])
+
+    if stats['writer_errors'] and session.exitstatus == 0:
+        session.exitstatus = 1
+
+    if manifests is not None:
+        manifests.save()
+
+    pyramid_cache = getattr(config, '_needle_pyramid_cache', None)
+
+    # Saving baselines leaves downscaled levels of rewritten baselines behind, unless another baseline still has them
+    if pyramid_cache is not None and pyramid_cache.stale and \
+            os.path.isdir(os.path.join(config.getoption('baseline_dir'), PYRAMID_DIR)):
+        prune_pyramid(config.getoption('baseline_dir'), pyramid_cache.stale - get_baseline_hashes(config))
+
+    if getattr(config, '_needle_shared_dir', None):
+        shutil.rmtree(config._needle_shared_dir, ignore_errors=True)
+
+
+def get_baseline_hashes(config):
+    """Returns pixel hashes of all baselines, from the baseline store or the manifests of the baseline directory
+
+    :param config: pytest config
+    :return:
+    :rtype: set
+    """
+
+    baseline_dir = config.getoption('baseline_dir')
+
+    if not config.getoption('needle_baseline_store'):
+        return get_manifest_hashes(baseline_dir)
+
+    store = BaselineStore(os.path.join(baseline_dir, STORE_FILE))
+
+    try:
+        return store.hashes()
+
+    finally:
+        store.close()
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Print needle statistics, of all pytest-xdist workers when distributed
+
+    :param terminalreporter: pytest terminal reporter
+    :return:
+    """
+
+    config = terminalreporter.config
+    lines = []
+
+    if is_worker(config):
+        return
+
+    # The controller of a distributed session runs no tests itself
+    worker_stats = getattr(config, '_needle_worker_stats', [])
+    stats = merge_session_stats(worker_stats or [get_session_stats(config)])
+    assertions = stats['assertions']
+
+    if assertions:
+        commands = sum(assertion['webdriver_commands'] for assertion in assertions)
+        lines.append('{} assertions issued {} WebDriver commands ({:.1f} per assertion)'.format(
+            len(assertions), commands, commands / float(len(assertions))))
+
+        if worker_stats:
+            lines.append('{:.2f}s spent in assertions across {} workers'.format(
+                sum(assertion.get('duration', 0) for assertion in assertions), len(worker_stats)))
+
+        stages = {}
+
+        for assertion in assertions:
+            for stage, seconds in assertion.get('timings', {}).items():
+                stages[stage] = stages.get(stage, 0) + seconds
+
+        if stages:
+            lines.append('time per stage: ' + ', '.join(
+                '{} {:.2f}s'.format(stage, stages[stage]) for stage in sorted(stages, key=get_stage_index)))
+
+        durations = config.getoption('needle_durations')
+
+        if durations:
+            lines.append('slowest {} assertions:'.format(min(durations, len(assertions))))
+            lines.extend('  {}'.format(format_assertion(assertion)) for assertion in sorted(
+                assertions, key=lambda assertion: assertion.get('duration', 0), reverse=True)[:durations])
+
+        largest = max(assertions, key=lambda assertion: assertion.get('peak_memory', 0))
+
+        if largest.get('peak_memory'):
+            lines.append('largest capture held an estimated {:.1f} MB at once ({})'.format(
+                largest['peak_memory'] / 1048576.0, largest['name']))
+
+        updates = {}
+
+        for assertion in assertions:
+            if assertion.get('baseline_update'):
+                updates[assertion['baseline_update']] = updates.get(assertion['baseline_update'], 0) + 1
+
+        if updates:
+            lines.append('baselines: {} written, {} unchanged and skipped, {} new'.format(
+                updates.get('written', 0), updates.get('skipped', 0), updates.get('new', 0)))
+
+        stabilized = [assertion for assertion in assertions if 'stable_frames' in assertion]
+
+        if stabilized:
+            lines.append('{} assertions waited for stable screenshots: {} captures in {:.2f}s, {} timed out'.format(
+                len(stabilized), sum(assertion['stable_frames'] for assertion in stabilized),
+                sum(assertion['stable_time'] for assertion in stabilized),
+                sum(1 for assertion in stabilized if not assertion['settled'])))
+
+        strategies = {}
+
+        for assertion in assertions:
+            if assertion.get('capture_strategy'):
+                strategies[assertion['capture_strategy']] = strategies.get(assertion['capture_strategy'], 0) + 1
+
+        if strategies:
+            lines.append('capture strategies: ' + ', '.join(
+                '{} {}'.format(strategy, count) for strategy, count in sorted(strategies.items())))
+
+    if stats['deferred']:
+        lines.append('{} comparisons deferred to worker processes'.format(stats['deferred']))
+
+    if stats['writer_errors']:
+        lines.append('{} images could not be written:'.format(len(stats['writer_errors'])))
+        lines.extend('  {}: {}'.format(file_path, err) for file_path, err in stats['writer_errors'])
+
+    cache = stats['cache']
+
+    if cache is not None and (cache['hits'] or cache['misses']):
+        lines.append('baseline cache: {hits} hits, {misses} misses, {evictions} evictions, '
+                     '{entries} entries using {mb:.1f} of {max_mb:.1f} MB'.format(
+                         mb=cache['bytes'] / 1048576.0, max_mb=cache['max_bytes'] / 1048576.0, **cache))
+
+        if cache['shared_hits']:
+            lines.append('{} baselines decoded by another worker'.format(cache['shared_hits']))
+
+    window = stats['window']
+
+    if window is not None and window['skipped']:
+        lines.append('{skipped} of {total} window position and size commands skipped, the window was already '
+                     'set up'.format(total=window['applied'] + window['skipped'], **window))
+
+    pyramid = stats['pyramid']
+
+    if pyramid is not None and (pyramid['failed_fast'] or pyramid['escalated']):
+        lines.append('{failed_fast} of {total} pyramid comparisons failed on downscaled images, {hits} downscaled '
+                     'baselines reused, {misses} built'.format(total=pyramid['failed_fast'] + pyramid['escalated'],
+                                                               **pyramid))
+
+    if not lines:
+        return
+
+    terminalreporter.write_sep('-', 'needle')
+
+    for line in lines:
+        terminalreporter.write_line(line)
+
+
+def get_stage_index(stage):
+    """Returns sort key of an assertion stage, unknown stages go last
+
+    :param str stage: Stage name
+    :return:
+    :rtype: int
+    """
+
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+def format_assertion(assertion):
+    """Format duration, stage timings and screenshot size of an assertion
+
+    :param dict assertion: Assertion statistics
+    :return:
+    :rtype: str
+    """
+
+    timings = assertion.get('timings', {})
+
+    return '{:.3f}s {} ({}; {:.1f} KB screenshots, {:.1f} MB peak)'.format(
+        assertion.get('duration', 0), assertion['name'],
+        ', '.join('{} {:.3f}s'.format(stage, timings[stage]) for stage in sorted(timings, key=get_stage_index)),
+        assertion.get('screenshot_bytes', 0) / 1024.0, assertion.get('peak_memory', 0) / 1048576.0)
+
+
+def get_user_properties(assertions):
+    """Returns test report properties with the timings of assertions, for JUnit XML reports
+
+    :param list assertions: Assertion statistics
+    :return:
+    :rtype: list
+    """
+
+    properties = []
+
+    for assertion in assertions:
+
+        prefix = 'needle.{}.'.format(assertion['name'])
+
+        properties.append((prefix + 'duration', '{:.6f}'.format(assertion.get('duration', 0))))
+        properties.extend((prefix + stage, '{:.6f}'.format(seconds))
+                          for stage, seconds in sorted(assertion.get('timings', {}).items()))
+        properties.append((prefix + 'screenshot_bytes', assertion.get('screenshot_bytes', 0)))
+        properties.append((prefix + 'peak_memory', assertion.get('peak_memory', 0)))
+
+        if 'stable_frames' in assertion:
+            properties.append((prefix + 'stable_frames', assertion['stable_frames']))
+            properties.append((prefix + 'stable_time', '{:.6f}'.format(assertion['stable_time'])))
+
+    return properties
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_call(item):
+    """Fail the test with the failures of its deferred comparisons, once the test function has passed
+
+    :param item: pytest item
+    :return:
+    """
+
+    driver = getattr(item, '_needle_driver', None)
+
+    if driver is None:
+        return
+
+    failures = driver.collect_deferred()
+
+    if len(failures) == 1:
+        raise failures[0]
+
+    if failures:
+        raise MultipleFailuresException(failures)
+
+
 @pytest.mark.hookwrapper
 def pytest_runtest_makereport(item, call):
     """Add image diff to report
@@ -60,10 +626,11 @@ def pytest_runtest_makereport(item, call):
     if not (is_failure(report) and call.excinfo):
         return
 
-    exception = call.excinfo.value
+    exceptions = [exception for exception in getattr(call.excinfo.value, 'exceptions', [call.excinfo.value])
+                  if isinstance(exception, ImageMismatchException)]
 
     # Only capture screenshots if they did not match
-    if not isinstance(exception, ImageMismatchException):
+    if not exceptions:
         return
 
     pytest_html = item.config.pluginmanager.getplugin('html')
@@ -72,20 +639,88 @@ def pytest_runtest_makereport(item, call):
     if pytest_html is None:
         return
 
-    attachments = (
+    # Images may still be queued for writing
+    writer = getattr(item.config, '_needle_writer', None)
+
+    if writer is not None:
+        writer.flush()
+
+    attachments = [attachment for exception in exceptions for attachment in (
         (exception.baseline_image, 'PDIFF: Expected'),
-        (exception.output_image.replace('.png', '.diff.png'), 'PDIFF: Comparison'),
+        (get_variant_path(exception.output_image, 'diff'), 'PDIFF: Comparison'),
         (exception.output_image, 'PDIFF: Actual')
-    )
+    )]
 
     for attachment in attachments:
 
         if os.path.exists(attachment[0]):
+            report.extra.append(get_report_extra(pytest_html, item.config, *attachment))
+
+
+def get_report_extra(pytest_html, config, filename, name):
+    """Returns pytest-html extra for an image, embedded or as a link depending on the report mode and size limit
+
+    :param pytest_html: pytest-html plugin
+    :param config: pytest config
+    :param str filename: File path
+    :param str name: Image name
+    :return:
+    """
+
+    link = config.getoption('report_mode') == 'link'
+    image_format = get_report_format(filename)
+
+    if link:
+        content = get_thumbnail_as_base64(filename, config.getoption('report_thumbnail_size'))
+
+    else:
+        content = get_image_as_base64(filename, image_format)
+
+    # Link images past the size limit instead of embedding them
+    max_bytes = config._needle_report_max_bytes  # pylint: disable=W0212
+
+    if max_bytes and config._needle_report_bytes + len(content) > max_bytes:  # pylint: disable=W0212
+        content = None
+
+    else:
+        config._needle_report_bytes += len(content)  # pylint: disable=W0212
+
+    if content is not None and not link:
+        return pytest_html.extras.image(content, name, mime_type='image/{}'.format(image_format.name),
+                                        extension=image_format.extension[1:])
+
+    return pytest_html.extras.html(get_link_html(get_report_path(config, filename), name, content))
+
+
+def get_report_path(config, filename):
+    """Returns path of a file relative to the HTML report, as used in links
+
+    :param config: pytest config
+    :param str filename: File path
+    :return:
+    :rtype: str
+    """
+
+    report_path = getattr(config.option, 'htmlpath', None)
+    report_dir = os.path.dirname(os.path.abspath(report_path)) if report_path else os.getcwd()
 
-            report.extra.append(pytest_html.extras.image(
-                get_image_as_base64(attachment[0]),
-                attachment[1]
-            ))
+    return os.path.relpath(os.path.abspath(filename), report_dir).replace(os.sep, '/')
+
+
+def get_link_html(href, name, thumbnail=None):
+    """Returns HTML linking to an image, showing a thumbnail if given
+
+    :param str href: Link to the image
+    :param str name: Image name
+    :param str thumbnail: Base64 encoded PNG thumbnail (Optional)
+    :return:
+    :rtype: str
+    """
+
+    label = '<img src="data:image/png;base64,{}"/>'.format(thumbnail) if thumbnail else escape(name)
+
+    return '<div class="image"><a href={} target="_blank" title={}>{}</a></div>'.format(
+        quoteattr(href), quoteattr(name), label)
 
 
 def is_failure(report):
@@ -99,13 +734,50 @@ def is_failure(report):
     return (report.skipped and xfail) or (report.failed and not xfail)
 
 
-def get_image_as_base64(filename):
+def get_report_format(filename):
+    """Returns format an image is embedded in HTML reports with, images browsers do not display are converted to PNG
+
+    :param str filename: File path
+    :return:
+    :rtype: ImageFormat
+    """
+
+    image_format = ImageFormat.from_path(filename)
+    return image_format if image_format.name in BROWSER_FORMATS else ImageFormat('png')
+
+
+def get_thumbnail_as_base64(filename, size):
+    """Open image from file as a base64 encoded PNG thumbnail
+
+    :param str filename: File path
+    :param int size: Largest width or height of the thumbnail
+    :return:
+    """
+
+    image = Image.open(filename)
+    image.thumbnail((size, size))
+
+    stream = BytesIO()
+    image.convert('RGB').save(stream, 'PNG')
+
+    return base64.b64encode(stream.getvalue()).decode('ascii')
+
+
+def get_image_as_base64(filename, image_format=None):
     """Open image from file as base64 encoded string
 
     :param str filename: File path
+    :param ImageFormat image_format: Format to convert the image to, if it is not already in it (Optional)
     :return:
     """
 
+    if image_format is not None and image_format.name != ImageFormat.from_path(filename).name:
+
+        stream = BytesIO()
+        image_format.save(Image.open(filename), stream)
+
+        return base64.b64encode(stream.getvalue()).decode('ascii')
+
     with open(filename, 'rb') as image:
         return base64.b64encode(image.read()).decode('ascii')
 
@@ -121,11 +793,50 @@ def needle(request, selenium):
 
     options = {
         'cleanup_on_success': request.config.getoption('needle_cleanup_on_success'),
+        'keep_on_success': request.config.getoption('needle_keep_on_success'),
         'save_baseline': request.config.getoption('needle_save_baseline'),
+        'save_baseline_threshold': request.config.getoption('save_baseline_threshold'),
         'needle_engine': request.config.getoption('needle_engine'),
+        'tolerance': request.config.getoption('needle_tolerance'),
+        'tile_size': request.config.getoption('needle_tile_size'),
         'baseline_dir': request.config.getoption('baseline_dir'),
         'output_dir': request.config.getoption('output_dir'),
-        'viewport_size': request.config.getoption('viewport_size')
+        'baseline_format': request.config.getoption('baseline_format'),
+        'output_format': request.config.getoption('output_format'),
+        'png_compress_level': request.config.getoption('png_compress_level'),
+        'webp_method': request.config.getoption('webp_method'),
+        'viewport_size': request.config.getoption('viewport_size'),
+        'capture_strategy': request.config.getoption('capture_strategy'),
+        'full_page_bands': request.config.getoption('needle_full_page_bands'),
+        'engine_registry': getattr(request.config, '_needle_engine_registry', None),
+        'baseline_cache': getattr(request.config, '_needle_baseline_cache', None),
+        'manifests': getattr(request.config, '_needle_manifests', None),
+        'baseline_stores': getattr(request.config, '_needle_baseline_stores', None),
+        'image_writer': getattr(request.config, '_needle_writer', None),
+        'deferred_compare': request.config.getoption('needle_deferred_compare'),
+        'compare_pool': getattr(request.config, '_needle_compare_pool', None),
+        'window_tracker': getattr(request.config, '_needle_window_tracker', None),
+        'pyramid': request.config.getoption('needle_pyramid'),
+        'pyramid_cache': getattr(request.config, '_needle_pyramid_cache', None),
+        'stable_frames': request.config.getoption('stable_frames'),
+        'stable_timeout': request.config.getoption('stable_timeout')
     }
 
-    return NeedleDriver(selenium, **options)
+    # Per test viewport size
+    marker = request.node.get_closest_marker('needle_viewport')
+
+    if marker is not None:
+        options['viewport_size'] = marker.args[0]
+
+    driver = NeedleDriver(selenium, **options)
+
+    # Deferred comparisons are collected once the test function returns
+    request.node._needle_driver = driver  # pylint: disable=W0212
+
+    yield driver
+
+    request.node.user_properties.extend(get_user_properties(driver.assertion_stats))
+    getattr(request.config, '_needle_assertions', []).extend(driver.assertion_stats)
+
+    # Drop comparisons still pending if the test failed before they were collected
+    driver.collect_deferred()
@@ -0,0 +1,251 @@
+"""pytest_needle.pyramid
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+import os
+import threading
+from PIL import Image, ImageChops
+from pytest_needle.cache import get_rgb_image
+from pytest_needle.writer import save_image
+
+
+#: Directory downscaled baselines are kept in, inside the baseline directory
+PYRAMID_DIR = '.needle-pyramid'
+
+#: Downscale factors of the pyramid levels, coarsest first
+PYRAMID_FACTORS = (16, 4)
+
+
+def reduce_image(image, factor):
+    """Returns image downscaled by factor, every pixel the average of a factor x factor block
+
+    Rows and columns past the last whole block are dropped, so every block has the same number of pixels.
+
+    :param Image.Image image: Image
+    :param int factor: Downscale factor
+    :return:
+    :rtype: Image.Image
+    """
+
+    width, height = image.size[0] // factor, image.size[1] // factor
+
+    return image.crop((0, 0, width * factor, height * factor)).resize((max(width, 1), max(height, 1)), Image.BOX)
+
+
+def get_distance_bound(image_a, image_b, factor, tolerance=0):
+    """Returns a lower bound of the distance between two images, from their downscaled versions
+
+    The difference of two block averages is never more than the average difference of the pixels in the block, so the
+    downscaled difference multiplied by the block size never exceeds the full resolution distance. One is taken off
+    every channel difference for rounding in the averages, and the tolerance for differences engines ignore.
+
+    :param Image.Image image_a: Image downscaled by factor
+    :param Image.Image image_b: Image downscaled by factor
+    :param int factor: Downscale factor
+    :param int tolerance: Per channel tolerance
+    :return:
+    :rtype: float
+    """
+
+    bands = len(image_a.getbands())
+    margin = 1 + tolerance
+
+    diff = ImageChops.difference(image_a, image_b).point([max(value - margin, 0) for value in range(256)] * bands)
+    total = sum(index % 256 * count for index, count in enumerate(diff.histogram()))
+
+    return factor * factor * total / float(bands * 255)
+
+
+class PyramidCache(object):  # pylint: disable=R0205
+    """Downscaled baselines of a session, by the pixel hash of the baseline
+
+    Levels are written to a directory inside the baseline directory, so later runs reuse them as long as the baseline
+    does not change. Baselines saved in the session are tracked, so levels of rewritten baselines can be pruned.
+    """
+
+    def __init__(self):
+
+        self.hits = 0
+        self.misses = 0
+        self.failed_fast = 0
+        self.escalated = 0
+
+        self._levels = {}
+        self._replaced = set()
+        self._saved = set()
+        self._lock = threading.Lock()
+
+    def get(self, baseline_dir, digest, factor, load):
+        """Returns baseline downscaled by factor
+
+        :param str baseline_dir: Baseline directory
+        :param str digest: Pixel hash of the baseline
+        :param int factor: Downscale factor
+        :param load: Called without arguments to decode the full baseline, if the level is not cached
+        :return:
+        :rtype: Image.Image
+        """
+
+        file_path = os.path.join(baseline_dir, PYRAMID_DIR, '{}.{}.png'.format(digest, factor))
+
+        with self._lock:
+
+            if file_path in self._levels:
+                self.hits += 1
+                return self._levels[file_path]
+
+        try:
+            level = get_rgb_image(Image.open(file_path))
+            hit = True
+
+        except EnvironmentError:
+            level = reduce_image(load(), factor)
+            save_image(level, file_path)
+            hit = False
+
+        with self._lock:
+
+            self._levels[file_path] = level
+
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return level
+
+    def add_result(self, failed_fast):
+        """Count a pyramid comparison
+
+        :param bool failed_fast: True, if the comparison failed on downscaled images
+        :return:
+        """
+
+        with self._lock:
+
+            if failed_fast:
+                self.failed_fast += 1
+            else:
+                self.escalated += 1
+
+    def add_baseline(self, digest, replaced=None):
+        """Record a baseline saved in this session
+
+        :param str digest: Pixel hash of the baseline, as kept or written
+        :param str replaced: Pixel hash of the baseline it rewrote, None if it was new or kept
+        :return:
+        """
+
+        with self._lock:
+
+            self._saved.add(digest)
+
+            if replaced is not None:
+                self._replaced.add(replaced)
+
+    @property
+    def baseline_updates(self):
+        """Returns pixel hashes of baselines saved and of baselines rewritten in this session
+
+        :return:
+        :rtype: dict
+        """
+
+        with self._lock:
+            return {'saved': sorted(self._saved), 'replaced': sorted(self._replaced)}
+
+    def add_baseline_updates(self, updates):
+        """Add baselines saved by another process, ex. a pytest-xdist worker
+
+        :param dict updates: Pixel hashes, as returned by :attr:`baseline_updates`
+        :return:
+        """
+
+        with self._lock:
+            self._saved.update(updates['saved'])
+            self._replaced.update(updates['replaced'])
+
+    @property
+    def stale(self):
+        """Returns pixel hashes of rewritten baselines no baseline saved in this session still has
+
+        :return:
+        :rtype: set
+        """
+
+        with self._lock:
+            return self._replaced - self._saved
+
+    @property
+    def stats(self):
+        """Returns cache and comparison counters
+
+        :return:
+        :rtype: dict
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'failed_fast': self.failed_fast, 'escalated': self.escalated}
+
+
+def prune_pyramid(baseline_dir, hashes):
+    """Remove downscaled baselines of baselines that were rewritten
+
+    :param str baseline_dir: Baseline directory
+    :param set hashes: Pixel hashes of the rewritten baselines
+    :return: Number of files removed
+    :rtype: int
+    """
+
+    directory = os.path.join(baseline_dir, PYRAMID_DIR)
+
+    try:
+        file_names = os.listdir(directory)
+
+    except EnvironmentError:
+        return 0
+
+    removed = 0
+
+    for file_name in file_names:
+
+        if file_name.split('.', 1)[0] not in hashes:
+            continue
+
+        try:
+            os.remove(os.path.join(directory, file_name))
+            removed += 1
+
+        except EnvironmentError:
+            pass
+
+    return removed
+
+
+def compare_pyramid(fresh_image, get_level, threshold, tolerance=0, factors=PYRAMID_FACTORS):
+    """Compare a fresh image against downscaled baselines, coarsest first
+
+    :param Image.Image fresh_image: Fresh image
+    :param get_level: Called with a downscale factor, returns the baseline downscaled by it
+    :param threshold: Distance threshold
+    :param int tolerance: Per channel tolerance
+    :param tuple factors: Downscale factors, coarsest first
+    :return: Lower bound of the distance, once it exceeds threshold, None if full resolution has to decide
+    :rtype: float
+    """
+
+    for factor in factors:
+
+        fresh_level = reduce_image(fresh_image, factor)
+        baseline_level = get_level(factor)
+
+        if fresh_level.size != baseline_level.size:
+            return None
+
+        bound = get_distance_bound(fresh_level, baseline_level, factor, tolerance)
+
+        if bound > threshold:
+            return bound
+
+    return None
@@ -0,0 +1,171 @@
+"""pytest_needle.recompare
+
+Compare fresh screenshots left in the output directory against their baselines again, without a browser.
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from __future__ import print_function
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+from PIL import Image
+from pytest_needle.cache import get_rgb_image
+from pytest_needle.deferred import compare_images
+from pytest_needle.driver import DEFAULT_BASELINE_DIR, DEFAULT_ENGINE, DEFAULT_OUTPUT_DIR
+from pytest_needle.engines import registry
+from pytest_needle.store import STORE_FILE, get_name
+from pytest_needle.writer import DEFAULT_IMAGE_FORMAT, IMAGE_FORMATS, get_variant_path
+
+
+def iter_fresh_images(output_dir, baseline_dir, baseline_extension='.png'):
+    """Yields fresh screenshots in the output directory, in any image format, with the path of their baseline
+
+    Diff images, extracted baselines, temporary files and the baseline directory, if it is inside the output directory,
+    are skipped.
+
+    :param str output_dir: Output directory
+    :param str baseline_dir: Baseline directory
+    :param str baseline_extension: File extension of baselines
+    :return: Tuples of screenshot name, fresh image path and baseline image path
+    """
+
+    extensions = tuple(extension for extension, _ in IMAGE_FORMATS.values())
+    output_dir = os.path.realpath(output_dir)
+    baseline_dir = os.path.realpath(baseline_dir)
+
+    for directory, directories, files in os.walk(output_dir):
+
+        directories[:] = sorted(name for name in directories if os.path.join(directory, name) != baseline_dir)
+
+        for name in sorted(files):
+
+            root, extension = os.path.splitext(name)
+
+            if extension not in extensions or os.path.splitext(root)[1] in ('.diff', '.baseline') or '.tmp' in name:
+                continue
+
+            fresh_image_file = os.path.join(directory, name)
+            relative_path = os.path.relpath(os.path.join(directory, root), output_dir)
+
+            yield relative_path, fresh_image_file, os.path.join(baseline_dir, relative_path + baseline_extension)
+
+
+def recompare_image(engine_name, tolerance, fresh_image_file, baseline_image, threshold,  # pylint: disable=R0913
+                    store_path=None, store_name=None):
+    """Compare a fresh screenshot on disk against its baseline, runs in a worker process
+
+    :param str engine_name: Engine name or dotted path to the engine class
+    :param int tolerance: Per channel tolerance, for engines that support it
+    :param str fresh_image_file: Fresh image path
+    :param str baseline_image: Baseline image path
+    :param threshold: Distance threshold
+    :param str store_path: Path of the baseline store to read the baseline from (Optional)
+    :param str store_name: Name of the baseline in the baseline store
+    :return: Result as returned by :func:`pytest_needle.deferred.compare_images`
+    :rtype: dict
+    """
+
+    fresh_image = get_rgb_image(Image.open(fresh_image_file))
+    result = compare_images(engine_name, tolerance, fresh_image, fresh_image_file, baseline_image, threshold,
+                            write_fresh=False, store_path=store_path, store_name=store_name)
+
+    # Remove the diff image and extracted baseline of an earlier failure
+    stale_files = (get_variant_path(fresh_image_file, 'diff'), os.path.splitext(fresh_image_file)[0] + '.baseline.png')
+
+    for file_path in stale_files:
+
+        if result['status'] == 'passed' and os.path.exists(file_path):
+            os.remove(file_path)
+
+    return result
+
+
+def recompare(output_dir, baseline_dir, engine_name='pil', tolerance=0, threshold=0,  # pylint: disable=R0913
+              processes=None, out=None, store=False, baseline_format=DEFAULT_IMAGE_FORMAT):
+    """Compare all fresh screenshots in the output directory against their baselines, in parallel
+
+    Diff images are written for mismatches, like :meth:`pytest_needle.driver.NeedleDriver.assert_screenshot` does.
+
+    :param str output_dir: Output directory
+    :param str baseline_dir: Baseline directory
+    :param str engine_name: Engine name or dotted path to the engine class
+    :param int tolerance: Per channel tolerance, for engines that support it
+    :param threshold: Distance threshold
+    :param int processes: Number of worker processes, one per CPU if not given
+    :param out: File results are printed to (Optional)
+    :param bool store: Read baselines from the baseline store of the baseline directory
+    :param str baseline_format: Format baselines are written in (png, webp or raw), unless they are in the store
+    :return: Exit code, 0 if all screenshots match their baseline
+    :rtype: int
+    """
+
+    out = out or sys.stdout
+    engine_path = registry.get_path(engine_name)
+    fresh_images = list(iter_fresh_images(output_dir, baseline_dir,
+                                          '.png' if store else IMAGE_FORMATS[baseline_format][0]))
+    store_path = os.path.join(baseline_dir, STORE_FILE) if store else None
+
+    counts = {'passed': 0, 'failed': 0, 'missing': 0, 'engine': 0}
+
+    with ProcessPoolExecutor(processes or None) as executor:
+
+        futures = [executor.submit(recompare_image, engine_path, tolerance, fresh_image_file, baseline_image,
+                                   threshold, store_path, get_name(os.path.realpath(baseline_dir), baseline_image))
+                   for _, fresh_image_file, baseline_image in fresh_images]
+
+        for (name, _, _), future in zip(fresh_images, futures):
+
+            result = future.result()
+            counts[result['status']] += 1
+
+            if result['status'] == 'passed':
+                print('PASSED {}'.format(name), file=out)
+
+            else:
+                print('{} {}: {}'.format(result['status'].upper(), name, result['message']), file=out)
+
+    print('{passed} passed, {failed} failed, {missing} missing baselines'.format(**counts) +
+          (', {engine} engine errors'.format(**counts) if counts['engine'] else ''), file=out)
+
+    return 1 if counts['failed'] or counts['missing'] or counts['engine'] else 0
+
+
+def main(argv=None):
+    """needle-recompare console entry point
+
+    :param list argv: Command line arguments
+    :return: Exit code
+    :rtype: int
+    """
+
+    parser = argparse.ArgumentParser(prog='needle-recompare', description='Compare fresh screenshots in the output '
+                                                                          'directory against their baselines again')
+
+    parser.add_argument('--baseline-dir', default=DEFAULT_BASELINE_DIR, help='where baseline images are stored')
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help='where fresh images are stored')
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, help='engine for compare screenshots')
+    parser.add_argument('--tolerance', type=int, default=0, help='per channel difference to ignore')
+    parser.add_argument('--threshold', type=float, default=0, help='distance threshold')
+    parser.add_argument('--baseline-format', default=DEFAULT_IMAGE_FORMAT, choices=sorted(IMAGE_FORMATS),
+                        help='format baselines are written in')
+    parser.add_argument('--store', action='store_true',
+                        help='read baselines from the baseline store of the baseline directory')
+    parser.add_argument('--processes', type=int, default=0, help='number of worker processes, 0 for one per CPU')
+
+    args = parser.parse_args(argv)
+
+    try:
+        registry.get_class(args.engine)
+
+    except (ImportError, AttributeError, ValueError) as err:
+        parser.error(str(err))
+
+    return recompare(args.output_dir, args.baseline_dir, args.engine, args.tolerance, args.threshold, args.processes,
+                     store=args.store, baseline_format=args.baseline_format)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+"""pytest_needle.store
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+from __future__ import print_function
+import argparse
+import errno
+import os
+import sqlite3
+import sys
+import threading
+from PIL import Image
+from pytest_needle.cache import get_image_hash, get_rgb_image
+from pytest_needle.writer import create_dir, replace_file
+
+if sys.version_info >= (3, 0):
+    from io import BytesIO as IOClass
+else:
+    try:
+        from cStringIO import StringIO as IOClass
+    except ImportError:
+        from StringIO import StringIO as IOClass
+
+
+#: Baseline store file, inside the baseline directory
+STORE_FILE = 'baselines.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (hash TEXT PRIMARY KEY, width INTEGER, height INTEGER, png BLOB);
+CREATE TABLE IF NOT EXISTS baselines (name TEXT PRIMARY KEY, hash TEXT NOT NULL REFERENCES images (hash));
+"""
+
+# Memory map up to 1 GB of the database file, so reading baselines does not copy them through read calls
+MMAP_SIZE = 1024 * 1024 * 1024
+
+
+def _encode_png(image):
+    """Encode image as PNG
+
+    :param Image.Image image: Image
+    :return:
+    :rtype: bytes
+    """
+
+    stream = IOClass()
+    image.save(stream, 'PNG')
+
+    return stream.getvalue()
+
+
+class BaselineStore(object):  # pylint: disable=R0205
+    """Baseline images in a single SQLite database, content addressed by the hash of their pixel data
+
+    Baselines are looked up by name, the file name relative to the baseline directory (ex. ``home.png``). Identical
+    images are stored once however many baselines use them. The database file is memory mapped for reading and can be
+    used by several processes at once.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        self._connection = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self):
+        """Returns database connection, opened on first use in each process
+
+        :return:
+        :rtype: sqlite3.Connection
+        """
+
+        with self._lock:
+
+            if self._connection is None or self._pid != os.getpid():
+
+                create_dir(os.path.dirname(self.path))
+
+                self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+                self._connection.execute('PRAGMA journal_mode=WAL')
+                self._connection.execute('PRAGMA mmap_size={}'.format(MMAP_SIZE))
+                self._connection.executescript(SCHEMA)
+                self._pid = os.getpid()
+
+            return self._connection
+
+    def _get_row(self, name, columns):
+        """Returns columns of a baseline's image, None if there is no such baseline
+
+        :param str name: Baseline name
+        :param str columns: Columns of the images table
+        :return:
+        :rtype: tuple
+        """
+
+        with self._lock:
+            return self.connection.execute('SELECT {} FROM baselines JOIN images USING (hash) '
+                                           'WHERE name = ?'.format(columns), (name,)).fetchone()
+
+    def __contains__(self, name):
+
+        return self.get_hash(name) is not None
+
+    def get_hash(self, name):
+        """Returns pixel hash of a baseline, None if there is no such baseline
+
+        :param str name: Baseline name
+        :return:
+        :rtype: str
+        """
+
+        row = self._get_row(name, 'hash')
+        return row[0] if row else None
+
+    def get_png(self, name):
+        """Returns PNG encoded baseline
+
+        :param str name: Baseline name
+        :return:
+        :rtype: bytes
+        :raises IOError: If there is no such baseline
+        """
+
+        row = self._get_row(name, 'png')
+
+        if row is None:
+            raise IOError(errno.ENOENT, "No baseline named '{}' in".format(name), self.path)
+
+        return bytes(row[0])
+
+    def open(self, name):
+        """Returns decoded baseline
+
+        :param str name: Baseline name
+        :return:
+        :rtype: Image.Image
+        :raises IOError: If there is no such baseline
+        """
+
+        return get_rgb_image(Image.open(IOClass(self.get_png(name))))
+
+    def extract(self, name, file_path):
+        """Write a baseline to a PNG file, ex. for engines that compare files
+
+        :param str name: Baseline name
+        :param str file_path: File path
+        :return:
+        :raises IOError: If there is no such baseline
+        """
+
+        png = self.get_png(name)
+        temp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+
+        create_dir(os.path.dirname(file_path))
+
+        with open(temp_path, 'wb') as output:
+            output.write(png)
+
+        replace_file(temp_path, file_path)
+
+    def save(self, name, image, png=None, digest=None):
+        """Store a baseline, replacing any baseline of the same name
+
+        :param str name: Baseline name
+        :param Image.Image image: Baseline image
+        :param bytes png: Image already encoded as PNG (Optional)
+        :param str digest: Pixel hash of the image, if already known (Optional)
+        :return: Pixel hash
+        :rtype: str
+        """
+
+        digest = digest or get_image_hash(image)
+
+        with self._lock:
+
+            connection = self.connection
+            exists = connection.execute('SELECT 1 FROM images WHERE hash = ?', (digest,)).fetchone()
+
+            with connection:
+
+                if not exists:
+                    connection.execute('INSERT OR IGNORE INTO images (hash, width, height, png) VALUES (?, ?, ?, ?)',
+                                       (digest, image.size[0], image.size[1],
+                                        sqlite3.Binary(png or _encode_png(image))))
+
+                connection.execute('INSERT OR REPLACE INTO baselines (name, hash) VALUES (?, ?)', (name, digest))
+
+        return digest
+
+    def names(self):
+        """Returns names of all baselines
+
+        :return:
+        :rtype: list
+        """
+
+        with self._lock:
+            return [row[0] for row in self.connection.execute('SELECT name FROM baselines ORDER BY name')]
+
+    def hashes(self):
+        """Returns pixel hashes of all baselines
+
+        :return:
+        :rtype: set
+        """
+
+        with self._lock:
+            return set(row[0] for row in self.connection.execute('SELECT DISTINCT hash FROM baselines'))
+
+    @property
+    def stats(self):
+        """Returns number of baselines, distinct images and bytes of PNG data
+
+        :return:
+        :rtype: dict
+        """
+
+        with self._lock:
+            baselines = self.connection.execute('SELECT COUNT(*) FROM baselines').fetchone()[0]
+            images, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(png)), 0) '
+                                                   'FROM images').fetchone()
+
+        return {'baselines': baselines, 'images': images, 'bytes': size}
+
+    def import_dir(self, directory):
+        """Import all PNG baselines of a baseline directory tree
+
+        :param str directory: Baseline directory
+        :return: Number of imported baselines
+        :rtype: int
+        """
+
+        imported = 0
+
+        for root, directories, files in os.walk(directory):
+
+            # Skip hidden directories, ex. downscaled baselines of pyramid comparisons
+            directories[:] = sorted(name for name in directories if not name.startswith('.'))
+
+            for file_name in sorted(files):
+
+                if not file_name.endswith('.png') or file_name.endswith('.diff.png') or '.tmp' in file_name:
+                    continue
+
+                file_path = os.path.join(root, file_name)
+
+                with open(file_path, 'rb') as png_file:
+                    png = png_file.read()
+
+                image = get_rgb_image(Image.open(IOClass(png)))
+                self.save(get_name(directory, file_path), image, png)
+
+                imported += 1
+
+        return imported
+
+    def export_dir(self, directory):
+        """Write all baselines as PNG files into a baseline directory tree
+
+        :param str directory: Baseline directory
+        :return: Number of exported baselines
+        :rtype: int
+        """
+
+        names = self.names()
+
+        for name in names:
+            self.extract(name, os.path.join(directory, *name.split('/')))
+
+        return len(names)
+
+    def close(self):
+        """Close the database connection
+
+        :return:
+        """
+
+        with self._lock:
+
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+
+            self._connection = None
+
+
+class BaselineStores(object):  # pylint: disable=R0205
+    """Baseline stores of a session, one per baseline directory
+    """
+
+    def __init__(self):
+
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, directory):
+        """Returns store of a baseline directory
+
+        :param str directory: Baseline directory
+        :return:
+        :rtype: BaselineStore
+        """
+
+        directory = os.path.realpath(directory)
+
+        with self._lock:
+
+            if directory not in self._stores:
+                self._stores[directory] = BaselineStore(os.path.join(directory, STORE_FILE))
+
+            return self._stores[directory]
+
+    def close(self):
+        """Close all stores
+
+        :return:
+        """
+
+        for store in list(self._stores.values()):
+            store.close()
+
+
+def get_name(baseline_dir, file_path):
+    """Returns store name of a baseline image path
+
+    :param str baseline_dir: Baseline directory
+    :param str file_path: Baseline image path
+    :return:
+    :rtype: str
+    """
+
+    return os.path.relpath(file_path, baseline_dir).replace(os.sep, '/')
+
+
+def main(argv=None):
+    """needle-baseline-store console entry point
+
+    :param list argv: Command line arguments
+    :return: Exit code
+    :rtype: int
+    """
+
+    from pytest_needle.driver import DEFAULT_BASELINE_DIR  # pylint: disable=C0415
+
+    parser = argparse.ArgumentParser(prog='needle-baseline-store',
+                                     description='Manage the baseline store of a baseline directory')
+
+    parser.add_argument('command', choices=('import', 'export', 'stats'),
+                        help='import the PNG files of the baseline directory into its store, export the store as '
+                             'PNG files into the baseline directory, or show store statistics')
+    parser.add_argument('--baseline-dir', default=DEFAULT_BASELINE_DIR, help='baseline directory')
+
+    args = parser.parse_args(argv)
+    store = BaselineStore(os.path.join(args.baseline_dir, STORE_FILE))
+
+    if args.command == 'import':
+        print('imported {} baselines'.format(store.import_dir(args.baseline_dir)))
+
+    elif args.command == 'export':
+        print('exported {} baselines'.format(store.export_dir(args.baseline_dir)))
+
+    print('{baselines} baselines, {images} distinct images, {mb:.1f} MB in {path}'.format(
+        mb=store.stats['bytes'] / 1048576.0, path=store.path, **store.stats))
+
+    store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""pytest_needle.tiles
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+import hashlib
+
+
+def get_tile_boxes(size, tile_size):
+    """Returns the boxes of fixed size tiles covering an image, row by row
+
+    :param tuple size: Image width and height
+    :param int tile_size: Tile width and height
+    :return:
+    :rtype: list
+    """
+
+    width, height = size
+
+    return [(left, top, min(left + tile_size, width), min(top + tile_size, height))
+            for top in range(0, height, tile_size) for left in range(0, width, tile_size)]
+
+
+def get_tile_hashes(image, tile_size):
+    """Returns hashes of an image's tiles, in the order of :func:`get_tile_boxes`
+
+    :param Image.Image image: Image
+    :param int tile_size: Tile width and height
+    :return:
+    :rtype: list
+    """
+
+    return [hashlib.sha1(image.crop(box).tobytes()).hexdigest() for box in get_tile_boxes(image.size, tile_size)]
+
+
+def compare_tiles(engine, image_a, image_b, tile_size, hashes_b=None):
+    """Compare two images of the same size tile by tile, only tiles whose hashes differ are compared by the engine
+
+    Distances add up across tiles, so the total is the same as comparing the whole images.
+
+    :param engine: Image processing engine that implements get_distance
+    :param Image.Image image_a: Image
+    :param Image.Image image_b: Image
+    :param int tile_size: Tile width and height
+    :param list hashes_b: Tile hashes of image_b, computed if not given
+    :return: Distance and boxes of changed tiles
+    :rtype: tuple
+    """
+
+    boxes = get_tile_boxes(image_a.size, tile_size)
+    hashes_a = get_tile_hashes(image_a, tile_size)
+    hashes_b = hashes_b if hashes_b and len(hashes_b) == len(boxes) else get_tile_hashes(image_b, tile_size)
+
+    distance = 0
+    changed = []
+
+    for box, hash_a, hash_b in zip(boxes, hashes_a, hashes_b):
+
+        if hash_a != hash_b:
+
+            distance += engine.get_distance(image_a.crop(box), image_b.crop(box))
+            changed.append(box)
+
+    return distance, changed
@@ -0,0 +1,84 @@
+"""pytest_needle.window
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+import threading
+
+
+class WindowTracker(object):  # pylint: disable=R0205
+    """Remembers the window position and size last set in each WebDriver session
+
+    Setting the same geometry again is skipped, which avoids a relayout of the page on most drivers. Geometry changed
+    without going through the tracker is not noticed, pass ``force=True`` to set it regardless.
+    """
+
+    def __init__(self):
+
+        self.applied = 0
+        self.skipped = 0
+
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(driver, name):
+        """Returns key of a window setting
+
+        :param driver: Selenium WebDriver
+        :param str name: Setting name, ex. position or size
+        :return:
+        :rtype: tuple
+        """
+
+        return getattr(driver, 'session_id', None) or id(driver), name
+
+    def set(self, driver, name, value, command, force=False):  # pylint: disable=R0913
+        """Run command to set a window setting, unless the setting already has value
+
+        :param driver: Selenium WebDriver
+        :param str name: Setting name, ex. position or size
+        :param value: Setting value
+        :param command: Called without arguments to set the value
+        :param bool force: Run command even if the setting already has value
+        :return: True, if the command was run
+        :rtype: bool
+        """
+
+        key = self._get_key(driver, name)
+
+        with self._lock:
+
+            if not force and key in self._windows and self._windows[key] == value:
+                self.skipped += 1
+                return False
+
+        command()
+
+        with self._lock:
+            self._windows[key] = value
+            self.applied += 1
+
+        return True
+
+    def forget(self, driver, name):
+        """Forget a window setting, so it is set again next time
+
+        :param driver: Selenium WebDriver
+        :param str name: Setting name, ex. position or size
+        :return:
+        """
+
+        with self._lock:
+            self._windows.pop(self._get_key(driver, name), None)
+
+    @property
+    def stats(self):
+        """Returns tracker counters
+
+        :return:
+        :rtype: dict
+        """
+
+        return {'applied': self.applied, 'skipped': self.skipped}
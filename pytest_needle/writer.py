@@ -0,0 +1,288 @@
+"""pytest_needle.writer
+
+.. codeauthor:: John Lane <jlane@fanthreesixty.com>
+
+"""
+
+import os
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue  # pylint: disable=E0401
+
+
+#: Image formats by name, with their file extension and PIL format. Raw images are uncompressed binary PPM files.
+IMAGE_FORMATS = {
+    'png': ('.png', 'PNG'),
+    'raw': ('.ppm', 'PPM'),
+    'webp': ('.webp', 'WEBP')
+}
+
+DEFAULT_IMAGE_FORMAT = 'png'
+DEFAULT_PNG_COMPRESS_LEVEL = 6
+DEFAULT_WEBP_METHOD = 4
+
+
+class ImageFormat(object):  # pylint: disable=R0205
+    """File format and encoder settings images are written with
+
+    PNG is written with the given zlib compression level, 0 (no compression, fastest) to 9 (smallest). WebP is always
+    lossless, with the given method, 0 (fastest) to 6 (smallest).
+    """
+
+    def __init__(self, name=DEFAULT_IMAGE_FORMAT, png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+                 webp_method=DEFAULT_WEBP_METHOD):
+
+        if name not in IMAGE_FORMATS:
+            raise ValueError("Unknown image format '{}', expected one of {}".format(name, ', '.join(
+                sorted(IMAGE_FORMATS))))
+
+        self.name = name
+        self.png_compress_level = png_compress_level
+        self.webp_method = webp_method
+
+    @classmethod
+    def from_path(cls, file_path, **settings):
+        """Returns image format of a file path, by its extension, PNG if the extension is not known
+
+        :param str file_path: File path
+        :param settings: Encoder settings
+        :return:
+        :rtype: ImageFormat
+        """
+
+        extension = os.path.splitext(file_path)[1].lower()
+
+        for name, (format_extension, _) in IMAGE_FORMATS.items():
+
+            if extension == format_extension:
+                return cls(name, **settings)
+
+        return cls(DEFAULT_IMAGE_FORMAT, **settings)
+
+    @property
+    def extension(self):
+        """Returns file extension, ex. .png
+
+        :return:
+        :rtype: str
+        """
+
+        return IMAGE_FORMATS[self.name][0]
+
+    @property
+    def params(self):
+        """Returns PIL encoder parameters
+
+        :return:
+        :rtype: dict
+        """
+
+        if self.name == 'png':
+            return {'compress_level': self.png_compress_level}
+
+        if self.name == 'webp':
+            return {'lossless': True, 'method': self.webp_method}
+
+        return {}
+
+    def save(self, image, file_path):
+        """Encode image to a file
+
+        :param Image.Image image: Image
+        :param file_path: File path or file object
+        :return:
+        """
+
+        image.save(file_path, IMAGE_FORMATS[self.name][1], **self.params)
+
+
+def get_variant_path(file_path, variant):
+    """Returns path of an image derived from another, ex. the diff image of a fresh image
+
+    :param str file_path: Image path, ex. screenshots/home.png
+    :param str variant: Variant name, ex. diff
+    :return: Variant path, ex. screenshots/home.diff.png
+    :rtype: str
+    """
+
+    root, extension = os.path.splitext(file_path)
+    return '{}.{}{}'.format(root, variant, extension)
+
+
+def create_dir(directory):
+    """Create a directory, if it does not exist
+
+    :param str directory: Directory path
+    :return:
+    """
+
+    if directory and not os.path.isdir(directory):
+
+        try:
+            os.makedirs(directory)
+
+        except OSError:
+
+            if not os.path.isdir(directory):
+                raise
+
+
+def replace_file(source, destination):
+    """Atomically move source to destination, replacing destination if it exists
+
+    :param str source: File path
+    :param str destination: File path
+    :return:
+    """
+
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)  # pylint: disable=E1101
+
+    else:
+
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)
+
+        os.rename(source, destination)
+
+
+def save_image(image, file_path, image_format=None):
+    """Write image to a temporary file next to file path and move it into place
+
+    Readers, including other processes, never see a partially written image.
+
+    :param Image.Image image: Image to write
+    :param str file_path: File path
+    :param ImageFormat image_format: Format and encoder settings, by default those of the file extension
+    :return:
+    """
+
+    create_dir(os.path.dirname(file_path))
+
+    root, extension = os.path.splitext(file_path)
+    temp_path = '{}.{}.tmp{}'.format(root, os.getpid(), extension)
+
+    try:
+        (image_format or ImageFormat.from_path(file_path)).save(image, temp_path)
+        replace_file(temp_path, file_path)
+
+    except Exception:
+
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise
+
+
+class ImageWriter(object):  # pylint: disable=R0205
+    """Encodes and writes images to disk on a pool of background threads
+
+    The queue of pending writes is bounded, once it is full :meth:`save` blocks until a thread is free. With no threads
+    images are written synchronously. Images must not be modified once handed to the writer.
+    """
+
+    def __init__(self, threads=0, queue_size=None):
+
+        self.threads = threads
+        self.errors = []
+        self.written = 0
+
+        self._queue = Queue(maxsize=queue_size or threads * 2)
+        self._workers = []
+        self._lock = threading.Lock()
+
+        for _ in range(threads):
+
+            worker = threading.Thread(target=self._work, name='needle-writer')
+            worker.daemon = True
+            worker.start()
+
+            self._workers.append(worker)
+
+    def _write(self, image, file_path, callback=None, image_format=None):
+        """Write image to disk and call callback with its path
+
+        :param Image.Image image: Image to write
+        :param str file_path: File path
+        :param callback: Called with the file path once written (Optional)
+        :param ImageFormat image_format: Format and encoder settings (Optional)
+        :return:
+        """
+
+        save_image(image, file_path, image_format)
+
+        with self._lock:
+            self.written += 1
+
+        if callback:
+            callback(file_path)
+
+    def _work(self):
+        """Write queued images until a stop sentinel is received
+
+        :return:
+        """
+
+        while True:
+
+            item = self._queue.get()
+
+            try:
+
+                if item is None:
+                    return
+
+                self._write(*item)
+
+            except Exception as err:  # pylint: disable=W0703
+
+                with self._lock:
+                    self.errors.append((item[1], err))
+
+            finally:
+                self._queue.task_done()
+
+    def save(self, image, file_path, callback=None, sync=False, image_format=None):  # pylint: disable=R0913
+        """Write image to disk, in the background if the writer has threads
+
+        :param Image.Image image: Image to write
+        :param str file_path: File path
+        :param callback: Called with the file path once written (Optional)
+        :param bool sync: Write before returning, even if the writer has threads
+        :param ImageFormat image_format: Format and encoder settings (Optional)
+        :return:
+        """
+
+        if sync or not self._workers:
+            self._write(image, file_path, callback, image_format)
+
+        else:
+            self._queue.put((image, file_path, callback, image_format))
+
+    def flush(self):
+        """Wait until all queued images are written
+
+        :return:
+        """
+
+        if self._workers:
+            self._queue.join()
+
+    def close(self):
+        """Write all queued images and stop the threads
+
+        :return:
+        """
+
+        self.flush()
+
+        for _ in self._workers:
+            self._queue.put(None)
+
+        for worker in self._workers:
+            worker.join()
+
+        self._workers = []
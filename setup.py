@@ -23,21 +23,26 @@ setup(name='pytest-needle',
       author_email=__email__,
       description='pytest plugin for visual testing websites using selenium',
       license=__license__,
-      keywords='py.test pytest needle imagemagick perceptualdiff pil selenium visual',
+      keywords='py.test pytest needle imagemagick perceptualdiff pil numpy selenium visual',
       url=u'https://github.com/jlane9/pytest-needle',
       project_urls={
           "Documentation": "https://pytest-needle.readthedocs.io/en/latest/",
           "Tracker": "https://github.com/jlane9/pytest-needle/issues"
       },
-      packages=['pytest_needle'],
-      entry_points={'pytest11': ['needle = pytest_needle.plugin', ]},
+      packages=['pytest_needle', 'pytest_needle.engines'],
+      entry_points={
+          'pytest11': ['needle = pytest_needle.plugin', ],
+          'console_scripts': ['needle-baseline-store = pytest_needle.store:main',
+                              'needle-recompare = pytest_needle.recompare:main', ]
+      },
       long_description=read("README.md"),
       long_description_content_type="text/markdown",
       install_requires=[
           'pytest>=3.7.0,<5.0.0',
           'pytest-selenium>=1.16.0,<2.0.0',
           'needle>=0.5.0,<0.6.0',
-          'selenium>=3.0.0'
+          'selenium>=3.0.0',
+          'futures>=3.0.0; python_version < "3.0"'
       ],
       python_requires=">=2.7",
       tests_require=[
@@ -46,6 +51,9 @@ setup(name='pytest-needle',
           "pytest-pep8>=1.0.0"
       ],
       extras_require={
+          "numpy": [
+              "numpy>=1.11.0"
+          ],
           "release": [
               "bumpversion>=0.5.0",
               "recommonmark>=0.5.0",
@@ -6,7 +6,11 @@
 
 import os
 import pytest
+from PIL import Image
 from selenium.webdriver.common.by import By
+from pytest_needle.pyramid import PYRAMID_DIR, prune_pyramid
+from pytest_needle.recompare import recompare
+from pytest_needle.store import BaselineStores
 
 
 @pytest.mark.page
@@ -49,6 +53,58 @@ def test_example_page_with_mask(needle):
     ], threshold=80)
 
 
+@pytest.mark.page
+def test_example_full_page(needle):
+    """Example for comparing pages taller than the viewport
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take a screen diff of the whole page
+    needle.assert_screenshot('full_page', threshold=80, full_page=True)
+
+
+@pytest.mark.page
+def test_example_deferred(needle):
+    """Example for comparing pages in a worker process while the test continues
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take a entire page screen diff, compared in the background
+    needle.assert_screenshot('deferred', threshold=80, defer=True)
+
+    assert not needle.collect_deferred()
+
+
+@pytest.mark.page
+def test_example_timings(needle):
+    """Verify that assertions record the time spent in each stage
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take a entire page screen diff
+    needle.assert_screenshot('timings', threshold=80)
+
+    stats = needle.assertion_stats[-1]
+
+    assert 'capture' in stats['timings'] and 'decode' in stats['timings']
+    assert stats['screenshot_bytes'] > 0
+
+
 @pytest.mark.element
 def test_example_element(needle):
     """Example for comparing individual elements
@@ -70,6 +126,27 @@ def test_example_element(needle):
     needle.assert_screenshot('search_field', (By.ID, 'tsf'), threshold=80)
 
 
+@pytest.mark.element
+@pytest.mark.parametrize('strategy', ('crop', 'clip', 'element', 'auto'))
+def test_element_capture_strategy(needle, strategy):
+    """Verify element screenshots can be captured with every capture strategy
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :param str strategy: Capture strategy
+    :return:
+    """
+
+    needle.capture_strategy = strategy
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take an element screen diff
+    needle.assert_screenshot('capture_' + strategy, (By.TAG_NAME, 'h1'), threshold=80)
+
+    assert needle.assertion_stats[-1]['capture_strategy'] in ('crop', 'clip', 'element')
+
+
 @pytest.mark.cleanup
 def test_cleanup_on_success(needle):
     """Verify that the --needle-cleanup-on-success removes the newly generated file
@@ -92,6 +169,25 @@ def test_cleanup_on_success(needle):
     assert not os.path.exists(screenshot_path)
 
 
+@pytest.mark.cleanup
+def test_no_fresh_image_on_success(needle):
+    """Verify that passing comparisons do not write the fresh image to disk
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    screenshot_path = os.path.join(needle.output_dir, "no_fresh_image_test.png")
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take a entire page screen diff
+    needle.assert_screenshot('no_fresh_image_test', threshold=80)
+
+    assert not os.path.exists(screenshot_path)
+
+
 @pytest.mark.output_dir
 def test_output_dir(needle):
     """Verify that the --needle-output-dir saves the fresh image in the specified directory
@@ -104,6 +200,9 @@ def test_output_dir(needle):
     needle.output_dir = os.path.join(needle.output_dir, 'extra')
     needle._create_dir(needle.output_dir)
 
+    # Fresh images of passing comparisons are only written when asked to keep them
+    needle.keep_on_success = True
+
     screenshot_path = os.path.join(needle.output_dir, "output_dir_test.png")
 
     # Navigate to web page
@@ -116,6 +215,238 @@ def test_output_dir(needle):
         assert os.path.exists(screenshot_path)
 
 
+@pytest.mark.output_dir
+def test_recompare(needle):
+    """Verify that fresh images left in the output directory can be compared again without a browser
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Keep the fresh image in its own output directory
+    needle.output_dir = os.path.join(needle.output_dir, 'recompare')
+    needle.keep_on_success = True
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take a entire page screen diff
+    needle.assert_screenshot('recompare_test', threshold=80)
+
+    assert recompare(needle.output_dir, needle.baseline_dir, needle.engine_class, threshold=80) == 0
+
+
+@pytest.mark.baseline_dir
+def test_baseline_store(needle):
+    """Verify that baselines can be saved to and compared against a baseline store
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    needle.baseline_dir = os.path.join(needle.baseline_dir, 'store')
+    needle.options['baseline_stores'] = stores = BaselineStores()
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    needle.save_baseline = True
+    needle.assert_screenshot('store_test_1')
+    needle.assert_screenshot('store_test_2')
+
+    # Identical screenshots are stored once
+    assert stores.get(needle.baseline_dir).stats['images'] == 1
+
+    needle.save_baseline = False
+    needle.assert_screenshot('store_test_1', threshold=80)
+
+    stores.close()
+
+
+@pytest.mark.baseline_dir
+def test_image_format(needle):
+    """Verify that baselines and fresh images can be written as lossless WebP
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    needle.baseline_format = needle.output_format = 'webp'
+    needle.keep_on_success = True
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    needle.save_baseline = True
+    needle.assert_screenshot('format_test')
+
+    needle.save_baseline = False
+    needle.assert_screenshot('format_test', threshold=80)
+
+    assert os.path.exists(os.path.join(needle.baseline_dir, 'format_test.webp'))
+    assert os.path.exists(os.path.join(needle.output_dir, 'format_test.webp'))
+
+
+@pytest.mark.element
+def test_example_batch(needle):
+    """Example for comparing several elements from a single screenshot
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take element screen diffs of the heading and the first paragraph
+    needle.assert_screenshots({
+        'batch_heading': (By.CSS_SELECTOR, 'h1'),
+        'batch_paragraph': (By.CSS_SELECTOR, 'p')
+    }, threshold=80)
+
+
+@pytest.mark.mask
+def test_example_ignore_regions(needle):
+    """Example for comparing page with ignored areas and a region with its own threshold
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take a entire page screen diff, leave out the link and be lenient on the paragraph
+    needle.assert_screenshot('ignore_regions', threshold=80, ignore=[(By.CSS_SELECTOR, 'a')],
+                             regions={'paragraph': ((By.CSS_SELECTOR, 'p'), 200)})
+
+
+@pytest.mark.element
+def test_example_stable_frames(needle):
+    """Example for waiting until consecutive screenshots are identical before comparing
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take an element screen diff once two consecutive captures match
+    needle.assert_screenshot('stable_heading', (By.CSS_SELECTOR, 'h1'), threshold=80, stable_frames=2)
+
+    assert needle.assertion_stats[-1]['stable_frames'] >= 1
+
+
+@pytest.mark.element
+def test_example_incremental_save(needle):
+    """Example for saving a baseline again without rewriting it
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    needle.save_baseline = True
+    needle.assert_screenshot('incremental_heading', (By.CSS_SELECTOR, 'h1'))
+    needle.assert_screenshot('incremental_heading', (By.CSS_SELECTOR, 'h1'))
+
+    assert needle.assertion_stats[-1]['baseline_update'] == 'skipped'
+
+
+@pytest.mark.element
+def test_example_incremental_save_stale_manifest(needle):
+    """Verify that saving an unchanged baseline again rebuilds its stale manifest entry
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    baseline_image = os.path.join(needle.baseline_dir, 'incremental_stale_heading.png')
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    needle.save_baseline = True
+    needle.assert_screenshot('incremental_stale_heading', (By.CSS_SELECTOR, 'h1'))
+
+    # A fresh checkout changes the modification time of baselines
+    os.utime(baseline_image, (0, 0))
+    assert needle._get_baseline_hash(baseline_image) is None
+
+    needle.assert_screenshot('incremental_stale_heading', (By.CSS_SELECTOR, 'h1'))
+
+    assert needle.assertion_stats[-1]['baseline_update'] == 'skipped'
+    assert needle._get_baseline_hash(baseline_image) is not None
+
+
+@pytest.mark.element
+def test_example_file_object(needle):
+    """Example for comparing against a baseline given as a file object
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    needle.save_baseline = True
+    needle.assert_screenshot('file_object_heading', (By.CSS_SELECTOR, 'h1'))
+
+    needle.save_baseline = False
+
+    with open(os.path.join(needle.baseline_dir, 'file_object_heading.png'), 'rb') as baseline:
+        needle.assert_screenshot(baseline, (By.CSS_SELECTOR, 'h1'), threshold=80)
+
+
+@pytest.mark.element
+def test_example_pyramid(needle):
+    """Example for comparing downscaled screenshots before full resolution
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    needle.pyramid = True
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    # Take a element screen diff
+    needle.assert_screenshot('pyramid_test', (By.CSS_SELECTOR, 'body div *:first-child'), threshold=80)
+
+
+@pytest.mark.element
+def test_example_pyramid_prune_kept_baseline(needle):
+    """Verify that saving an unchanged baseline with a stale manifest entry keeps its downscaled levels
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    baseline_image = os.path.join(needle.baseline_dir, 'pyramid_prune_heading.png')
+
+    # Navigate to web page
+    needle.driver.get('https://www.example.com')
+
+    needle.save_baseline = True
+    needle.assert_screenshot('pyramid_prune_heading', (By.CSS_SELECTOR, 'h1'))
+
+    digest = needle._get_baseline_hash(baseline_image)
+    needle.pyramid_cache.get(needle.baseline_dir, digest, 16, lambda: Image.open(baseline_image).convert('RGB'))
+
+    # A fresh checkout changes the modification time of baselines
+    os.utime(baseline_image, (0, 0))
+    needle.assert_screenshot('pyramid_prune_heading', (By.CSS_SELECTOR, 'h1'))
+
+    prune_pyramid(needle.baseline_dir, needle.pyramid_cache.stale)
+
+    assert os.path.exists(os.path.join(needle.baseline_dir, PYRAMID_DIR, '{}.16.png'.format(digest)))
+
+
 @pytest.mark.baseline_dir
 def test_baseline_dir(needle):
     """Verify that the --needle-baseline-dir saves the fresh image in the specified directory
@@ -155,8 +486,24 @@ def test_viewport_size(needle):
     assert needle.driver.get_window_size() != original_size
 
 
+@pytest.mark.viewport
+@pytest.mark.needle_viewport('800x600')
+def test_viewport_marker(needle):
+    """Verify that the needle_viewport marker overrides the viewport size of a test
+
+    :param NeedleDriver needle: NeedleDriver instance
+    :return:
+    """
+
+    assert needle.viewport_size == '800x600'
+
+    # The window is not resized again if the viewport size did not change
+    needle.set_viewport()
+    assert needle.window_tracker.skipped
+
+
 @pytest.mark.engine
-@pytest.mark.parametrize('engine', ('pil', 'perceptualdiff', 'imagemagick'))
+@pytest.mark.parametrize('engine', ('pil', 'perceptualdiff', 'imagemagick', 'numpy'))
 def test_image_engine(needle, engine):
     """Verify all image engines can be set
 